@@ -0,0 +1,85 @@
+import os
+import sys
+import types
+import timeit
+import logging
+import twp
+from twp import marshalling, parser, reader
+from twp.protocols import tcp
+from twp.utils import pack_ip
+
+twp.log.setLevel(logging.WARN)
+
+CALCULATOR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "protocols", "tcp.tdl")
+
+class Connection(object):
+    def __init__(self, protocol):
+        self.protocol = protocol
+        protocol.init_connection(self)
+
+def generated_module():
+    source = parser.compile_file(CALCULATOR, None,
+        {"double": "twp.protocols.tcp.Double"})
+    module = types.ModuleType("calculator")
+    exec(source, module.__dict__)
+    return module
+
+def messages(module):
+    ip = pack_ip("127.0.0.1")
+    arguments = [
+        (0, 42.0),
+        (1, [ip, 9000, [
+            (0, 23.0),
+            (1, [ip, 9001, [(0, 5.0), (0, 666.666)]]),
+        ]]),
+    ]
+    request = module.Request(1, arguments)
+    request.extensions.append(tcp.ThreadID(9, 1))
+    return [
+        ("calculator Request", request),
+        ("calculator Reply", module.Reply(1, 736.666)),
+    ]
+
+def bench(name, message, encode, decode, number):
+    def generated_marshal():
+        parts = []
+        encode(message, parts.append)
+        return b"".join(parts)
+    data = marshalling.marshal(message)
+    if generated_marshal() != data:
+        raise AssertionError("Encodings differ for %s" % name)
+    compiled_decode = reader._get_typed_decoder(message.__class__)
+    r = reader._RawReader(Connection(tcp.CalculatorProtocol()), data, None,
+        False)
+    def decode_with(decode):
+        r.pos = 0
+        return decode(r, r.read_tag())
+    t_encode = timeit.timeit(lambda: marshalling.marshal(message),
+        number=number)
+    t_generated_encode = timeit.timeit(generated_marshal, number=number)
+    t_decode = timeit.timeit(lambda: decode_with(compiled_decode),
+        number=number)
+    t_generated_decode = timeit.timeit(lambda: decode_with(decode),
+        number=number)
+    print("%-20s %8.2f us %8.2f us %6.2fx %8.2f us %8.2f us %6.2fx" % (name,
+        t_encode / number * 1e6, t_generated_encode / number * 1e6,
+        t_encode / t_generated_encode,
+        t_decode / number * 1e6, t_generated_decode / number * 1e6,
+        t_decode / t_generated_decode))
+
+def run(number):
+    module = generated_module()
+    print("%-20s %11s %11s %7s %11s %11s %7s" % ("message", "encode",
+        "generated", "speedup", "decode", "generated", "speedup"))
+    for name, message in messages(module):
+        cls = message.__class__
+        bench(name, message, module.encoders[cls], module.decoders[cls],
+            number)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [<iterations>]" % sys.argv[0])
+        exit(1)
+    number = int(sys.argv[1]) if len(sys.argv) == 2 else 20000
+    run(number)
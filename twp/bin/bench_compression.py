@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import zlib
+import logging
+import twp
+from twp import compression, fields, marshalling, message
+
+twp.log.setLevel(logging.WARN)
+
+class Filelist(fields.Sequence):
+    type = fields.String()
+
+class ListResult(fields.Struct):
+    directories = Filelist()
+    files = Filelist()
+
+class ListReply(message.Message):
+    # Shaped like an RPC Reply carrying a TFS ListResult
+    id = 1
+    request_id = fields.Int()
+    result = ListResult()
+
+class ReadReply(message.Message):
+    # Shaped like an RPC Reply carrying the data of a TFS read
+    id = 1
+    request_id = fields.Int()
+    result = fields.Binary()
+
+def payloads():
+    directories = ["dir%04d" % i for i in range(200)]
+    files = ["file_%05d.txt" % i for i in range(5000)]
+    text = b"".join(b"%d: The quick brown fox jumps over the lazy dog\n" % i
+        for i in range(20000))
+    return [
+        ("ListResult", ListReply(1, [directories, files])),
+        ("read, text", ReadReply(2, text)),
+        ("read, random", ReadReply(3, os.urandom(len(text)))),
+    ]
+
+def bench(name, value, level, number):
+    data = marshalling.marshal(value)
+    start = time.process_time()
+    for _ in range(number):
+        wrapped = marshalling.marshal(compression.compress(data, level))
+    compress_time = (time.process_time() - start) / number
+    # As received by the peer
+    extension = message.UnknownExtension(compression.Compressed.registered_id,
+        [zlib.compress(data, level)])
+    start = time.process_time()
+    for _ in range(number):
+        compression.decompress(extension)
+    decompress_time = (time.process_time() - start) / number
+    print("%-14s %5d %10d %10d %6.1f%% %9.2f ms %9.2f ms" % (name, level,
+        len(data), len(wrapped), 100.0 * len(wrapped) / len(data),
+        compress_time * 1e3, decompress_time * 1e3))
+
+def run(number):
+    print("%-14s %5s %10s %10s %7s %12s %12s" % ("payload", "level", "bytes",
+        "sent", "ratio", "compress", "decompress"))
+    for name, value in payloads():
+        for level in (1, 6, 9):
+            bench(name, value, level, number)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [<iterations>]" % sys.argv[0])
+        exit(1)
+    number = int(sys.argv[1]) if len(sys.argv) == 2 else 20
+    run(number)
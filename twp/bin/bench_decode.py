@@ -0,0 +1,144 @@
+import sys
+import struct
+import timeit
+import logging
+import twp
+from twp import fields, marshalling, reader
+from twp.error import TWPError, EndOfContent
+from twp.message import UnknownExtension
+from twp.protocols import tcp
+
+twp.log.setLevel(logging.WARN)
+
+class LegacyReader(reader.TWPReader):
+    """How TWPReader decoded values before it used a dispatch table: an if
+    chain over the tags, recursion for complex values, and EndOfContent
+    exceptions to find their ends."""
+    def read_value(self):
+        tag = self.read_tag()
+        if tag == 0:
+            raise EndOfContent("Unexpected End-Of-Content")
+        elif tag == 1:
+            return None
+        elif tag == 2:
+            return self.read_complex()
+        elif tag == 3:
+            return self.read_sequence()
+        elif tag in range(4,12):
+            return self.read_union(tag)
+        elif tag == 12:
+            return self.read_extension(tag)
+        elif tag in range(13, 15):
+            return self.read_int(tag)
+        elif tag in range(15, 17):
+            return self.read_binary(tag)
+        elif tag in range(17, 128):
+            return self.read_string(tag)
+        elif tag in range(160, 256):
+            return self.read_application_type(tag)
+        else:
+            raise TWPError("Invalid tag: %d" % tag)
+
+    def read_complex(self):
+        values = []
+        while True:
+            try:
+                val = self.read_value()
+                values.append(val)
+            except EndOfContent:
+                break
+        return values
+
+    def read_sequence(self):
+        return self.read_complex()
+
+    def read_union(self, tag=None):
+        tag = tag or self.read_tag()
+        return tag - 4, self.read_value()
+
+    def read_int(self, tag=None):
+        tag = tag or self.read_tag()
+        formats = {
+            13: "!b",
+            14: "!l",
+        }
+        return self.read_with_format(formats[tag])
+
+    def read_binary(self, tag):
+        formats = {
+            15: "!B",
+            16: "!I"
+        }
+        length = self.read_with_format(formats[tag])
+        return self.read_bytes(length)
+
+    def read_string(self, tag):
+        if tag < 127:
+            length = tag - 17
+        else:
+            length = self.read_with_format("!I")
+        return self.read_bytes(length).decode("utf-8")
+
+    def read_extension(self, tag=None):
+        tag = tag or self.read_tag()
+        id = struct.unpack("!I", self.read_bytes(4))[0]
+        start_pos = self.pos
+        values = self.read_complex()
+        raw = bytes(self.buffer[start_pos:self.pos - 1])
+        return UnknownExtension(id, values, raw=raw)
+
+
+class Connection(object):
+    # Just enough of a connection for application types
+    def __init__(self):
+        self.protocol = tcp.CalculatorProtocol()
+        self.protocol.init_connection(self)
+
+
+def application_type(field, value):
+    field.value = value
+    return field.marshal()
+
+def elements():
+    return [
+        ("no value", b"\1"),
+        ("struct", b"\2\x0d\1\x0d\2\0"),
+        ("sequence", b"\3\x0d\1\0"),
+        ("union", b"\4\x0d\1"),
+        ("extension", b"\x0c\0\0\0\x2a\x0d\1\0"),
+        ("short int", marshalling.marshal_int(5)),
+        ("long int", marshalling.marshal_int(70000)),
+        ("short binary", marshalling.marshal_binary(b"x" * 10)),
+        ("long binary", marshalling.marshal_binary(b"x" * 300)),
+        ("short string", marshalling.marshal_str("hello")),
+        ("long string", marshalling.marshal_str("x" * 300)),
+        ("Double", application_type(tcp.Double(), 1.5)),
+        ("PackedArray", application_type(fields.PackedArray(), [1.0] * 4)),
+    ]
+
+def decode_time(reader_class, data, number):
+    connection = Connection()
+    r = reader_class(connection)
+    connection.reader = r
+    r.replace_processed(data)
+    def decode():
+        r.pos = 0
+        r.read_value()
+    return timeit.timeit(decode, number=number) / number
+
+def run(count, number):
+    print("%-14s %12s %12s %8s" % ("element", "legacy", "table", "speedup"))
+    for name, element in elements():
+        # A sequence of count elements
+        data = b"\3" + element * count + b"\0"
+        legacy = decode_time(LegacyReader, data, number)
+        current = decode_time(reader.TWPReader, data, number)
+        print("%-14s %9.2f us %9.2f us %7.2fx" % (name, legacy / count * 1e6,
+            current / count * 1e6, legacy / current))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [<iterations>]" % sys.argv[0])
+        exit(1)
+    number = int(sys.argv[1]) if len(sys.argv) == 2 else 20
+    run(1000, number)
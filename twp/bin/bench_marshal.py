@@ -0,0 +1,67 @@
+import sys
+import timeit
+import logging
+import twp
+from twp import marshalling
+from twp.protocols import echo, fam, tcp
+from twp.tests.marshalling import marshal_reflective
+from twp.utils import pack_ip
+
+twp.log.setLevel(logging.WARN)
+
+def echo_messages():
+    return [
+        ("echo Request", echo.Request("Hello, World!")),
+        ("echo Response", echo.Response("Hello, World!", 10)),
+    ]
+
+def fam_messages():
+    directory = ["home", "user", "projects", "twp", "twp", "protocols"]
+    return [
+        ("FAM Changed", fam.Changed(directory, "fam.py")),
+        ("FAM Created", fam.Created(directory, "x" * 200)),
+    ]
+
+def calculator_messages():
+    ip = pack_ip("127.0.0.1")
+    request = tcp.Request()
+    request.request_id = 1
+    request.arguments = [
+        (0, 42.0),
+        (1, [ip, 9000, [
+            (0, 23.0),
+            (1, [ip, 9001, [(0, 5.0), (0, 666.666)]]),
+        ]]),
+    ]
+    request.extensions.append(tcp.ThreadID(9, 1))
+    return [
+        ("calculator Request", request),
+        ("calculator Reply", tcp.Reply(1, 736.666)),
+    ]
+
+def bench(name, message, number):
+    compiled = marshalling.marshal(message)
+    reflective = marshal_reflective(message)
+    if compiled != reflective:
+        raise AssertionError("Encodings differ for %s" % name)
+    t_reflective = timeit.timeit(
+        lambda: marshal_reflective(message), number=number)
+    t_compiled = timeit.timeit(
+        lambda: marshalling.marshal(message), number=number)
+    print("%-20s %5d bytes %8.2f us %8.2f us %6.2fx" % (name, len(compiled),
+        t_reflective / number * 1e6, t_compiled / number * 1e6,
+        t_reflective / t_compiled))
+
+def run(number):
+    print("%-20s %11s %11s %11s %7s" % ("message", "size", "reflective",
+        "compiled", "speedup"))
+    messages = echo_messages() + fam_messages() + calculator_messages()
+    for name, message in messages:
+        bench(name, message, number)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [<iterations>]" % sys.argv[0])
+        exit(1)
+    number = int(sys.argv[1]) if len(sys.argv) == 2 else 20000
+    run(number)
@@ -0,0 +1,71 @@
+import sys
+import copy
+import timeit
+import logging
+import tracemalloc
+import twp
+from twp.protocols import echo, fam, tcp
+from twp.utils import pack_ip
+
+twp.log.setLevel(logging.WARN)
+
+class LegacyMessage(object):
+    """How messages were built before they kept plain values in slots: every
+    instance deepcopies the field definitions of its class, and the values
+    are assigned to the copies."""
+    def __init__(self, message_class, *args, **kwargs):
+        self.extensions = kwargs.pop("extensions", [])
+        self._fields = copy.deepcopy(message_class._fields)
+        for field, value in zip(self._fields.values(), args):
+            field.value = value
+
+
+def messages():
+    ip = pack_ip("127.0.0.1")
+    directory = ["home", "user", "projects", "twp", "twp", "protocols"]
+    arguments = [
+        (0, 42.0),
+        (1, [ip, 9000, [
+            (0, 23.0),
+            (1, [ip, 9001, [(0, 5.0), (0, 666.666)]]),
+        ]]),
+    ]
+    return [
+        ("echo Response", echo.Response, ("Hello, World!", 10), {}),
+        ("FAM Changed", fam.Changed, (directory, "fam.py"), {}),
+        ("calculator Request", tcp.Request, (1, arguments),
+            {"extensions": [tcp.ThreadID(9, 1)]}),
+        ("calculator Reply", tcp.Reply, (1, 736.666), {}),
+    ]
+
+def memory(build, count=1000):
+    """Returns the bytes allocated per message by build()."""
+    tracemalloc.start()
+    try:
+        kept = [build() for _ in range(count)]
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return size / len(kept)
+
+def bench(name, message_class, args, kwargs, number):
+    legacy = lambda: LegacyMessage(message_class, *args, **kwargs)
+    current = lambda: message_class(*args, **kwargs)
+    t_legacy = timeit.timeit(legacy, number=number)
+    t_current = timeit.timeit(current, number=number)
+    print("%-20s %8.2f us %8.2f us %6.2fx %8d B %8d B" % (name,
+        t_legacy / number * 1e6, t_current / number * 1e6,
+        t_legacy / t_current, memory(legacy), memory(current)))
+
+def run(number):
+    print("%-20s %11s %11s %7s %10s %10s" % ("message", "legacy", "slots",
+        "speedup", "legacy", "slots"))
+    for name, message_class, args, kwargs in messages():
+        bench(name, message_class, args, kwargs, number)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [<iterations>]" % sys.argv[0])
+        exit(1)
+    number = int(sys.argv[1]) if len(sys.argv) == 2 else 20000
+    run(number)
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import twp
+from twp import parser
+
+twp.log.setLevel(logging.WARN)
+
+PROTOCOLS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "protocols")
+APPLICATION_TYPES = {"double": "twp.protocols.tcp.Double"}
+
+def specifications(directory, count):
+    """Writes count specifications to directory, copies of the ones in
+    twp/protocols that differ in a comment, and returns their paths."""
+    sources = []
+    for filename in sorted(os.listdir(PROTOCOLS)):
+        if filename.endswith((".idl", ".tdl")):
+            with open(os.path.join(PROTOCOLS, filename)) as f:
+                sources.append(f.read())
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "spec%d.tdl" % i)
+        with open(path, "w") as f:
+            f.write("// copy %d\n%s" % (i, sources[i % len(sources)]))
+        paths.append(path)
+    return paths
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def run(count):
+    directory = tempfile.mkdtemp()
+    try:
+        paths = specifications(directory, count)
+        output = os.path.join(directory, "out")
+        cache = os.path.join(directory, "cache")
+        os.mkdir(output)
+        t_parse = timed(lambda: [parser.parse_file(path) for path in paths])
+        print("parse %d files: %8.2f ms" % (count, t_parse * 1e3))
+        for jobs in [1, None]:
+            shutil.rmtree(cache, ignore_errors=True)
+            t_cold = timed(parser.compile_files, paths, output,
+                APPLICATION_TYPES, cache, jobs)
+            t_warm = timed(parser.compile_files, paths, output,
+                APPLICATION_TYPES, cache, jobs)
+            print("compile -j %-4s %8.2f ms, with cached specifications "
+                "%8.2f ms" % (jobs or os.cpu_count(), t_cold * 1e3,
+                t_warm * 1e3))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [<files>]" % sys.argv[0])
+        exit(1)
+    count = int(sys.argv[1]) if len(sys.argv) == 2 else 500
+    run(count)
@@ -0,0 +1,120 @@
+import sys
+import time
+import socket
+import logging
+import threading
+import twp
+from twp import fields, marshalling, message, reader
+
+twp.log.setLevel(logging.WARN)
+
+class Blob(message.Message):
+    id = 0
+    data = fields.Binary()
+
+
+class Connection(object):
+    # Just enough of a connection for the readers
+    def __init__(self, sock):
+        self.socket = sock
+        self.recv = sock.recv
+        self.recv_into = sock.recv_into
+
+
+class LegacyReader(reader.TWPReader):
+    """The buffer handling TWPReader had before it used recv_into(): bytes
+    appended to an immutable buffer in reads of 1024 bytes."""
+    def __init__(self, connection, _recvsize=1024):
+        self.connection = connection
+        self.buffer = b""
+        self.pos = 0
+        self._recvsize = _recvsize
+
+    def flush(self):
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+
+    @property
+    def processed_bytes(self):
+        return self.buffer[:self.pos]
+
+    def _ensure_buffer_length(self, length):
+        if self.remaining_byte_length < length:
+            if not self._read_from_connection():
+                raise reader.ReaderError("Connection closed")
+        if self.remaining_byte_length < length:
+            raise reader.NotEnoughBytes()
+
+    def _read_from_connection(self, size=1024):
+        data = self.connection.recv(self._recvsize)
+        if not len(data):
+            return False
+        self.buffer += data
+        return True
+
+    def read_bytes(self, n):
+        self._ensure_buffer_length(n)
+        end = self.pos + n
+        value = self.buffer[self.pos:end]
+        self._advance(n)
+        return value
+
+
+def receive(reader_class, data):
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=sender.sendall, args=(data,))
+    thread.start()
+    recvs = [0]
+    connection = Connection(receiver)
+    def recv(*args):
+        recvs[0] += 1
+        return receiver.recv(*args)
+    def recv_into(*args):
+        recvs[0] += 1
+        return receiver.recv_into(*args)
+    connection.recv = recv
+    connection.recv_into = recv_into
+    r = reader_class(connection)
+    start = time.perf_counter()
+    while True:
+        pos = r.pos
+        try:
+            id, values, extensions = r.read_message()
+            break
+        except reader.NotEnoughBytes:
+            # The legacy reader needs to be rewound, like the consumers did
+            r.pos = pos
+    raw = r.processed_bytes
+    r.flush()
+    elapsed = time.perf_counter() - start
+    thread.join()
+    sender.close()
+    receiver.close()
+    if len(values[0]) != len(data) - 7:
+        raise AssertionError("Received %d bytes" % len(values[0]))
+    return elapsed, recvs[0]
+
+def run(megabytes, legacy_max):
+    print("%8s %-8s %10s %10s" % ("size", "reader", "time", "recvs"))
+    for size in megabytes:
+        data = marshalling.marshal(Blob(b"x" * (size * 2**20)))
+        for name, reader_class in [("legacy", LegacyReader),
+                ("current", reader.TWPReader)]:
+            if reader_class is LegacyReader and size > legacy_max:
+                print("%6d MB %-8s %10s" % (size, name, "skipped"))
+                continue
+            elapsed, recvs = receive(reader_class, data)
+            print("%6d MB %-8s %8.3f s %10d" % (size, name, elapsed, recvs))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    # The legacy reader is quadratic, 64 MB take it more than 15 minutes
+    legacy_max = 16
+    if args and args[0] == "--all":
+        legacy_max = float("inf")
+        args = args[1:]
+    if not all([arg.isdigit() for arg in args]):
+        print("Usage: %s [--all] [<megabytes> ...]" % sys.argv[0])
+        exit(1)
+    megabytes = [int(arg) for arg in args] or [1, 4, 16, 64]
+    run(megabytes, legacy_max)
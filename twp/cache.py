@@ -0,0 +1,75 @@
+import collections
+
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used entries first.
+
+    At most maxsize entries are kept. If maxbytes is given, entries are also
+    evicted while the sizes of all cached values, as computed by sizeof, add
+    up to more than maxbytes. Values larger than maxbytes are not cached."""
+
+    def __init__(self, maxsize=1024, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as recently used."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        if key in self._entries:
+            self.size -= self.sizeof(self._entries.pop(key))
+        self._entries[key] = value
+        self.size += size
+        self._evict()
+
+    def _evict(self):
+        while (len(self._entries) > self.maxsize or
+                self.maxbytes is not None and self.size > self.maxbytes):
+            _, value = self._entries.popitem(last=False)
+            self.size -= self.sizeof(value)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all entries. The counters are kept."""
+        self._entries.clear()
+        self.size = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __repr__(self):
+        return "LRUCache %s" % self.stats()
@@ -0,0 +1,582 @@
+import io
+import re
+import sys
+from collections import namedtuple
+from twp import fields, marshalling
+from twp.error import TWPError
+from twp.message import Extension
+from twp.reader import (NotEnoughBytes, decode_any_defined_by,
+	install_typed_decoders, interrupt_typed, typed_decoder)
+
+# The definitions of a TDL specification, as the Generator works from them.
+# A specification is a list of Protocol, MessageDef and StructDef. Types are
+# Type(kind, name) pairs: kind "primitive" with name int, string, binary or
+# any, kind "identifier" with the name of a defined type or an application
+# type, or kind "any defined by" with the name of the base field.
+Protocol = namedtuple("Protocol", "name id elements")
+MessageDef = namedtuple("MessageDef", "name id registered_id fields")
+StructDef = namedtuple("StructDef", "name registered_id fields")
+SequenceDef = namedtuple("SequenceDef", "name type")
+UnionDef = namedtuple("UnionDef", "name cases")
+CaseDef = namedtuple("CaseDef", "number type name")
+ForwardDef = namedtuple("ForwardDef", "name")
+Field = namedtuple("Field", "type name optional")
+Type = namedtuple("Type", "kind name")
+
+_PRIMITIVE_FIELDS = {
+	"int": "twp.fields.Int()",
+	"string": "twp.fields.String()",
+	"binary": "twp.fields.Binary()",
+	"any": "twp.message.Extension()",
+}
+
+# Tags the fields of messages and structs end with
+_END_TAGS = "tag != 0 and tag != %d" % Extension.tag
+
+
+class Generator(object):
+	"""Writes a module with the classes of the definitions in specification,
+	and straight-line encode and decode functions for each of them, in the
+	tables `encoders` and `decoders` keyed by class, see install().
+	application_types maps identifiers that the specification uses without
+	defining them, like double, to the dotted name of their application type
+	class in twp.fields terms."""
+	def __init__(self, specification, output_stream=sys.stdout,
+			application_types=None):
+		self.specification = specification
+		self.output_stream = output_stream
+		self.application_types = application_types or {}
+
+		self.indent_level = 0
+		self.indent_step = 4
+		self.indent_char = " "
+		# Type definitions by name, and the names only declared so far
+		self.types = {}
+		self.forwards = set()
+		# Application types that fields use, by identifier
+		self.used_application_types = {}
+
+	def write(self, str):
+		self.output_stream.write(str)
+
+	def writeln(self, str):
+		if len(str):
+			str = self._indent_str() + str
+		self.write(str + "\n")
+
+	def start_class(self, name, bases="object"):
+		self.writeln("")
+		if not isinstance(bases, str):
+			bases = ", ".join(bases)
+		self.writeln("class %s(%s):" % (name, bases))
+
+	def start_function(self, name, args):
+		self.writeln("")
+		self.writeln("def %s(%s):" % (name, args))
+
+	def _indent_str(self):
+		return self.indent_char * self.indent_level
+
+	def indent(self):
+		self.indent_level += self.indent_step
+
+	def dedent(self):
+		self.indent_level -= self.indent_step
+		if self.indent_level < 0:
+			self.indent_level = 0
+			raise ValueError("Indent level below 0")
+
+	def generate(self):
+		# The imports depend on the application types the definitions use
+		output_stream = self.output_stream
+		self.output_stream = io.StringIO()
+		try:
+			for definition in self.specification:
+				self._generate_node(definition)
+			definitions = self.output_stream.getvalue()
+		finally:
+			self.output_stream = output_stream
+		if self.forwards:
+			raise ValueError("Declared but never defined: %s"
+				% ", ".join(sorted(self.forwards)))
+		self.writeln("import twp.fields")
+		self.writeln("import twp.message")
+		self.writeln("import twp.protocol")
+		modules = set([name.rpartition(".")[0]
+			for name in self.used_application_types.values()])
+		for module in sorted(modules):
+			self.writeln("import %s" % module)
+		self.writeln("from twp import codegen")
+		self.writeln("from twp.error import TWPError")
+		self.write(definitions)
+		self.writeln("")
+		for name in ["int", "string", "binary", "any"]:
+			self.writeln("_encode_%s, _decode_%s = codegen.field_codecs(%s)"
+				% (name, name, _PRIMITIVE_FIELDS[name]))
+		self.writeln("_encode_value = codegen.field_codecs("
+			"twp.fields.AnyDefinedBy(None))[0]")
+		for name, cls in sorted(self.used_application_types.items()):
+			name = function_name(name)
+			self.writeln("_encode_%s, _decode_%s = codegen.field_codecs(%s())"
+				% (name, name, cls))
+		encoders, decoders = [], []
+		for definition in self.types.values():
+			self._generate_codecs(definition, encoders, decoders)
+		self.writeln("")
+		self._generate_table("encoders", "encode", encoders)
+		self._generate_table("decoders", "decode", decoders)
+
+	def _generate_node(self, node):
+		func = getattr(self, "generate_" + node.__class__.__name__.lower())
+		return func(node)
+
+	def _define(self, node):
+		if node.name in self.types:
+			raise ValueError("%s is defined twice" % node.name)
+		self.forwards.discard(node.name)
+		self.types[node.name] = node
+
+	def generate_protocol(self, node):
+		message_types = []
+		extension_types = []
+		for element in node.elements:
+			self._generate_node(element)
+			if _is_extension(element):
+				extension_types.append(class_name(element.name))
+			elif isinstance(element, MessageDef):
+				message_types.append(class_name(element.name))
+		self.start_class(class_name(node.name), "twp.protocol.Protocol")
+		self.indent()
+		self.writeln("protocol_id = %d" % node.id)
+		self._generate_list("message_types", message_types)
+		if extension_types:
+			self._generate_list("extension_types", extension_types)
+		self.dedent()
+
+	def generate_messagedef(self, node):
+		if _is_extension(node):
+			self.start_class(class_name(node.name), "twp.message.Extension")
+			self.indent()
+			self.writeln("registered_id = %d" % node.registered_id)
+		else:
+			self.start_class(class_name(node.name), "twp.message.Message")
+			self.indent()
+			self.writeln("id = %d" % node.id)
+		self._generate_fields(node.fields)
+		self.dedent()
+		self._define(node)
+
+	def generate_structdef(self, node):
+		if _is_extension(node):
+			self.start_class(class_name(node.name), "twp.message.Extension")
+			self.indent()
+			self.writeln("registered_id = %d" % node.registered_id)
+		else:
+			self.start_class(class_name(node.name), "twp.fields.Struct")
+			self.indent()
+		self._generate_fields(node.fields)
+		self.dedent()
+		self._define(node)
+
+	def _generate_fields(self, fields):
+		for field in fields:
+			self.writeln("%s = %s" % (field.name, self._field(field.type)))
+		if not fields:
+			self.writeln("pass")
+
+	def generate_sequencedef(self, node):
+		self.start_class(class_name(node.name), "twp.fields.Sequence")
+		self.indent()
+		self.writeln("type = %s" % self._field(node.type))
+		self.dedent()
+		self._define(node)
+
+	def generate_uniondef(self, node):
+		self.start_class(class_name(node.name), "twp.fields.Union")
+		self.indent()
+		self.writeln("cases = {")
+		self.indent()
+		for case in node.cases:
+			if case.number > 7:
+				raise ValueError("%s: cases above 7 must be registered "
+					"extensions" % node.name)
+			self.writeln("%d: %s," % (case.number, self._field(case.type)))
+		self.dedent()
+		self.writeln("}")
+		self.dedent()
+		self._define(node)
+
+	def generate_forwarddef(self, node):
+		if node.name not in self.types:
+			self.forwards.add(node.name)
+
+	def _field(self, type):
+		"""The field definition of type, as Python source."""
+		if type.kind == "primitive":
+			return _PRIMITIVE_FIELDS[type.name]
+		elif type.kind == "any defined by":
+			return 'twp.fields.AnyDefinedBy("%s")' % type.name
+		elif type.name in self.types:
+			return "%s()" % class_name(type.name)
+		elif type.name in self.forwards:
+			return "codegen.Forward(lambda: %s)" % class_name(type.name)
+		elif type.name in self.application_types:
+			cls = self.application_types[type.name]
+			self.used_application_types[type.name] = cls
+			return "%s()" % cls
+		raise ValueError("Undefined type %s" % type.name)
+
+	def _encoder(self, type):
+		if type.kind == "primitive":
+			return "_encode_%s" % type.name
+		elif type.kind == "any defined by":
+			return "_encode_value"
+		definition = self.types.get(type.name)
+		if definition is None:
+			return "_encode_%s" % function_name(type.name)
+		elif _is_extension(definition):
+			return "_encode_any"
+		return "encode_%s" % function_name(type.name)
+
+	def _decoder(self, type):
+		if type.kind == "primitive":
+			return "_decode_%s" % type.name
+		definition = self.types.get(type.name)
+		if definition is None:
+			return "_decode_%s" % function_name(type.name)
+		elif _is_extension(definition):
+			# Like any other extension in place of a value
+			return "_decode_any"
+		return "decode_%s" % function_name(type.name)
+
+	def _generate_codecs(self, node, encoders, decoders):
+		name = function_name(node.name)
+		if isinstance(node, SequenceDef):
+			self._generate_sequence_codecs(node, name)
+		elif isinstance(node, UnionDef):
+			self._generate_union_codecs(node, name)
+		elif _is_extension(node):
+			self._generate_extension_encoder(node, name)
+			encoders.append(node)
+			return
+		elif isinstance(node, MessageDef):
+			self._generate_message_codecs(node, name)
+		else:
+			self._generate_struct_codecs(node, name)
+		encoders.append(node)
+		decoders.append(node)
+
+	def _generate_encode_fields(self, fields):
+		for i, field in enumerate(fields):
+			self.writeln("%s(values[%d], write)" % (self._encoder(field.type),
+				i))
+
+	def _generate_decode_fields(self, node):
+		"""Decodes the fields of node into values. They end early at
+		End-Of-Content or an extension, whose tag is left in tag. On
+		NotEnoughBytes, the fields so far are kept for read_typed_message()
+		to resume."""
+		cls = class_name(node.name)
+		self.writeln("values = []")
+		self.writeln("item = reader.pos")
+		self.writeln("try:")
+		self.indent()
+		self.writeln("tag = reader.read_tag()")
+		self.writeln("try:")
+		self.indent()
+		names = [field.name for field in node.fields]
+		for field in node.fields:
+			self.writeln("if %s:" % _END_TAGS)
+			self.indent()
+			if field.type.kind == "any defined by":
+				self.writeln("values.append(codegen.decode_any_defined_by("
+					'reader, tag, %s._fields["%s"], values[%d]))'
+					% (class_name(node.name), field.name,
+					names.index(field.type.name)))
+			else:
+				self.writeln("values.append(%s(reader, tag))"
+					% self._decoder(field.type))
+			self.writeln("item = reader.pos")
+			self.writeln("tag = reader.read_tag()")
+			self.dedent()
+		if not node.fields:
+			self.writeln("pass")
+		self.dedent()
+		self.writeln("except TWPError as e:")
+		self.indent()
+		self.writeln("raise codegen.field_error(%s, values, e)" % cls)
+		self.dedent()
+		self.dedent()
+		self._generate_interrupt(cls, "values", "len(values)")
+		self.writeln("if %s:" % _END_TAGS)
+		self.indent()
+		self.writeln('raise TWPError("%s has more values than fields")' % cls)
+		self.dedent()
+
+	def _generate_interrupt(self, cls, values, position):
+		"""Ends a try block whose decoding of a value of cls may be
+		interrupted, see reader.interrupt_typed()."""
+		self.writeln("except codegen.NotEnoughBytes:")
+		self.indent()
+		self.writeln("codegen.interrupt_typed(reader, item, %s, %s, %s)"
+			% (cls, values, position))
+		self.writeln("raise")
+		self.dedent()
+
+	def _generate_message_codecs(self, node, name):
+		cls = class_name(node.name)
+		self.start_function("encode_%s" % name, "message, write")
+		self.indent()
+		self.writeln("values = message._values")
+		self.writeln("write(%r)" % bytes([4 + node.id]))
+		self._generate_encode_fields(node.fields)
+		self.writeln("for extension in message.extensions:")
+		self.indent()
+		self.writeln("_encode_any(extension, write)")
+		self.dedent()
+		self.writeln("write(b'\\x00')")
+		self.dedent()
+
+		self.start_function("decode_%s" % name, "reader, tag")
+		self.indent()
+		self._generate_decode_fields(node)
+		self.writeln("pool = reader.connection.protocol.message_pool")
+		self.writeln("message = %s._from_values(values," % cls)
+		self.writeln("    None if pool is None else pool.acquire(%s))" % cls)
+		self.writeln("codegen.read_extensions(reader, tag, %s, message)" % cls)
+		self.writeln("return message")
+		self.dedent()
+
+	def _generate_extension_encoder(self, node, name):
+		self.start_function("encode_%s" % name, "extension, write")
+		self.indent()
+		self.writeln("values = extension._values")
+		self.writeln("write(%r)" % marshalling._REGISTERED_ID.pack(
+			Extension.tag, node.registered_id))
+		self._generate_encode_fields(node.fields)
+		self.writeln("write(b'\\x00')")
+		self.dedent()
+
+	def _generate_struct_codecs(self, node, name):
+		cls = class_name(node.name)
+		self.start_function("encode_%s" % name, "value, write")
+		self.indent()
+		self.writeln("if value is None:")
+		self.indent()
+		self.writeln("write(b'\\x01')")
+		self.writeln("return")
+		self.dedent()
+		self.writeln("values = codegen.struct_values(%s, value)" % cls)
+		self.writeln("write(%r)" % bytes([fields.Struct.tag]))
+		self._generate_encode_fields(node.fields)
+		self.writeln("write(b'\\x00')")
+		self.dedent()
+
+		self.start_function("decode_%s" % name, "reader, tag")
+		self.indent()
+		self._generate_check_tag(cls, fields.Struct.tag)
+		self._generate_decode_fields(node)
+		self.writeln("codegen.read_extensions(reader, tag, %s, values)" % cls)
+		self.writeln("return values")
+		self.dedent()
+
+	def _generate_check_tag(self, cls, tag):
+		self.writeln("if tag == 1:")
+		self.indent()
+		self.writeln("return None")
+		self.dedent()
+		self.writeln("elif tag != %d:" % tag)
+		self.indent()
+		self.writeln('raise TWPError("Expected %s but saw tag %%d" %% tag)'
+			% cls)
+		self.dedent()
+
+	def _generate_sequence_codecs(self, node, name):
+		cls = class_name(node.name)
+		self.start_function("encode_%s" % name, "value, write")
+		self.indent()
+		self.writeln("write(%r)" % bytes([fields.Sequence.tag]))
+		self.writeln("if value is not None:")
+		self.indent()
+		self.writeln("for item in value:")
+		self.indent()
+		self.writeln("%s(item, write)" % self._encoder(node.type))
+		self.dedent()
+		self.dedent()
+		self.writeln("write(b'\\x00')")
+		self.dedent()
+
+		self.start_function("decode_%s" % name, "reader, tag")
+		self.indent()
+		self._generate_check_tag(cls, fields.Sequence.tag)
+		self.writeln("start = reader.pos - 1")
+		self.writeln("values = []")
+		self.writeln("item = reader.pos")
+		self.writeln("try:")
+		self.indent()
+		self.writeln("tag = reader.read_tag()")
+		self.writeln("try:")
+		self.indent()
+		self.writeln("while tag != 0:")
+		self.indent()
+		if node.type.kind == "any defined by":
+			# No base field to go by
+			decode = "_decode_any"
+		else:
+			decode = self._decoder(node.type)
+		self.writeln("values.append(%s(reader, tag))" % decode)
+		self.writeln("item = reader.pos")
+		self.writeln("tag = reader.read_tag()")
+		self.dedent()
+		self.dedent()
+		self.writeln("except TWPError as e:")
+		self.indent()
+		self.writeln('raise TWPError("%s[%%d]: %%s" %% (len(values), e))'
+			% cls)
+		self.dedent()
+		self.dedent()
+		self._generate_interrupt(cls, "values", "start")
+		self.writeln("return values")
+		self.dedent()
+
+	def _generate_union_codecs(self, node, name):
+		cls = class_name(node.name)
+		self.start_function("encode_%s" % name, "value, write")
+		self.indent()
+		self.writeln("if value is None:")
+		self.indent()
+		self.writeln("write(b'\\x01')")
+		self.writeln("return")
+		self.dedent()
+		self.writeln("case, value = value")
+		keyword = "if"
+		for case in node.cases:
+			self.writeln("%s case == %d:" % (keyword, case.number))
+			self.indent()
+			self.writeln("write(%r)" % bytes([4 + case.number]))
+			self.writeln("%s(value, write)" % self._encoder(case.type))
+			self.dedent()
+			keyword = "elif"
+		self.writeln("else:")
+		self.indent()
+		self.writeln('raise ValueError("Invalid case %d" % case)')
+		self.dedent()
+		self.dedent()
+
+		self.start_function("decode_%s" % name, "reader, tag")
+		self.indent()
+		self.writeln("item = reader.pos")
+		self.writeln("try:")
+		self.indent()
+		for case in node.cases:
+			self.writeln("if tag == %d:" % (4 + case.number))
+			self.indent()
+			self.writeln("return %d, %s(reader, reader.read_tag())"
+				% (case.number, self._decoder(case.type)))
+			self.dedent()
+		if not node.cases:
+			self.writeln("pass")
+		self.dedent()
+		self._generate_interrupt(cls, "tag - 4", "None")
+		self.writeln("if tag == 1:")
+		self.indent()
+		self.writeln("return None")
+		self.dedent()
+		self.writeln('raise TWPError("Expected a case of %s but saw tag %%d" '
+			'%% tag)' % cls)
+		self.dedent()
+
+	def _generate_list(self, name, items):
+		self.writeln("%s = [" % name)
+		self.indent()
+		for item in items:
+			self.writeln("%s," % item)
+		self.dedent()
+		self.writeln("]")
+
+	def _generate_table(self, name, prefix, definitions):
+		self.writeln("%s = {" % name)
+		self.indent()
+		for definition in definitions:
+			self.writeln("%s: %s_%s," % (class_name(definition.name),
+				prefix, function_name(definition.name)))
+		self.dedent()
+		self.writeln("}")
+
+
+def _is_extension(node):
+	return getattr(node, "registered_id", None) is not None
+
+def class_name(name):
+	"""The Python class name for a TDL identifier, e.g. ListResult for
+	list_result. Identifiers that start upper case are kept."""
+	if name[:1].isupper():
+		return name
+	return "".join([part.capitalize() for part in name.split("_")])
+
+def function_name(name):
+	"""The lower case name of the generated functions for a TDL identifier,
+	e.g. start_executing for StartExecuting."""
+	return re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", name).lower()
+
+
+# Runtime of the generated modules
+
+class Forward(fields.Base):
+	"""The field definition of a type that has been declared with typedef but
+	is defined further down. resolve() returns its class."""
+	def __init__(self, resolve):
+		super(Forward, self).__init__()
+		self._resolve = resolve
+		self._ref = None
+
+	@property
+	def ref(self):
+		if self._ref is None:
+			self._ref = self._resolve()()
+		return self._ref
+
+	def _convert(self, value):
+		return self.ref._convert(value)
+
+
+def field_codecs(field):
+	"""Returns the encoder and the typed decoder for values of the field
+	definition `field`, for primitive and application types."""
+	return marshalling._field_encoder(field), typed_decoder(field)
+
+struct_values = marshalling._struct_values
+
+def field_error(cls, values, error):
+	"""Returns error prefixed with the field of cls whose value failed to
+	decode after values."""
+	names = list(cls._fields)
+	if len(values) >= len(names):
+		return error
+	return TWPError("%s.%s: %s" % (cls.__name__, names[len(values)], error))
+
+def read_extensions(reader, tag, cls, value):
+	"""Read the extensions after the fields of value, a message or the values
+	of a struct of cls, starting with tag, up to End-Of-Content. They are
+	appended to the extensions of messages; structs have no place to keep
+	them."""
+	item = reader.pos - 1
+	try:
+		while tag == Extension.tag:
+			extension = reader._read_typed_extension()
+			if not issubclass(cls, fields.Struct):
+				value.extensions.append(extension)
+			item = reader.pos
+			tag = reader.read_tag()
+	except NotEnoughBytes:
+		interrupt_typed(reader, item, cls, value, None)
+		raise
+	if tag != 0:
+		raise TWPError("Expected extension or EOC but saw %d" % tag)
+
+def install(module):
+	"""Have marshal() and read_typed_message() use the codecs of a generated
+	module instead of compiling their own. enable_cache() and disable_cache()
+	drop the encoders again."""
+	marshalling._encoders.update(module.encoders)
+	install_typed_decoders(module.decoders)
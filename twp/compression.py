@@ -0,0 +1,53 @@
+"""Compression of large message bodies.
+
+Both sides send a Compression extension message after the protocol id. If
+both offer zlib, each side wraps the marshalled messages it sends that are at
+least as large as its compression threshold into a Compressed extension
+message, and unwraps the ones it receives."""
+import zlib
+from twp import fields, message
+from twp.error import TWPError
+
+ZLIB = "zlib"
+# Limit for decompressed messages when the connection sets no
+# max_message_size, so a small Compressed body cannot expand without bound
+DEFAULT_MAX_SIZE = 64 * 2**20
+
+class Compression(message.Extension):
+    """Offers or accepts a compression algorithm. An empty algorithm declines
+    an offer."""
+    registered_id = 64
+    algorithm = fields.String()
+
+
+class Compressed(message.Extension):
+    """A marshalled message, compressed with zlib."""
+    registered_id = 65
+    body = fields.Binary()
+
+
+def compress(data, level=6):
+    """Returns a Compressed extension wrapping the marshalled message data."""
+    return Compressed(zlib.compress(data, level))
+
+def decompress(extension, max_size=None):
+    """Returns the marshalled message wrapped by a received Compressed
+    extension. Raises a TWPError if it is larger than max_size, or than
+    DEFAULT_MAX_SIZE if max_size is None."""
+    body = extension.values[0]
+    if isinstance(body, fields.FileRegion):
+        body = body.read()
+    elif not isinstance(body, (bytes, memoryview)):
+        raise TWPError("Expected binary compressed body but saw %s" % body)
+    if max_size is None:
+        max_size = DEFAULT_MAX_SIZE
+    try:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(body, max_size + 1)
+    except zlib.error as e:
+        raise TWPError("Failed to decompress message: %s" % e)
+    if len(data) > max_size:
+        raise TWPError("Decompressed message exceeds %d bytes" % max_size)
+    elif not decompressor.eof:
+        raise TWPError("Failed to decompress message: incomplete")
+    return data
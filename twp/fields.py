@@ -1,12 +1,21 @@
 # FIXME rename this module
 
+import array
 import collections
-import copy
 import struct
+import sys
 from .error import TWPError
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Registered ApplicationType subclasses by tag
+application_types = {}
 
 class Base(object):
 	"""Abstract base class for TWP types."""
+	__slots__ = ()
 	tag = None
 
 	def __init__(self, name=None):
@@ -16,9 +25,56 @@ class Base(object):
 	def is_application_type(self):
 		return self.tag and self.tag >= 160
 
+	def _default(self):
+		"""The value of a field with this definition that has not been set."""
+		return None
+
+	def _convert(self, value):
+		"""Returns value as it is stored for a field with this definition."""
+		return value
+
+
+class _FieldValue(object):
+	"""The class-level descriptor of a field of a _Complex class. All 
+	instances share it, and keep the plain values of their fields in their 
+	_values list."""
+	__slots__ = ("index", "convert")
+
+	def __init__(self, index, convert):
+		self.index = index
+		self.convert = convert
+
+	def __get__(self, instance, owner):
+		if instance is None:
+			return self
+		return instance._values[self.index]
+
+	def __set__(self, instance, value):
+		if self.convert is not None:
+			value = self.convert(value)
+		instance._values[self.index] = value
+
+
+class _StringValue(_FieldValue):
+	__slots__ = ()
+
+	def __get__(self, instance, owner):
+		if instance is None:
+			return self
+		value = instance._values[self.index]
+		if value.__class__ is LazyString:
+			# Decode on first access
+			value = instance._values[self.index] = value.data
+		return value
+
 
 class _ComplexType(type):
-	"""Metaclass for Complex classes with fields."""
+	"""Metaclass for Complex classes with fields. The field definitions are 
+	moved to _fields, and instances only keep the field values, in the 
+	_values slot. _descriptors holds a _FieldValue per field name; classes 
+	with _attribute_access also have them as attributes. Like other classes,
+	subclasses have a __dict__ for attributes of their own unless they 
+	declare __slots__, e.g. __slots__ = () to save its memory."""
 	@classmethod
 	def __prepare__(metacls, name, bases, **kwargs):
 		# Use an OrderedDict as __dict__, so that the marshaling order of 
@@ -26,18 +82,36 @@ class _ComplexType(type):
 		return collections.OrderedDict()
 
 	def __new__(metacls, name, bases, attrs):
-		cls = type.__new__(metacls, name, bases, attrs)
-		cls._fields = collections.OrderedDict()
-		# Copy all Field-type attributes to _fields and initialize the original 
-		# attributes with None.
-		for k, v in attrs.items():
+		fields = collections.OrderedDict()
+		for base in reversed(bases):
+			fields.update(getattr(base, "_fields", ()))
+		# Move all Field-type attributes to _fields
+		for k, v in list(attrs.items()):
 			if isinstance(v, Base):
-				if metacls.bases_have_attr(bases, k):
+				# name is only an attribute of field definitions
+				if metacls.bases_have_attr(bases, k) and k != "name":
 					raise TypeError("%s.%s overrides a member of a base class."
-						% (cls.__name__, k))
-				cls._fields[k] = v
+						% (name, k))
+				fields[k] = v
 				v.name = v.name or k
-				delattr(cls, k)
+				del attrs[k]
+		cls = type.__new__(metacls, name, bases, attrs)
+		cls._fields = fields
+		cls._defaults = tuple([field._default() for field in fields.values()])
+		cls._descriptors = collections.OrderedDict()
+		cls._conversions = []
+		for i, (k, field) in enumerate(fields.items()):
+			convert = field._convert
+			if type(field)._convert is Base._convert:
+				convert = None
+			else:
+				cls._conversions.append((i, convert))
+			value_class = _FieldValue
+			if isinstance(field, String):
+				value_class = _StringValue
+			cls._descriptors[k] = value_class(i, convert)
+			if cls._attribute_access:
+				setattr(cls, k, cls._descriptors[k])
 		return cls
 
 	def bases_have_attr(bases, attr):
@@ -48,21 +122,43 @@ class _ComplexType(type):
 
 
 class _Complex(Base, metaclass=_ComplexType):
-	def __new__(cls, *args, **kwargs):
-		instance = super(_Complex, cls).__new__(cls)
-		# Copy all the fields to be per instance, even if defined per class
-		# This is a strange way of achieving this. Better have types.Foo() 
-		# return a class/factory instead and create the instances in __new__
-		instance._fields = copy.deepcopy(cls._fields)
-		return instance
+	__slots__ = ("_values", "_name")
+	_attribute_access = False
 
 	def __init__(self, *args, **kwargs):
+		self._values = list(self._defaults)
 		name = kwargs.pop("name", None)
 		super(_Complex, self).__init__(name=name)
 		self.update_values(*args, **kwargs)
 
+	@classmethod
+	def _from_values(cls, values, instance=None):
+		"""Returns an instance with the field values in the list values, in 
+		marshalling order, without going through update_values(). Missing 
+		values are the defaults. If instance is given, it is reused."""
+		missing = len(cls._defaults) - len(values)
+		if missing < 0:
+			raise ValueError("Too many positional args")
+		elif missing:
+			values.extend(cls._defaults[len(values):])
+		for i, convert in cls._conversions:
+			values[i] = convert(values[i])
+		if instance is None:
+			instance = cls.__new__(cls)
+			instance._name = None
+		instance._values = values
+		return instance
+
+	@property
+	def name(self):
+		return self._name
+
+	@name.setter
+	def name(self, name):
+		self._name = name
+
 	def get_fields(self):
-		"""Returns an iterable of fields in marshalling order."""
+		"""Returns an iterable of field definitions in marshalling order."""
 		return self._fields.values()
 
 	@property
@@ -78,8 +174,24 @@ class _Complex(Base, metaclass=_ComplexType):
 			# Not a list, maybe a dict?
 			self.update_values(**values)
 
+	def _convert(self, value):
+		"""Values of fields with this definition are instances of its class,
+		they can be given as a dict or a list of field values too."""
+		cls = self.__class__
+		if value is None or isinstance(value, cls):
+			return value
+		elif isinstance(value, dict):
+			instance = cls._from_values([])
+			instance.update_values(**value)
+			return instance
+		return cls._from_values(list(value))
+
+	def _items(self):
+		return [(name, descriptor.__get__(self, None)) 
+			for name, descriptor in self._descriptors.items()]
+
 	def __repr__(self):
-		return "%s %s" % (self.__class__.__name__, dict(self._fields))
+		return "%s %s" % (self.__class__.__name__, dict(self._items()))
 
 
 class Struct(_Complex):
@@ -97,34 +209,31 @@ class Struct(_Complex):
 
 	def __getitem__(self, name):
 		try:
-			return self._fields[name].value
+			descriptor = self._descriptors[name]
 		except KeyError:
 			raise KeyError("Struct has no such field %s" % name)
+		return descriptor.__get__(self, None)
 
 	def __setitem__(self, name, value):
 		try:
-			self._fields[name].value = value
+			descriptor = self._descriptors[name]
 		except KeyError:
 			raise KeyError("Struct has no such field %s" % name)
+		descriptor.__set__(self, value)
 
 
 class Sequence(Base): # Should be Complex, but isn't
 	tag = 3
 	type = None
 	value = []
-	def __new__(cls, *args, **kwargs):
-		instance = super(Sequence, cls).__new__(cls)
-		# Destroys the Forward descriptor for some reason.
-		#instance.type = copy.deepcopy(cls.type)
-		return instance
+
+	def _default(self):
+		return self.value
 
 
 class Union(Base): # Should be Complex, but isn't
 	_case = -1
-	def __new__(cls, *args, **kwargs):
-		instance = super(Union, cls).__new__(cls)
-		instance.cases = copy.deepcopy(cls.cases)
-		return instance
+	_value = None
 
 	@property
 	def casedef(self):
@@ -132,24 +241,33 @@ class Union(Base): # Should be Complex, but isn't
 	
 	@property
 	def value(self):
-		try:
-			field = self.cases[self._case]
-		except KeyError:
+		if self._case not in self.cases:
 			return None
-		return self._case, field.value
+		return self._case, self._value
 
 	@value.setter
 	def value(self, val):
+		val = self._convert(val)
 		if val is None:
 			self._case = -1
+			self._value = None
 			return
-		case, val = val
+		self._case, self._value = val
+
+	def _convert(self, value):
+		"""Values are (case, value) tuples, with the value as stored for the 
+		case's definition."""
+		if value is None:
+			return None
+		case, val = value
 		try:
 			field = self.cases[case]
 		except KeyError:
 			raise ValueError("Invalid case %d" % case)
-		self._case = case
-		field.value = val
+		converted = field._convert(val)
+		if converted is val and value.__class__ is tuple:
+			return value
+		return case, converted
 
 
 class RegisteredExtension(_Complex):
@@ -175,6 +293,9 @@ class Primitive(Base):
 		super(Primitive, self).__init__(*args, **kwargs)
 		self.value = None
 
+	def _default(self):
+		return self.value
+
 	def __repr__(self):
 		return "%s: %s" % (self.__class__.__name__, self.value)
 
@@ -193,12 +314,218 @@ class String(Primitive):
 	MAX_SHORT_LENGTH = 109
 	MAX_LENGTH = 2**32-1
 
+	@property
+	def value(self):
+		value = self._value
+		if value.__class__ is LazyString:
+			# Decode on first access
+			value = self._value = value.data
+		return value
+
+	@value.setter
+	def value(self, value):
+		self._value = value
+
+
+class LazyString(collections.UserString):
+	"""A received String value that is only utf-8 decoded when it is used. 
+	encoded holds the received bytes, or a FileRegion they have been spooled
+	to, see TWPReader.zero_copy and spool_threshold. String fields replace it
+	with the decoded str when their value is read."""
+	def __init__(self, encoded):
+		if isinstance(encoded, (str, collections.UserString)):
+			# UserString methods create new instances from str values
+			self.encoded = None
+			self._data = str(encoded)
+		else:
+			self.encoded = encoded
+			self._data = None
+
+	@property
+	def data(self):
+		if self._data is None:
+			encoded = self.encoded
+			if isinstance(encoded, FileRegion):
+				encoded = encoded.read()
+			try:
+				self._data = str(encoded, "utf-8")
+			except UnicodeError:
+				raise TWPError("Failed to utf-8 decode string value")
+		return self._data
+
+	def detach(self):
+		"""Copy the encoded bytes, so they no longer refer to the reader's 
+		buffer."""
+		if isinstance(self.encoded, memoryview):
+			self.encoded = self.encoded.tobytes()
+
+	def __repr__(self):
+		return repr(self.data)
+
 
 class Binary(Primitive):
 	SHORT_TAG = 15
 	LONG_TAG = 16
 
 
+class FileRegion(object):
+	"""A Binary value backed by length bytes of a file, starting at offset. 
+	Marshalling only produces the Binary header for it; connections that 
+	support it send the bytes straight from the file with sendfile(), so they 
+	are never read into memory. Elsewhere the region is read when needed.
+
+	file is a file object opened in binary mode. length defaults to the rest 
+	of the file."""
+	def __init__(self, file, offset=0, length=None):
+		if length is None:
+			file.seek(0, 2)
+			length = file.tell() - offset
+		if offset < 0 or length < 0:
+			raise ValueError("Invalid file region %d+%d" % (offset, length))
+		self.file = file
+		self.offset = offset
+		self.length = length
+
+	def read(self, offset=0, size=None):
+		"""Read size bytes, or up to the end of the region, starting at offset 
+		within the region."""
+		if size is None or size > self.length - offset:
+			size = self.length - offset
+		self.file.seek(self.offset + offset)
+		data = self.file.read(size)
+		if len(data) != size:
+			raise ValueError("File is shorter than the region")
+		return data
+
+	def __bytes__(self):
+		return self.read()
+
+	def __len__(self):
+		return self.length
+
+	def __repr__(self):
+		return "FileRegion(%s, %d, %d)" % (getattr(self.file, "name", "?"),
+			self.offset, self.length)
+
+
+class FixedSizeApplicationType(Primitive):
+	"""Abstract class for application types with a fixed size value. These are 
+	marshalled as the tag, a length byte and the value packed with the struct 
+	format character `format` in network byte order."""
+	tag = None
+	format = None
+
+	@classmethod
+	def unmarshal(cls, bytes):
+		try:
+			return struct.unpack("!" + cls.format, bytes)[0]
+		except struct.error:
+			raise TWPError("Failed to decode %s from %s" % (cls.__name__, bytes))
+
+	def marshal(self):
+		length = struct.calcsize("!" + self.format)
+		try:
+			return struct.pack("!BB" + self.format, self.tag, length, self.value)
+		except struct.error:
+			raise TWPError("Failed to encode %s from %s" 
+				% (self.__class__.__name__, self.value))
+
+
+class ApplicationType(Primitive):
+	"""Abstract class for application types as defined by the spec: the tag, 
+	a 4 byte length and the value. Subclasses with a tag are registered in 
+	application_types, so readers of any protocol can decode them."""
+	tag = None
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		if cls.tag is None:
+			return
+		if not 160 <= cls.tag <= 255:
+			raise ValueError("Application type tags are 160-255, not %d" 
+				% cls.tag)
+		application_types[cls.tag] = cls
+
+	def marshal_value(self, value):
+		"""Implement to return the marshalled value without tag and length."""
+		raise NotImplementedError
+
+	def value_size(self, value):
+		"""Implement to return the length of marshal_value(value) without 
+		marshalling it, for marshalled_size(). Otherwise it marshals the 
+		value to measure it."""
+		raise NotImplementedError
+
+	@classmethod
+	def unmarshal(cls, data, as_numpy=False):
+		"""Implement to decode a value from its bytes. as_numpy asks for 
+		numpy arrays where that applies."""
+		raise NotImplementedError
+
+	def marshal(self):
+		value = self.marshal_value(self.value)
+		return struct.pack("!BI", self.tag, len(value)) + value
+
+
+class PackedArray(ApplicationType):
+	"""A homogeneous array of numbers, packed without per element tags. The 
+	value is a dtype byte followed by the elements in network byte order. 
+	Values can be given as lists, array.array or numpy arrays, and are 
+	decoded to array.array, or numpy arrays if asked to."""
+	tag = 161
+	# dtype name: (dtype byte, array.array typecode, numpy dtype)
+	dtypes = {
+		"int32": (1, "i", ">i4"),
+		"int64": (2, "q", ">i8"),
+		"float64": (3, "d", ">f8"),
+	}
+
+	def __init__(self, dtype="float64", *args, **kwargs):
+		super(PackedArray, self).__init__(*args, **kwargs)
+		if not dtype in self.dtypes:
+			raise ValueError("Unknown dtype %s" % dtype)
+		self.dtype = dtype
+
+	def marshal_value(self, value):
+		code, typecode, numpy_dtype = self.dtypes[self.dtype]
+		if numpy is not None and isinstance(value, numpy.ndarray):
+			data = value.astype(numpy_dtype, copy=False).tobytes()
+		else:
+			value = array.array(typecode, value)
+			if sys.byteorder == "little":
+				value.byteswap()
+			data = value.tobytes()
+		return bytes([code]) + data
+
+	def value_size(self, value):
+		code, typecode, numpy_dtype = self.dtypes[self.dtype]
+		if numpy is not None and isinstance(value, numpy.ndarray):
+			count = value.size
+		else:
+			count = len(value)
+		return 1 + count * array.array(typecode).itemsize
+
+	@classmethod
+	def unmarshal(cls, data, as_numpy=False):
+		if not data:
+			raise TWPError("Packed array without dtype")
+		for code, typecode, numpy_dtype in cls.dtypes.values():
+			if data[0] == code:
+				break
+		else:
+			raise TWPError("Unknown packed array dtype %d" % data[0])
+		if as_numpy:
+			return numpy.frombuffer(data, numpy_dtype, offset=1)
+		value = array.array(typecode)
+		try:
+			value.frombytes(data[1:])
+		except ValueError:
+			raise TWPError("Packed array length does not match its dtype")
+		if sys.byteorder == "little":
+			value.byteswap()
+		return value
+
+
 class AnyDefinedBy(Primitive):
 	def __init__(self, reference_name, *args, **kwargs):
 		super(AnyDefinedBy, self).__init__(*args, **kwargs)
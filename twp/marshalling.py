@@ -1,95 +1,207 @@
+import array
+import copy
 import struct
 from twp.fields import *
-from twp.message import Message, Extension, UnknownExtension
+from twp.message import Message, Extension, UnknownExtension, LazyMessage
+from twp.cache import LRUCache
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 EOC = b"\0"
 NO_VAL = b"\1"
 
+# Prebuilt packers for tag + value headers
+_SHORT_INT = struct.Struct("!BB")
+_LONG_INT = struct.Struct("!BI")
+_SHORT_BINARY = struct.Struct("!BB")
+_LONG_BINARY = struct.Struct("!BI")
+_LONG_STRING = struct.Struct("!BI")
+_REGISTERED_ID = struct.Struct("!BI")
+_SHORT_STRING_TAGS = [bytes([String.SHORT_TAG + length])
+    for length in range(String.MAX_SHORT_LENGTH + 1)]
+
+# Compiled encoders, keyed by Message, Struct, Sequence and Union subclass.
+_encoders = {}
+# Compiled size functions, see marshalled_size()
+_sizers = {}
+
+# Opt-in cache of marshalled sub-values, see enable_cache()
+_cache = None
+_cache_max_value_size = None
+
+# Sequence values that are packed in one go if the element type allows it
+_ARRAY_TYPES = (array.array,) if numpy is None else (array.array, numpy.ndarray)
+_INT_TYPECODES = "bBhHiIlLqQ"
+_NUMBER_TYPECODES = _INT_TYPECODES + "fd"
+
 def marshal(val):
     """Marshal anything that can be sent over a connection, i.e. Message, 
     Extension, or primitive value."""
-    if isinstance(val, Message):
-        return marshal_message(val)
-    elif isinstance(val, Extension):
+    # Extensions are Messages too
+    if isinstance(val, Extension):
         return marshal_extension(val)
+    elif isinstance(val, Message):
+        return marshal_message(val)
+    elif isinstance(val, LazyMessage):
+        return marshal_lazy_message(val)
     else:
         return marshal_value(val)
 
-def _marshal_field(field):
-    if field.is_application_type:
-        return field.marshal()
-    elif isinstance(field, Primitive):
-        return marshal_value(field.value)
-    elif isinstance(field, Struct):
-        return _marshal_struct(field)
-    elif isinstance(field, Sequence):
-        return _marshal_sequence(field)
-    elif isinstance(field, Union):
-        return _marshal_union(field)
-    elif isinstance(field, AnyDefinedBy):
-        return _marshal_any_defined_by(field)
-    elif isinstance(field, Extension):
-        return marshal_extension(field)
+def marshal_buffers(val):
+    """Like marshal(), but return the marshalled value as a list of buffers 
+    instead of joining them. Suitable for vectored writes. FileRegion values 
+    of Binary fields are not read: they appear in the list as they are, 
+    following their Binary header. See join_buffers()."""
+    buffers = []
+    _encode(val, buffers.append)
+    return buffers
+
+def join_buffers(buffers):
+    """Join buffers as returned by marshal_buffers(), reading file regions."""
+    try:
+        return b"".join(buffers)
+    except TypeError:
+        return b"".join([bytes(buffer) if isinstance(buffer, FileRegion)
+            else buffer for buffer in buffers])
+
+def marshal_into(val, buffer):
+    """Like marshal(), but append the marshalled value to the bytearray 
+    buffer. The buffer can be cleared and reused for the next value. Returns 
+    the buffer."""
+    def write(data):
+        if data.__class__ is FileRegion:
+            data = data.read()
+        buffer.extend(data)
+    _encode(val, write)
+    return buffer
+
+def marshal_stream(val, send, chunk_size=65536):
+    """Marshal val and pass the marshalled bytes to send() in chunks of about 
+    chunk_size bytes, as soon as they are produced. Sequence values may be 
+    iterators such as generators: their elements are encoded and sent while 
+    the iterator is consumed, so the whole sequence is never held in memory.
+    """
+    buffer = bytearray()
+    def write(data):
+        if data.__class__ is FileRegion:
+            # Read the region chunk by chunk
+            for offset in range(0, len(data), chunk_size):
+                write(data.read(offset, chunk_size))
+            return
+        if len(data) >= chunk_size:
+            # Large pieces are sent as they are instead of being copied
+            if buffer:
+                send(bytes(buffer))
+                buffer.clear()
+            send(data)
+            return
+        buffer.extend(data)
+        if len(buffer) >= chunk_size:
+            send(bytes(buffer))
+            buffer.clear()
+    _encode(val, write)
+    if buffer:
+        send(bytes(buffer))
+
+def marshal_many(message_class, rows):
+    """Marshal one message of message_class per row and return them as a 
+    single buffer. A row is a tuple of field values in marshalling order, or 
+    a dict mapping field names to values. Missing fields are None, and are 
+    sent like unset fields of a message: as No Value, or as an empty 
+    sequence for sequence fields. No Message instances are created."""
+    tag = _marshal_tag(_message_tag(message_class))
+    names = list(message_class._fields.keys())
+    encode_fields = _compile_fields(message_class)
+    parts = []
+    write = parts.append
+    for row in rows:
+        if isinstance(row, dict):
+            unknown = row.keys() - message_class._fields.keys()
+            if unknown:
+                raise ValueError("Unknown field name: %s" % unknown.pop())
+            row = [row.get(name) for name in names]
+        elif len(row) != len(names):
+            if len(row) > len(names):
+                raise ValueError("Too many values in row %s" % (row,))
+            row = list(row) + [None] * (len(names) - len(row))
+        write(tag)
+        encode_fields(row, write)
+        write(EOC)
+    return join_buffers(parts)
+
+def marshalled_size(val):
+    """Returns the number of bytes marshal(val) would produce, without 
+    marshalling val."""
+    if isinstance(val, Extension):
+        return _extension_size(val)
+    elif isinstance(val, Message):
+        return _get_sizer(val.__class__)(val)
+    elif isinstance(val, LazyMessage):
+        if val.raw is None:
+            return marshalled_size(val.decode())
+        return len(val.raw)
     else:
-        raise ValueError("Not a supported field %s" % field)
+        return _value_size(val)
+
+def enable_cache(cache=None, max_value_size=1024):
+    """Cache the marshalled form of values that repeat across messages: 
+    strings, tuples given as sequence values, and registered extensions. 
+    Repeated values are then copied from the cache instead of being encoded 
+    again. Only values that cannot change are cached: strings, ints, bytes 
+    and tuples of them, and extensions with only such values. Values that 
+    marshal to more than max_value_size bytes are not cached. cache defaults
+    to a new twp.cache.LRUCache. Returns the cache."""
+    global _cache, _cache_max_value_size
+    _cache = cache if cache is not None else LRUCache()
+    _cache_max_value_size = max_value_size
+    # Recompile, encoders only check for the cache when they are built
+    _encoders.clear()
+    return _cache
+
+def disable_cache():
+    global _cache
+    _cache = None
+    _encoders.clear()
+
+def _encode(val, write):
+    if isinstance(val, Extension):
+        _encode_extension(val, write)
+    elif isinstance(val, Message):
+        _get_encoder(val.__class__)(val, write)
+    elif isinstance(val, LazyMessage):
+        if val.raw is None:
+            _encode(val.decode(), write)
+        else:
+            write(val.raw)
+    else:
+        write(marshal_value(val))
 
 def marshal_message(message):
-    tag = _marshal_tag(message.tag)
-    values = [_marshal_field(field) for field in message.get_fields()]
-    extensions = [marshal_extension(ext) for ext in message.extensions]
-    return tag + b"".join(values) + b"".join(extensions) + EOC
+    parts = []
+    _get_encoder(message.__class__)(message, parts.append)
+    return join_buffers(parts)
 
-def _marshal_struct(complex):
-    tag = _marshal_tag(complex.tag)
-    values = [_marshal_field(field) for field in complex.get_fields()]
-    return tag + b"".join(values) + EOC
+def marshal_lazy_message(message):
+    """Returns the received bytes of a LazyMessage, or marshals it again if 
+    one of its fields has been assigned."""
+    if message.raw is None:
+        return marshal_message(message.decode())
+    return bytes(message.raw)
 
 def marshal_extension(extension):
-    tag = _marshal_tag(extension.tag)
-    id = struct.pack("!I", extension.registered_id)
-    if not isinstance(extension, UnknownExtension):
-        values = b"".join([_marshal_field(field) for field in extension.get_fields()])
-    else:
-        values = extension.raw or b'\1'
-    return tag + id + values + EOC
-
-def _marshal_sequence(sequence):
-    type_field = sequence.type
-    values = []
-    for val in sequence.value or []:
-        type_field.value = val
-        values.append(_marshal_field(type_field))
-    type_field.value = None
-    # Not sure if we would have to send NO_VAL if len(values) == 0, probably not.
-    values = b"".join(values)
-    tag = _marshal_tag(sequence.tag)
-    return tag + values + EOC
-
-def _marshal_union(union):
-    val = union.value
-    if val is None:
-        return NO_VAL
-    case, field = val
-    tag = _marshal_tag(4 + case)
-    return tag + _marshal_field(union.casedef)
-
-def _marshal_any_defined_by(field):
-    val = field.value
-    # Not quite as per standard, but works for our RPC use cases at least.
-    if isinstance(val, list):
-        tag = _marshal_tag(Struct.tag)
-        values = [marshal_value(val) for v in val]
-        return tag + b"".join() + EOC
-    else:
-        return marshal_value(val)
+    parts = []
+    _encode_extension(extension, parts.append)
+    return join_buffers(parts)
 
 def marshal_value(val):
     """Marshals a primitive python value"""
     if isinstance(val, int):
         return marshal_int(val)
-    elif isinstance(val, str):
+    elif isinstance(val, (str, LazyString)):
         return marshal_str(val)
-    elif isinstance(val, bytes):
+    elif isinstance(val, (bytes, FileRegion, memoryview)):
         return marshal_binary(val)
     elif val is None:
         return NO_VAL
@@ -108,7 +220,11 @@ def marshal_int(value):
     raise ValueError("Integer value out of bounds %s" % value)
 
 def marshal_str(value):
-    value = str(value).encode("utf-8")
+    if isinstance(value, LazyString) and value.encoded is not None:
+        # Received, send it on without decoding it
+        value = bytes(value.encoded)
+    else:
+        value = str(value).encode("utf-8")
     length = len(value)
     if length <= String.MAX_SHORT_LENGTH:
         tag = _marshal_tag(String.SHORT_TAG + length)
@@ -138,3 +254,537 @@ def marshal_no_value(value):
 def _marshal_tag(tag):
     assert(tag < 256)
     return bytes([tag])
+
+
+# Compiled encoders. Every encoder has the signature encode(value, write), 
+# where write is called with the marshalled pieces in order. The encoders for 
+# a class are built once from its field definitions, so marshalling a value 
+# does not need to inspect the field types again.
+
+def _get_encoder(cls):
+    """Returns the compiled encoder for a Message, Struct, Sequence or Union 
+    subclass, compiling it on first use."""
+    try:
+        return _encoders[cls]
+    except KeyError:
+        pass
+    if issubclass(cls, Extension):
+        return _compile_extension(cls)
+    elif issubclass(cls, Message):
+        return _compile_message(cls)
+    elif issubclass(cls, Struct):
+        return _compile_struct(cls)
+    elif issubclass(cls, Sequence):
+        return _compile_sequence(cls)
+    elif issubclass(cls, Union):
+        return _compile_union(cls)
+    else:
+        raise ValueError("Cannot compile an encoder for %s" % cls)
+
+def _field_encoder(field):
+    """Returns an encoder for values of the field definition `field`."""
+    # Forward declarations only resolve to their target on access.
+    field = getattr(field, "ref", field)
+    if field.is_application_type:
+        return _application_type_encoder(field)
+    elif isinstance(field, Int):
+        return _encode_int
+    elif isinstance(field, String):
+        return _cached(_encode_str, str)
+    elif isinstance(field, Binary):
+        return _encode_binary
+    elif isinstance(field, Primitive):
+        return _encode_value
+    elif isinstance(field, Extension):
+        return _encode_extension
+    elif isinstance(field, Sequence):
+        return _cached(_get_encoder(field.__class__), tuple)
+    elif isinstance(field, (Struct, Union)):
+        return _get_encoder(field.__class__)
+    else:
+        raise ValueError("Not a supported field %s" % field)
+
+def _cached(encode, immutable_type):
+    """Wraps encode to look up values of immutable_type in the cache."""
+    cache = _cache
+    if cache is None:
+        return encode
+    def encode_cached(value, write):
+        if value.__class__ is not immutable_type:
+            encode(value, write)
+            return
+        _write_cached(cache, encode, value, encode, write)
+    return encode_cached
+
+def _write_cached(cache, key, value, encode, write):
+    if not _cacheable(value):
+        encode(value, write)
+        return
+    key = (key, value)
+    data = cache.get(key)
+    if data is None:
+        parts = []
+        encode(value, parts.append)
+        data = join_buffers(parts)
+        if len(data) <= _cache_max_value_size:
+            cache.put(key, data)
+    write(data)
+
+def _cacheable(value):
+    """Whether value is immutable all the way down, so that its marshalled 
+    form cannot change while it is cached. A tuple of Structs, for example, 
+    hashes by identity even though they can be changed. Exact types only:
+    True would be the same key as 1."""
+    cls = value.__class__
+    if cls is str or cls is bytes:
+        return len(value) <= _cache_max_value_size
+    elif cls is int:
+        return True
+    elif cls is tuple:
+        for item in value:
+            if not _cacheable(item):
+                return False
+        return True
+    return False
+
+def _message_tag(cls):
+    tag = cls.tag
+    if isinstance(tag, property):
+        # Message computes its tag from the id
+        tag = tag.fget(cls)
+    return tag
+
+def _compile_fields(cls):
+    """Returns a function that encodes a list of values for the fields of 
+    cls, in marshalling order."""
+    encoders = [_field_encoder(field) for field in cls._fields.values()]
+    def encode_fields(values, write):
+        for encode, value in zip(encoders, values):
+            encode(value, write)
+    return encode_fields
+
+def _compile_message(cls):
+    def encode(message, write):
+        write(tag)
+        encode_fields(message._values, write)
+        for extension in message.extensions:
+            _encode_extension(extension, write)
+        write(EOC)
+    tag = _marshal_tag(_message_tag(cls))
+    _encoders[cls] = encode
+    encode_fields = _compile_fields(cls)
+    return encode
+
+def _compile_extension(cls):
+    def encode(extension, write):
+        write(_REGISTERED_ID.pack(Extension.tag, extension.registered_id))
+        encode_fields(extension._values, write)
+        write(EOC)
+    _encoders[cls] = encode
+    encode_fields = _compile_fields(cls)
+    return encode
+
+def _struct_values(cls, value):
+    """Returns the field values of a struct value in marshalling order. The 
+    value can be a Struct, a dict, or a list of values."""
+    if isinstance(value, Struct):
+        return value._values
+    elif isinstance(value, dict):
+        return [value.get(name) for name in cls._fields]
+    values = list(value)
+    if len(values) > len(cls._fields):
+        raise ValueError("Too many values for %s" % cls.__name__)
+    values += [None] * (len(cls._fields) - len(values))
+    return values
+
+def _compile_struct(cls):
+    def encode(value, write):
+        if value is None:
+            write(NO_VAL)
+            return
+        write(tag)
+        encode_fields(_struct_values(cls, value), write)
+        write(EOC)
+    tag = _marshal_tag(cls.tag)
+    # Register before compiling the fields, so recursive types terminate.
+    _encoders[cls] = encode
+    encode_fields = _compile_fields(cls)
+    return encode
+
+def _compile_sequence(cls):
+    def encode(value, write):
+        write(tag)
+        if value is None:
+            pass
+        elif (pack is not None and isinstance(value, _ARRAY_TYPES) 
+                and pack(value, write)):
+            pass
+        else:
+            for item in value:
+                encode_element(item, write)
+        write(EOC)
+    tag = _marshal_tag(cls.tag)
+    _encoders[cls] = encode
+    encode_element = _field_encoder(cls.type)
+    pack = _array_packer(cls.type)
+    return encode
+
+def _array_packer(field):
+    """Returns a function pack(values, write) that marshals all elements of an
+    array.array or numpy array for the element type `field` at once, or None
+    if elements of that type cannot be packed. pack() returns False if it 
+    cannot handle the particular array."""
+    field = getattr(field, "ref", field)
+    if isinstance(field, Int):
+        return _pack_ints
+    elif isinstance(field, FixedSizeApplicationType):
+        return _fixed_size_packer(field)
+    return None
+
+def _pack_ints(values, write):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if values.ndim != 1 or values.dtype.kind not in "iu":
+            return False
+        if not len(values):
+            return True
+        low, high = int(values.min()), int(values.max())
+    elif values.typecode not in _INT_TYPECODES:
+        return False
+    elif not values:
+        return True
+    else:
+        low, high = min(values), max(values)
+    if low < 0 or high >= 2**32:
+        raise ValueError("Integer value out of bounds %s" 
+            % (low if low < 0 else high))
+    # Same choice of short and long form as _encode_int()
+    if high < 256:
+        tag, format = 13, "B"
+    elif low >= 256:
+        tag, format = 14, "I"
+    else:
+        tags = [13 if value < 256 else 14 for value in values]
+        format = "".join(["BB" if tag == 13 else "BI" for tag in tags])
+        args = [0] * (2 * len(values))
+        args[0::2] = tags
+        args[1::2] = values.tolist()
+        write(struct.pack("!" + format, *args))
+        return True
+    write(_pack_elements((tag,), format, values))
+    return True
+
+def _fixed_size_packer(field):
+    header = (field.tag, struct.calcsize("!" + field.format))
+    def pack(values, write):
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            if values.ndim != 1 or values.dtype.kind not in "iuf":
+                return False
+        elif values.typecode not in _NUMBER_TYPECODES:
+            return False
+        write(_pack_elements(header, field.format, values))
+        return True
+    return pack
+
+def _pack_elements(header, format, values):
+    """Packs each of the values with the struct format character `format`, 
+    prefixed by the bytes in header."""
+    n = len(values)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        layout = [("h%d" % i, "u1") for i in range(len(header))]
+        layout.append(("value", ">" + format))
+        packed = numpy.empty(n, dtype=layout)
+        for i, byte in enumerate(header):
+            packed["h%d" % i] = byte
+        packed["value"] = values
+        return packed.tobytes()
+    width = len(header) + 1
+    args = [0] * (width * n)
+    for i, byte in enumerate(header):
+        args[i::width] = [byte] * n
+    args[len(header)::width] = values.tolist()
+    format = "B" * len(header) + format
+    return struct.pack("!" + format * n, *args)
+
+def _compile_union(cls):
+    def encode(value, write):
+        if value is None:
+            write(NO_VAL)
+            return
+        case, value = value
+        try:
+            tag, encode_case = cases[case]
+        except KeyError:
+            raise ValueError("Invalid case %d" % case)
+        write(tag)
+        encode_case(value, write)
+    cases = {}
+    _encoders[cls] = encode
+    for case, field in cls.cases.items():
+        cases[case] = (_marshal_tag(4 + case), _field_encoder(field))
+    return encode
+
+def _application_type_encoder(field):
+    # Application types marshal themselves from their value, so keep a private
+    # instance around instead of changing the class-level definition.
+    field = copy.copy(field)
+    def encode(value, write):
+        field.value = value
+        write(field.marshal())
+    return encode
+
+def _encode_extension(extension, write):
+    if isinstance(extension, UnknownExtension):
+        write(_REGISTERED_ID.pack(extension.tag, extension.registered_id))
+        write(extension.raw or NO_VAL)
+        write(EOC)
+    elif _cache is not None:
+        cls = extension.__class__
+        values = tuple(extension._values)
+        encode = lambda values, write: _get_encoder(cls)(extension, write)
+        _write_cached(_cache, cls, values, encode, write)
+    else:
+        _get_encoder(extension.__class__)(extension, write)
+
+def _encode_value(value, write):
+    write(marshal_value(value))
+
+def _encode_int(value, write):
+    if value.__class__ is int:
+        if 0 <= value < 256:
+            write(_SHORT_INT.pack(13, value))
+            return
+        elif 0 <= value < 2**32:
+            write(_LONG_INT.pack(14, value))
+            return
+    write(marshal_value(value))
+
+def _encode_str(value, write):
+    if value.__class__ is str:
+        value = value.encode("utf-8")
+    elif value.__class__ is LazyString and value.encoded is not None:
+        value = value.encoded
+    else:
+        write(marshal_value(value))
+        return
+    length = len(value)
+    if length <= String.MAX_SHORT_LENGTH:
+        write(_SHORT_STRING_TAGS[length])
+    elif length <= String.MAX_LENGTH:
+        write(_LONG_STRING.pack(String.LONG_TAG, length))
+    else:
+        raise ValueError("String too long")
+    write(value)
+
+def _encode_binary(value, write):
+    if value.__class__ is memoryview:
+        # Received with zero_copy, or any other buffer
+        length = value.nbytes
+    elif value.__class__ is bytes or value.__class__ is FileRegion:
+        length = len(value)
+    else:
+        write(marshal_value(value))
+        return
+    if length < 256:
+        write(_SHORT_BINARY.pack(Binary.SHORT_TAG, length))
+    elif length < 2**32:
+        write(_LONG_BINARY.pack(Binary.LONG_TAG, length))
+    else:
+        raise ValueError("value too long")
+    write(value)
+
+
+# Compiled size functions. These mirror the encoders above: size(value) 
+# returns the number of bytes the encoder would write for value.
+
+def _get_sizer(cls):
+    try:
+        return _sizers[cls]
+    except KeyError:
+        pass
+    if issubclass(cls, Extension):
+        return _compile_extension_sizer(cls)
+    elif issubclass(cls, Message):
+        return _compile_message_sizer(cls)
+    elif issubclass(cls, Struct):
+        return _compile_struct_sizer(cls)
+    elif issubclass(cls, Sequence):
+        return _compile_sequence_sizer(cls)
+    elif issubclass(cls, Union):
+        return _compile_union_sizer(cls)
+    else:
+        raise ValueError("Cannot compile a size function for %s" % cls)
+
+def _field_sizer(field):
+    field = getattr(field, "ref", field)
+    if isinstance(field, FixedSizeApplicationType):
+        size = 2 + struct.calcsize("!" + field.format)
+        return lambda value: size
+    elif (isinstance(field, ApplicationType) and 
+            type(field).value_size is not ApplicationType.value_size):
+        # The tag and the 4 byte length, then the value
+        return lambda value: 5 + field.value_size(value)
+    elif field.is_application_type:
+        encode = _application_type_encoder(field)
+        return lambda value: len(_encode_joined(encode, value))
+    elif isinstance(field, Int):
+        return _int_size
+    elif isinstance(field, String):
+        return _str_size
+    elif isinstance(field, Binary):
+        return _binary_size
+    elif isinstance(field, Primitive):
+        return _value_size
+    elif isinstance(field, Extension):
+        return _extension_size
+    elif isinstance(field, (Struct, Sequence, Union)):
+        return _get_sizer(field.__class__)
+    else:
+        raise ValueError("Not a supported field %s" % field)
+
+def _encode_joined(encode, value):
+    parts = []
+    encode(value, parts.append)
+    return b"".join(parts)
+
+def _compile_fields_sizer(cls):
+    sizers = [_field_sizer(field) for field in cls._fields.values()]
+    def size_fields(values):
+        return sum([size(value) for size, value in zip(sizers, values)])
+    return size_fields
+
+def _compile_message_sizer(cls):
+    def size(message):
+        return (2 + 
+            size_fields(message._values) +
+            sum([_extension_size(ext) for ext in message.extensions]))
+    _sizers[cls] = size
+    size_fields = _compile_fields_sizer(cls)
+    return size
+
+def _compile_extension_sizer(cls):
+    def size(extension):
+        return 6 + size_fields(extension._values)
+    _sizers[cls] = size
+    size_fields = _compile_fields_sizer(cls)
+    return size
+
+def _compile_struct_sizer(cls):
+    def size(value):
+        if value is None:
+            return 1
+        return 2 + size_fields(_struct_values(cls, value))
+    _sizers[cls] = size
+    size_fields = _compile_fields_sizer(cls)
+    return size
+
+def _compile_sequence_sizer(cls):
+    def size(value):
+        if value is None:
+            return 2
+        if pack is not None and isinstance(value, _ARRAY_TYPES):
+            length = _array_size(cls.type, value)
+            if length is not None:
+                return 2 + length
+        return 2 + sum([size_element(item) for item in value])
+    _sizers[cls] = size
+    size_element = _field_sizer(cls.type)
+    pack = _array_packer(cls.type)
+    return size
+
+def _array_size(field, values):
+    """Returns the marshalled size of the elements of an array that 
+    _array_packer() would pack, or None if it would not."""
+    field = getattr(field, "ref", field)
+    is_numpy = numpy is not None and isinstance(values, numpy.ndarray)
+    if is_numpy and values.ndim != 1:
+        return None
+    if isinstance(field, FixedSizeApplicationType):
+        if (values.dtype.kind not in "iuf" if is_numpy 
+                else values.typecode not in _NUMBER_TYPECODES):
+            return None
+        return len(values) * (2 + struct.calcsize("!" + field.format))
+    if (values.dtype.kind not in "iu" if is_numpy 
+            else values.typecode not in _INT_TYPECODES):
+        return None
+    if not len(values):
+        return 0
+    if is_numpy:
+        low, high = int(values.min()), int(values.max())
+        long = int((values >= 256).sum())
+    else:
+        low, high = min(values), max(values)
+        long = sum([1 for value in values if value >= 256])
+    if low < 0 or high >= 2**32:
+        raise ValueError("Integer value out of bounds %s" 
+            % (low if low < 0 else high))
+    return 2 * len(values) + 3 * long
+
+def _compile_union_sizer(cls):
+    def size(value):
+        if value is None:
+            return 1
+        case, value = value
+        try:
+            size_case = cases[case]
+        except KeyError:
+            raise ValueError("Invalid case %d" % case)
+        return 1 + size_case(value)
+    cases = {}
+    _sizers[cls] = size
+    for case, field in cls.cases.items():
+        cases[case] = _field_sizer(field)
+    return size
+
+def _extension_size(extension):
+    if isinstance(extension, UnknownExtension):
+        return 6 + len(extension.raw or NO_VAL)
+    return _get_sizer(extension.__class__)(extension)
+
+def _value_size(value):
+    if isinstance(value, int):
+        return _int_size(int(value))
+    elif isinstance(value, str):
+        return _str_size(str(value))
+    elif isinstance(value, bytes):
+        return _binary_size(bytes(value))
+    elif isinstance(value, (FileRegion, memoryview)):
+        length = value.nbytes if isinstance(value, memoryview) else len(value)
+        return (2 if length < 256 else 5) + length
+    elif isinstance(value, LazyString):
+        if value.encoded is None:
+            return _str_size(value.data)
+        length = len(value.encoded)
+        return (1 if length <= String.MAX_SHORT_LENGTH else 5) + length
+    elif value is None:
+        return 1
+    else:
+        raise ValueError("Cannot marshal %s" % value)
+
+def _int_size(value):
+    if value.__class__ is not int:
+        return _value_size(value)
+    elif 0 <= value < 256:
+        return 2
+    elif 0 <= value < 2**32:
+        return 5
+    raise ValueError("Integer value out of bounds %s" % value)
+
+def _str_size(value):
+    if value.__class__ is not str:
+        return _value_size(value)
+    length = len(value) if value.isascii() else len(value.encode("utf-8"))
+    if length <= String.MAX_SHORT_LENGTH:
+        return 1 + length
+    elif length <= String.MAX_LENGTH:
+        return 5 + length
+    raise ValueError("String too long")
+
+def _binary_size(value):
+    if value.__class__ is not bytes:
+        return _value_size(value)
+    length = len(value)
+    if length < 256:
+        return 2 + length
+    elif length < 2**32:
+        return 5 + length
+    raise ValueError("value too long")
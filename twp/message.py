@@ -1,10 +1,36 @@
+import contextlib
 from twp import fields
 
+# Extension classes by registered id, filled as they are defined
+registered_extensions = {}
+
+def _get_extension(extensions, cls):
+    for index, extension in enumerate(extensions):
+        if extension.registered_id != cls.registered_id:
+            continue
+        if not isinstance(extension, cls):
+            extension = extensions[index] = extension.materialize(cls)
+        return extension
+    return None
+
 class Message(fields._Complex, metaclass=fields._ComplexType):
+    __slots__ = ("extensions",)
+    # Fields are attributes of messages
+    _attribute_access = True
+
     def __init__(self, *args, **kwargs):
         self.extensions = kwargs.pop("extensions", [])
         super(Message, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def _from_values(cls, values, instance=None):
+        if instance is not None:
+            # Recycled, see MessagePool
+            return super(Message, cls)._from_values(values, instance)
+        instance = super(Message, cls)._from_values(values)
+        instance.extensions = []
+        return instance
+
     def update_values(self, *args, **kwargs):       
         if len(args) > len(self._fields):
             raise ValueError("Too many positional args")
@@ -25,35 +51,235 @@ class Message(fields._Complex, metaclass=fields._ComplexType):
             raise ValueError("Message id cannot be greater than 7.")
         return self.id + 4
 
+    def get_extension(self, cls):
+        """Return the extension of Extension class cls, or None if the message
+        has none. Received extensions are only turned into cls here."""
+        return _get_extension(self.extensions, cls)
+
     def __getattr__(self, name):
-        if name in self._fields:
-            return self._fields[name].value
         raise AttributeError("Message has no attribute named %s" % name)
 
-    def __setattr__(self, name, value):
-        try:
-            self._fields[name].value = value
-        except KeyError:
-            super(Message, self).__setattr__(name, value)
-
     def __repr__(self):
         return "Message %s: %s, Extensions: %s" % (self.__class__.__name__, 
-            dict(self._fields), self.extensions)
+            dict(self._items()), self.extensions)
 
 
 #FIXME
 class Extension(Message):
     tag = 12
+
+    def __init_subclass__(cls, **kwargs):
+        super(Extension, cls).__init_subclass__(**kwargs)
+        if isinstance(cls.__dict__.get("registered_id"), int):
+            existing = registered_extensions.get(cls.registered_id)
+            # A reloaded module defines its classes again
+            if existing is not None and (existing.__module__,
+                    existing.__qualname__) != (cls.__module__, cls.__qualname__):
+                raise ValueError("Registered id %d of %s is taken by %s.%s" % (
+                    cls.registered_id, cls.__name__, existing.__module__,
+                    existing.__qualname__))
+            registered_extensions[cls.registered_id] = cls
     
     def __repr__(self):
-        return "Extension %s: %s" % (self.__class__.__name__, dict(self._fields))
+        return "Extension %s: %s" % (self.__class__.__name__, 
+            dict(self._items()))
 
 class UnknownExtension(Extension):
-    def __init__(self, id, values, raw=None):
+    """An extension as received. If decode is given, values are only decoded 
+    from raw with it when they are first used."""
+    __slots__ = ("registered_id", "_decode", "raw")
+
+    def __init__(self, id, values=None, raw=None, decode=None):
         self.registered_id = id
-        self.values = values
+        self._values = values
+        self._decode = decode
         # Used for forwarding unknown extensions
         self.raw = raw
 
+    @property
+    def values(self):
+        if self._decode is not None:
+            self._values = self._decode(self.raw)
+            self._decode = None
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        self._values = values
+        self._decode = None
+
+    def materialize(self, cls=None):
+        """Return the extension as an instance of cls, by default the 
+        Extension class registered for its id. Returns self if there is 
+        none."""
+        if cls is None:
+            cls = registered_extensions.get(self.registered_id)
+            if cls is None:
+                return self
+        return cls(*self.values)
+
     def __repr__(self):
         return "Extension %d: %s" % (self.registered_id, self.values)
+
+
+class LazyMessage(object):
+    """A received message whose values are only decoded when they are 
+    accessed, see Connection.lazy_messages. raw holds the marshalled message,
+    and offsets the positions of its fields in raw. Unless a field is 
+    assigned, marshalling a LazyMessage sends raw as it was received."""
+    def __init__(self, message_type, raw, offsets, extension_offsets, decode,
+            build_extensions=list):
+        self.message_type = message_type
+        self.id = message_type.id
+        self.raw = raw
+        self.offsets = offsets
+        self.extension_offsets = extension_offsets
+        self._decode = decode
+        self._build_extensions = build_extensions
+        # Holds the decoded fields, created on first access
+        self._message = None
+        self._decoded = set()
+        self._extensions = None
+
+    def __getattr__(self, name):
+        fields = self.message_type._fields
+        if name.startswith("_") or name not in fields:
+            raise AttributeError("Message has no attribute named %s" % name)
+        if self._message is None:
+            self._message = self.message_type()
+        if name not in self._decoded:
+            index = list(fields).index(name)
+            if index < len(self.offsets):
+                setattr(self._message, name, self._decode(self.offsets[index]))
+            self._decoded.add(name)
+        return getattr(self._message, name)
+
+    def __setattr__(self, name, value):
+        message_type = self.__dict__.get("message_type")
+        if message_type is not None and name in message_type._fields:
+            setattr(self.decode(), name, value)
+            # raw no longer matches the message
+            self.raw = None
+        else:
+            super(LazyMessage, self).__setattr__(name, value)
+
+    @property
+    def extensions(self):
+        if self._extensions is None:
+            self._extensions = self._build_extensions([self._decode(offset)
+                for offset in self.extension_offsets])
+        return self._extensions
+
+    def get_extension(self, cls):
+        """See Message.get_extension()."""
+        return _get_extension(self.extensions, cls)
+
+    def decode(self):
+        """Decode all values and return the message as an instance of its 
+        Message class."""
+        for name in self.message_type._fields:
+            getattr(self, name)
+        if self._message is None:
+            self._message = self.message_type()
+        self._message.extensions = self.extensions
+        return self._message
+
+    def __repr__(self):
+        return "LazyMessage %s, %s bytes" % (self.message_type.__name__,
+            "modified" if self.raw is None else len(self.raw))
+
+
+class MessagePool(object):
+    """Keeps released message instances for reuse, so that hot paths do not 
+    allocate and collect one instance per message. Up to maxsize instances 
+    are kept per message class, or sizes[cls] for the classes in sizes; 0 
+    turns pooling off for a class. Sizes are looked up when a class is first
+    pooled. Pooled instances have the default values
+    in all fields, no extensions and no attributes of their own.
+
+    A released message must not be used any more: it is handed out again as
+    a different message."""
+    def __init__(self, maxsize=64, sizes=None):
+        self.maxsize = maxsize
+        self.sizes = dict(sizes or {})
+        # The pooled instances of each class, the counts of hits, misses, 
+        # released and dropped instances, and the size of the pool
+        self._pools = {}
+
+    def _pool(self, cls):
+        try:
+            return self._pools[cls]
+        except KeyError:
+            pool = ([], [0, 0, 0, 0], self.sizes.get(cls, self.maxsize))
+            self._pools[cls] = pool
+            return pool
+
+    def acquire(self, cls):
+        """Returns a pooled instance of cls, or None if there is none."""
+        free, counts, size = self._pool(cls)
+        if free:
+            counts[0] += 1
+            return free.pop()
+        counts[1] += 1
+        return None
+
+    def new(self, cls, *args, **kwargs):
+        """Like cls(*args, **kwargs), but reuses a pooled instance if there 
+        is one."""
+        message = self.acquire(cls)
+        if message is None:
+            return cls(*args, **kwargs)
+        extensions = kwargs.pop("extensions", None)
+        message.update_values(*args, **kwargs)
+        if extensions is not None:
+            message.extensions = extensions
+        return message
+
+    def release(self, message):
+        """Reset message and keep it for reuse, unless the pool of its class 
+        is full."""
+        cls = message.__class__
+        free, counts, size = self._pool(cls)
+        if message in free:
+            raise ValueError("%s has already been released" % cls.__name__)
+        if len(free) >= size:
+            counts[3] += 1
+            return
+        message._values[:] = cls._defaults
+        if message.extensions:
+            message.extensions = []
+        if getattr(message, "__dict__", None):
+            # Attributes of its own, see twp.fields._ComplexType
+            message.__dict__.clear()
+        free.append(message)
+        counts[2] += 1
+
+    @contextlib.contextmanager
+    def lease(self, message):
+        """Release message at the end of a with block."""
+        try:
+            yield message
+        finally:
+            self.release(message)
+
+    def stats(self):
+        """Returns the counts of reused (hits) and newly created (misses) 
+        instances, released and dropped ones, the pooled instances and the 
+        reuse rate, per message class."""
+        stats = {}
+        for cls, (free, counts, size) in self._pools.items():
+            hits, misses, released, dropped = counts
+            lookups = hits + misses
+            stats[cls] = {
+                "hits": hits,
+                "misses": misses,
+                "released": released,
+                "dropped": dropped,
+                "pooled": len(free),
+                "reuse_rate": hits / lookups if lookups else 0.0,
+            }
+        return stats
+
+    def __repr__(self):
+        return "MessagePool %s" % dict([(cls.__name__, counts) 
+            for cls, counts in self.stats().items()])
@@ -1,249 +1,350 @@
-import sys
+import argparse
+import hashlib
+import io
+import os
+import pickle
 import re
-from lepl import *
-from twp import log
-
-class Protocol(Node): pass
-class MessageDef(Node): pass
-class StructDef(Node): pass
-
-class ProtocolElement(Node): pass
-class TypeDef(ProtocolElement): pass
-class MessageDef(ProtocolElement): pass
-
-class StructDef(TypeDef): pass
-class SequenceDef(TypeDef): pass
-class CaseDef(TypeDef): pass
-class UnionDef(TypeDef): pass
-class ForwardDef(TypeDef): pass
-
-class Field(Node): pass
-
-letter = Letter() | Literal("_")
-identifier = Word(letter, letter | Digit()) > "identifier"
-number = Integer() >> int
-colon = Drop(":")
-semicolon = Drop(";")
-lt = Drop("<")
-gt = Drop(">")
-lbr = Drop("{")
-rbr = Drop("}")
-eq = Drop("=")
-id = Literal("ID")
-
-primitiveType = Or("int", "string", "binary", "any") > "primitive"
-
-with TraceVariables():
-	with Separator(~Whitespace()[1:]):
-		anyDefinedBy = Add(Literal("any") & "defined" & "by")
-		anyDefinedByType = anyDefinedBy & identifier
-
-	with Separator(~Whitespace()[:]):
-		type = Or(primitiveType, identifier, anyDefinedByType) > "type"
-		idPair = ~id & number > "extension_id"
-
-		field = Optional("optional") & type & identifier & semicolon > Field
-		structdef = Drop("struct") & identifier & Optional(eq & idPair) & lbr & field[1:] & rbr > StructDef
-		sequencedef = "sequence" & lt & type & gt & identifier & semicolon > SequenceDef
-		casedef = Drop("case") & number & colon & type & identifier & semicolon > CaseDef
-		uniondef = Drop("union") & identifier & lbr & casedef[1:] & rbr > UnionDef
-		forwarddef = Drop("typedef") & identifier & semicolon > ForwardDef
-		messageId = Regexp(r"[0-7]") >> int
-		messagedef = "message" & identifier & eq & Or(messageId > "id", idPair) & lbr & field[:] & rbr > MessageDef
-
-		typedef = Or(structdef, sequencedef, uniondef, forwarddef) > TypeDef
-		protocolelement = Or(typedef, messagedef) > ProtocolElement
-
-		protocol =  Drop("protocol") & identifier & eq & ~id & (number > "id") & lbr & protocolelement[:] & rbr > Protocol
-		specification = Or(protocol, messagedef, structdef)[:] & Eos()
-
-
-class StubGenerator(object):
-	def __init__(self, ast, output_stream=sys.stdout):
-		self.ast = ast
-		self.output_stream = output_stream
-
-		self.indent_level = 0 
-		self.indent_step = 4
-		self.indent_char = " "
-		self.protocols = {}
-
-	def write(self, str):
-		self.output_stream.write(str)
-
-	def writeln(self, str):
-		if len(str):
-			str = self._indent_str() + str
-		self.write(str + "\n")
-
-	def start_class(self, name, bases="object"):
-		self.writeln("")
-		if not isinstance(bases, str):
-			bases = ", ".join(bases)
-		self.writeln("class %s(%s):" % (name, bases))
-
-	def _indent_str(self):
-		return self.indent_char * self.indent_level
-
-	def indent(self):
-		self.indent_level += self.indent_step
-	
-	def dedent(self):
-		self.indent_level -= self.indent_step
-		if self.indent_level < 0:
-			self.indent_level = 0
-			raise ValueError("Indent level below 0")
-
-	def generate(self):
-		self.writeln("import twp")
-		for node in self.ast:
-			self._generate_node(node)
-	
-	def _generate_node(self, node):
-		node_type = node.__class__.__name__.lower()
-		func = getattr(self, "generate_" + node_type)
-		return func(node)
-
-	def generate_protocol(self, node):
-		# Collect all message names
-		message_identifiers = []
-		for protocol_element in getattr(node, "ProtocolElement", []):
-			if hasattr(protocol_element, "TypeDef"):
-				typedef = protocol_element[0]
-				self._generate_node(typedef[0])
+import sys
+import tempfile
+from concurrent import futures
+from twp import codegen, log
+
+# Identifier-like terminal symbols of the grammar, which cannot be used as
+# identifiers (SPEC.txt, section 4.1)
+KEYWORDS = frozenset(["protocol", "ID", "message", "struct", "sequence",
+	"union", "case", "typedef", "optional", "int", "string", "binary", "any",
+	"defined", "by"])
+
+PRIMITIVE_TYPES = frozenset(["int", "string", "binary", "any"])
+
+# Part of the key of cached specifications. Change it whenever the parser or
+# the definitions it returns change, so that older pickles are not used.
+CACHE_VERSION = 1
+
+_TOKENS = re.compile(r"""
+	(?P<space>\s+)
+	| (?P<comment>//[^\n]*|/\*.*?\*/)
+	| (?P<name>[A-Za-z_][A-Za-z_0-9]*)
+	| (?P<number>[0-9]+)
+	| (?P<punctuation>[{}<>=;:])
+""", re.VERBOSE | re.DOTALL)
+
+
+class ParseError(ValueError):
+	"""A syntax error in a TDL specification."""
+	pass
+
+
+def tokenize(text, filename="<string>"):
+	"""Returns the tokens of text as (kind, value, line, column) tuples. The
+	kind of keywords and punctuation is the token itself, others are
+	identifier or number. The last token is of kind end."""
+	tokens = []
+	line, line_start = 1, 0
+	pos, end = 0, len(text)
+	match = _TOKENS.match
+	while pos < end:
+		m = match(text, pos)
+		if m is None:
+			if text.startswith("/*", pos):
+				problem = "unterminated comment"
 			else:
-				msg = protocol_element[0]
-				message_identifiers.append(msg.identifier[0])
-				self._generate_node(msg)
-		
-		self.start_class(node.identifier[0], "twp.protocol.Protocol")
-		self.indent()
-		self.writeln("protocol_id = %d" % node.id[0])
-		self.writeln("message_types = [")
-		self.indent()
-		for msg in message_identifiers:
-			self.writeln("%s," % msg)
-		self.dedent()
-		self.writeln("]")
-		self.dedent()
-
-	def generate_messagedef(self, node):
-		self.start_class(node.identifier[0], "twp.values.Message")
-		self.indent()
-		if hasattr(node, "id"):
-			self.writeln("id = %d" % node.id[0])
-		elif hasattr(node, "extension_id"):
-			self.writeln("extension_id = %d" % node.id[0])
-		for field in getattr(node, "Field", []):
-			self.generate_field(field)
-		self.dedent()
-
-	def generate_field(self, node):
-		optional = node[0] == "optional"
-		optional_str = "optional=True" if optional else ""
-		type = node.type[0]
-		name = node.identifier[0]
-		field = None
-		if type == "anydefinedby":
-			field = 'twp.values.AnyDefinedBy("%s"' % (node.type[1][1])
-			if optional:
-				field += ", " + optional_str
-			field += ")"
-		elif type[0] == "identifier":
-			field = "%s()" % cap_and_camelcase(type[1])
-		else: #type[0] == "primitive"
-			# Primitiive
-			field = "twp.values.%s(%s)" % (type[1].capitalize(), optional_str)
-		self.writeln('%s = %s' % (name, field))
-
-	def generate_structdef(self, node):
-		name = cap_and_camelcase(node.identifier[0])
-		self.start_class(name, "twp.values.Struct")
-		self.indent()
-		if hasattr(node, "extension_id"):
-			self.writeln("extension_id = %s" % node.extension_id[0])
-		for field in node.Field:
-			self.generate_field(field)
-		self.dedent()
-
-	def generate_sequencedef(self, node):
-		name = cap_and_camelcase(node.identifier[0])
-		self.start_class(name, "twp.values.Sequence")
-		self.indent()
-		type = node.type[0] # (<specification>, <name>)
-		if type[0] == "primitive":
-			type = "twp.values.%s()" % type[1].capitalize()
-		elif type[0] == "identifier":
-			type = "%s()" % cap_and_camelcase(type[1])
-		else: #type[0] == "anydefinedby"
-			type = "twp.values.AnyDefinedBy(%s)" % type[1]
-		self.writeln("type = %s" % type)
-		self.dedent()
-
-	def generate_uniondef(self, node):
-		name = cap_and_camelcase(node.identifier[0])
-		self.start_class(name, "twp.values.Union")
-		self.indent()
-		self.writeln("cases = {")
-		self.indent()
-		for casedef in node.CaseDef:
-			caseno = casedef[0]
-			line = "%d: " % caseno
-			#name = casedef.identifier[0]
-			type = casedef.type[0]
-			if type == "anydefinedby":
-				line += 'twp.values.AnyDefinedBy("%s")' % (node.type[1][1])
-			elif type[0] == "identifier":
-				line += "%s()" % cap_and_camelcase(type[1])
-			else: #type[0] == "primitive"
-				# Primitiive
-				line += "twp.values.%s(%s)" % (type[1].capitalize(), optional_str)
-			self.writeln("%s," % line)
-		self.dedent()
-		self.writeln("}")
-		self.dedent()
-
-	def generate_forwarddef(self, node):
-		print("ForwardDef:\n%s" % node)
-
-
-def cap_and_camelcase(value):
-	# see http://stackoverflow.com/questions/4303492/how-can-i-simplify-this-conversion-from-underscore-to-camelcase-in-python
-    def camelcase(): 
-        yield str
-        while True:
-            yield str.capitalize
-
-    value = value.capitalize()
-    c = camelcase()
-    return "".join(next(c)(x) if x else '_' for x in value.split("_"))
-
-def strip_comments(input):
-	comments = r"\/\*.*\*\/"
-	input = re.sub(comments, "", input)
-	return input
+				problem = "unexpected character %r" % text[pos]
+			raise ParseError("%s:%d:%d: %s" % (filename, line,
+				pos - line_start + 1, problem))
+		kind = m.lastgroup
+		value = m.group()
+		if kind == "name":
+			tokens.append((value if value in KEYWORDS else "identifier", value,
+				line, pos - line_start + 1))
+		elif kind == "number":
+			tokens.append(("number", value, line, pos - line_start + 1))
+		elif kind == "punctuation":
+			tokens.append((value, value, line, pos - line_start + 1))
+		else:
+			newlines = value.count("\n")
+			if newlines:
+				line += newlines
+				line_start = pos + value.rindex("\n") + 1
+		pos = m.end()
+	tokens.append(("end", "", line, pos - line_start + 1))
+	return tokens
+
+
+class Parser(object):
+	"""Recursive descent parser for the TDL grammar of SPEC.txt, section 4.
+	parse() returns the specification as a list of twp.codegen
+	definitions."""
+	def __init__(self, text, filename="<string>"):
+		self.filename = filename
+		self.tokens = tokenize(text, filename)
+		self.pos = 0
+
+	def peek(self, offset=0):
+		return self.tokens[self.pos + offset][0]
+
+	def expect(self, kind, description=None):
+		token = self.tokens[self.pos]
+		if token[0] != kind:
+			raise self.error(description or repr(kind))
+		self.pos += 1
+		return token[1]
+
+	def accept(self, kind):
+		if self.tokens[self.pos][0] == kind:
+			self.pos += 1
+			return True
+		return False
+
+	def error(self, expected):
+		kind, value, line, column = self.tokens[self.pos]
+		found = "end of input" if kind == "end" else repr(value)
+		return ParseError("%s:%d:%d: expected %s but found %s" % (
+			self.filename, line, column, expected, found))
+
+	def identifier(self):
+		return self.expect("identifier", "an identifier")
+
+	def number(self):
+		return int(self.expect("number", "a number"))
+
+	def registered_id(self):
+		self.expect("ID")
+		return self.number()
+
+	def parse(self):
+		definitions = []
+		while self.peek() != "end":
+			kind = self.peek()
+			if kind == "protocol":
+				definitions.append(self.protocol())
+			elif kind == "message":
+				definitions.append(self.messagedef())
+			elif kind == "struct":
+				definition = self.structdef()
+				if definition.registered_id is None:
+					raise ParseError("%s: top-level struct %s needs an ID"
+						% (self.filename, definition.name))
+				definitions.append(definition)
+			else:
+				raise self.error("protocol, message or struct")
+		return definitions
+
+	def protocol(self):
+		self.expect("protocol")
+		name = self.identifier()
+		self.expect("=")
+		id = self.registered_id()
+		self.expect("{")
+		elements = []
+		while not self.accept("}"):
+			elements.append(self.protocolelement())
+		return codegen.Protocol(name, id, elements)
+
+	def protocolelement(self):
+		kind = self.peek()
+		if kind == "message":
+			return self.messagedef()
+		elif kind == "struct":
+			return self.structdef()
+		elif kind == "sequence":
+			return self.sequencedef()
+		elif kind == "union":
+			return self.uniondef()
+		elif kind == "typedef":
+			return self.forwarddef()
+		raise self.error("a type definition, message or '}'")
+
+	def type(self):
+		kind = self.peek()
+		if kind == "any" and self.peek(1) == "defined":
+			self.pos += 2
+			self.expect("by")
+			return codegen.Type("any defined by", self.identifier())
+		elif kind in PRIMITIVE_TYPES:
+			self.pos += 1
+			return codegen.Type("primitive", kind)
+		return codegen.Type("identifier", self.expect("identifier", "a type"))
+
+	def field(self):
+		optional = self.accept("optional")
+		type = self.type()
+		name = self.identifier()
+		self.expect(";")
+		return codegen.Field(type, name, optional)
+
+	def structdef(self):
+		self.expect("struct")
+		name = self.identifier()
+		registered_id = None
+		if self.accept("="):
+			registered_id = self.registered_id()
+		self.expect("{")
+		fields = [self.field()]
+		while not self.accept("}"):
+			fields.append(self.field())
+		return codegen.StructDef(name, registered_id, fields)
+
+	def sequencedef(self):
+		self.expect("sequence")
+		self.expect("<")
+		type = self.type()
+		self.expect(">")
+		name = self.identifier()
+		self.expect(";")
+		return codegen.SequenceDef(name, type)
+
+	def uniondef(self):
+		self.expect("union")
+		name = self.identifier()
+		self.expect("{")
+		cases = [self.casedef()]
+		while not self.accept("}"):
+			cases.append(self.casedef())
+		return codegen.UnionDef(name, cases)
+
+	def casedef(self):
+		self.expect("case", "'case' or '}'")
+		number = self.number()
+		self.expect(":")
+		type = self.type()
+		name = self.identifier()
+		self.expect(";")
+		return codegen.CaseDef(number, type, name)
+
+	def forwarddef(self):
+		self.expect("typedef")
+		name = self.identifier()
+		self.expect(";")
+		return codegen.ForwardDef(name)
+
+	def messagedef(self):
+		self.expect("message")
+		name = self.identifier()
+		self.expect("=")
+		id = registered_id = None
+		if self.peek() == "ID":
+			registered_id = self.registered_id()
+		else:
+			token = self.tokens[self.pos]
+			if token[0] != "number" or len(token[1]) != 1 or token[1] > "7":
+				raise self.error("a message number 0-7 or ID")
+			id = self.number()
+		self.expect("{")
+		fields = []
+		while not self.accept("}"):
+			fields.append(self.field())
+		return codegen.MessageDef(name, id, registered_id, fields)
+
+
+def parse(text, filename="<string>"):
+	"""Returns the specification in text as a list of twp.codegen
+	definitions. Raises a ParseError for syntax errors."""
+	return Parser(text, filename).parse()
+
+def parse_file(path, cache_dir=None):
+	"""Parse the specification in the file at path. With cache_dir, parsed
+	specifications are kept there, named by the hash of the file contents,
+	and loaded from there instead of being parsed again."""
+	with open(path, "rb") as f:
+		data = f.read()
+	if cache_dir is None:
+		return parse(data.decode("utf-8"), path)
+	key = hashlib.sha256(b"%d:" % CACHE_VERSION + data).hexdigest()
+	cached = os.path.join(cache_dir, key + ".pickle")
+	try:
+		with open(cached, "rb") as f:
+			return pickle.load(f)
+	except FileNotFoundError:
+		pass
+	except (pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+			IndexError, KeyError, TypeError, ValueError) as e:
+		# Parsed again and written over below
+		log.warn("Ignoring broken cache file %s: %s" % (cached, e))
+	definitions = parse(data.decode("utf-8"), path)
+	os.makedirs(cache_dir, exist_ok=True)
+	# Other processes may be compiling the same file
+	fd, temporary = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			pickle.dump(definitions, f, pickle.HIGHEST_PROTOCOL)
+		os.replace(temporary, cached)
+	except BaseException:
+		os.unlink(temporary)
+		raise
+	return definitions
+
+def compile_file(path, output=None, application_types=None, cache_dir=None):
+	"""Generate the module of the specification at path into the file
+	output, or return it if output is None. See twp.codegen.Generator."""
+	log.debug("Compiling %s" % path)
+	specification = parse_file(path, cache_dir)
+	module = io.StringIO()
+	codegen.Generator(specification, module, application_types).generate()
+	if output is None:
+		return module.getvalue()
+	with open(output, "w") as f:
+		f.write(module.getvalue())
+
+def compile_files(paths, output_dir, application_types=None, cache_dir=None,
+		jobs=1):
+	"""Compile each of the specifications at paths into a module named like
+	it in output_dir, in up to jobs processes, or one per CPU if jobs is
+	None. Returns the paths of the modules."""
+	outputs = [os.path.join(output_dir,
+		os.path.splitext(os.path.basename(path))[0] + ".py") for path in paths]
+	if len(set(outputs)) != len(outputs):
+		raise ValueError("Specifications with the same name would overwrite "
+			"each other's module")
+	if jobs == 1 or len(paths) < 2:
+		for path, output in zip(paths, outputs):
+			compile_file(path, output, application_types, cache_dir)
+		return outputs
+	with futures.ProcessPoolExecutor(jobs) as executor:
+		tasks = [executor.submit(compile_file, path, output,
+			application_types, cache_dir)
+			for path, output in zip(paths, outputs)]
+		for task in tasks:
+			task.result()
+	return outputs
+
+def main(argv=None):
+	options = argparse.ArgumentParser(prog="twp-parser",
+		description="Generate the classes, encoders and decoders of TDL "
+		"specifications.")
+	options.add_argument("inputs", nargs="+", metavar="input",
+		help="a specification, followed by the module to write it to unless "
+		"-d is given")
+	options.add_argument("-d", "--output-dir",
+		help="compile all inputs into modules named like them in this "
+		"directory")
+	options.add_argument("-a", "--application-type", action="append",
+		default=[], metavar="IDENTIFIER=CLASS",
+		help="the class of an application type, "
+		"e.g. double=twp.protocols.tcp.Double")
+	options.add_argument("-c", "--cache-dir",
+		help="keep parsed specifications in this directory")
+	options.add_argument("-j", "--jobs", type=int, default=1,
+		help="number of processes to compile in, 0 for one per CPU")
+	args = options.parse_args(argv)
+	application_types = dict(
+		[value.partition("=")[::2] for value in args.application_type])
+	try:
+		if args.output_dir is not None:
+			compile_files(args.inputs, args.output_dir, application_types,
+				args.cache_dir, args.jobs or None)
+		elif len(args.inputs) > 2:
+			options.error("several inputs need -d")
+		elif len(args.inputs) == 2:
+			compile_file(args.inputs[0], args.inputs[1], application_types,
+				args.cache_dir)
+		else:
+			sys.stdout.write(compile_file(args.inputs[0], None,
+				application_types, args.cache_dir))
+	except (OSError, ValueError) as e:
+		print("twp-parser: %s" % e, file=sys.stderr)
+		return 1
+	return 0
 
 if __name__ == '__main__':
-	if len(sys.argv) == 3:
-		output = sys.argv[2]
-	elif len(sys.argv) == 2:
-		output = sys.stdout
-	else:
-		print("Usage: twp-parser <input> [<output>]")
-		exit(1)
-	try:
-		input = open(sys.argv[1])
-		if isinstance(output, str):
-			output = open(output, "w")
-		log.debug("Reading input file...")
-		idl = input.read()
-		log.debug("Parsing input...")
-		idl = strip_comments(idl)
-		ast = specification.parse(idl)
-		log.debug("Generating stub...")
-		gen = StubGenerator(ast, output)
-		gen.generate()
-	finally:
-		input.close()
-		if output != sys.stdout:
-			output.close()
+	exit(main())
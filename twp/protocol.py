@@ -1,14 +1,40 @@
+import os
 import socket
 import asyncore
-from twp import fields, log, marshalling, reader
+import collections
+from twp import compression, fields, log, marshalling, reader
+from twp.message import Message, Extension, LazyMessage
+from twp.message import MessagePool
 from twp.error import TWPError
 
 BUFSIZE = 1024
 TWP_MAGIC = b"TWP3\n"
+# Maximum number of buffers to pass to a single sendmsg() call
+try:
+	IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+	IOV_MAX = 1024
+
+def _dispatcher_recv_into(dispatcher, buffer, nbytes=0):
+	"""recv_into() for asyncore dispatchers. Like dispatcher.recv(), it handles
+	a closed connection by calling handle_close() and returning 0."""
+	try:
+		received = dispatcher.socket.recv_into(buffer, nbytes)
+	except OSError as e:
+		if e.errno not in asyncore._DISCONNECTED:
+			raise
+		received = 0
+	if not received:
+		dispatcher.handle_close()
+	return received
+
 
 class Protocol(object):
 	message_types = []
 	extension_types = []
+	# A twp.message.MessagePool that received messages are taken from, see 
+	# release_message()
+	message_pool = None
 	def init_connection(self, connection):
 		# FIXME delete?
 		self.connection = connection
@@ -22,34 +48,71 @@ class Protocol(object):
 			)
 		return self._message_tags
 
+	@property
+	def message_ids(self):
+		"""Returns a dict mapping ids to subclasses of `Message`."""
+		if not hasattr(self, "_message_ids"):
+			self._message_ids = dict(
+				((msg.id, msg) for msg in self.message_types)
+			)
+		return self._message_ids
+
+	@property
+	def extension_ids(self):
+		"""Returns a dict mapping registered ids to subclasses of `Extension`."""
+		if not hasattr(self, "_extension_ids"):
+			self._extension_ids = dict(
+				((ext.registered_id, ext) for ext in self.extension_types)
+			)
+		return self._extension_ids
+
 	@property
 	def message_types(self):
 		"""Implement to return a list of supported types for the protocol."""
 		raise NotImplementedError
 
+	def define_any_defined_by(self, field, reference_value):
+		"""Implement to return the field definition of the value of the 
+		AnyDefinedBy field `field`, given the value of the field it refers to.
+		Values without a definition are decoded as they are."""
+		return None
+
 	def build_extensions(self, extensions):
-		ext_out = []
-		for ext in extensions:
-			extension_cls = None
-			for cls in self.extension_types:
-				if cls.registered_id == ext.registered_id:
-					extension_cls = cls
-					break
-			if extension_cls:
-				ext = extension_cls(*ext.values)
-			ext_out.append(ext)
-		return ext_out
+		"""Hook for the received extensions of a message. They are kept as 
+		UnknownExtensions, which Message.get_extension() turns into their 
+		classes when a handler asks for them."""
+		return extensions
 
 	def build_message(self, id, values, extensions, raw):
-		for cls in self.message_types:
-			if cls.id == id:
-				msg_type = cls
-				break
+		msg_type = self.message_ids.get(id)
 		if not msg_type:
-			raise TWPError("Message not understood: %d" % tag)
+			raise TWPError("Message not understood: %d" % id)
+		if self.message_pool is not None:
+			return self.message_pool.new(msg_type, *values, 
+				extensions=extensions)
 		msg = msg_type(*values, extensions=extensions)
 		return msg
 
+	def new_message(self, cls, *args, **kwargs):
+		"""Like cls(*args, **kwargs), taking the instance from message_pool if
+		there is one."""
+		if self.message_pool is not None:
+			return self.message_pool.new(cls, *args, **kwargs)
+		return cls(*args, **kwargs)
+
+	def release_message(self, message):
+		"""Return a handled message to message_pool, if there is one. The 
+		message must not be used afterwards."""
+		if self.message_pool is not None and isinstance(message, Message):
+			self.message_pool.release(message)
+
+	def build_lazy_message(self, id, raw, offsets, extension_offsets, decode):
+		msg_type = self.message_ids.get(id)
+		if not msg_type:
+			raise TWPError("Message not understood: %d" % id)
+		return LazyMessage(msg_type, raw, offsets, extension_offsets, decode,
+			self.build_extensions)
+
 	def read_application_type(self, tag):
 		"""Hook for implementing application types in Protocols."""
 		raise NotImplementedError()
@@ -57,28 +120,115 @@ class Protocol(object):
 
 class Connection(object):
 	reader_class = reader.TWPReader
+	# Set to compress sent messages of at least this many bytes, if the peer
+	# agrees. See twp.compression.
+	compression_threshold = None
+	compression_level = 6
+	# Set to receive large Binary and String values without copying them, 
+	# see twp.reader.TWPReader. Call reader.release() when done with them.
+	zero_copy = False
+	# Set to receive twp.message.LazyMessage instances, which only decode the
+	# fields that are used, and are sent on as they were received.
+	lazy_messages = False
+	# Limit the size of received messages, and spool Binary and String values
+	# of at least spool_threshold bytes to files, see twp.reader.TWPReader. 
+	# Messages are neither lazy nor typed while spooling.
+	max_message_size = None
+	spool_threshold = None
+	# Decode received messages straight into their Message classes, checking 
+	# the values against the field definitions. Unset to decode the values 
+	# first and build the message from them.
+	typed_messages = True
+	# Set to share repeated strings, and sequences of them, among received 
+	# values, keeping up to this many in the reader's intern table.
+	intern_strings = None
+	# Set to "array" or "numpy" to receive sequences of only integers or only
+	# floats as arrays, see twp.reader.TWPReader. "numpy" needs numpy.
+	homogeneous_sequences = None
+	# Set to reuse up to this many received instances per message class. 
+	# Handlers hand messages back with protocol.release_message().
+	message_pool_size = None
 	def __init__(self):
 		self.init_protocol()
 		self.init_reader()
 		self.buffer = b""
+		self.compress = False
+		self._compression_offered = False
 
 	def init_protocol(self):
 		self.protocol = self.protocol_class()
 		self.protocol.init_connection(self)
+		if self.message_pool_size:
+			self.protocol.message_pool = MessagePool(self.message_pool_size)
 
 	def init_reader(self):
 		"""Initialize an instance of twp.reader.TWPReader to use with this
 		session."""
-		self.reader = self.reader_class(self)
+		self.reader = self.reader_class(self, zero_copy=self.zero_copy, 
+			max_message_size=self.max_message_size, 
+			spool_threshold=self.spool_threshold, 
+			intern_strings=self.intern_strings,
+			homogeneous_sequences=self.homogeneous_sequences)
+
+	def recv_into(self, buffer, nbytes=0):
+		"""Receive up to nbytes into buffer, like socket.recv_into(). This 
+		default copies what recv() returns."""
+		data = self.recv(nbytes or len(buffer))
+		buffer[:len(data)] = data
+		return len(data)
 
 	def send_twp(self, twp_value):
 		"""Send pretty much anything that can be marshalled."""
 		log.debug("Sending TWP value %s" % twp_value)
-		data = marshalling.marshal(twp_value)
+		buffers = self._marshal_buffers(twp_value)
+		self.send_buffers(buffers)
+		log.debug("Sent data %s" % buffers)
+
+	def _marshal_buffers(self, twp_value):
+		buffers = marshalling.marshal_buffers(twp_value)
+		if (self.compress and isinstance(twp_value, (Message, LazyMessage)) and 
+				not isinstance(twp_value, Extension)):
+			size = sum([len(buffer) for buffer in buffers])
+			# Compressing file regions would read them into memory
+			if (size >= self.compression_threshold and not any([isinstance(
+					buffer, fields.FileRegion) for buffer in buffers])):
+				data = b"".join(buffers)
+				wrapped = compression.compress(data, self.compression_level)
+				buffers = marshalling.marshal_buffers(wrapped)
+		return buffers
+
+	def send_buffers(self, buffers):
+		"""Send a list of buffers. Override to use vectored writes, or to send 
+		file regions without reading them."""
+		self.send(marshalling.join_buffers(buffers))
+
+	def send_twp_stream(self, twp_value, chunk_size=65536):
+		"""Send a value while marshalling it, see 
+		twp.marshalling.marshal_stream. Use this to send sequences from 
+		generators."""
+		log.debug("Streaming TWP value %s" % twp_value)
+		marshalling.marshal_stream(twp_value, self.send, chunk_size)
+
+	def send_many(self, message_class, rows):
+		"""Send one message of message_class per row of field values, see 
+		twp.marshalling.marshal_many."""
+		data = marshalling.marshal_many(message_class, rows)
 		self.send(data)
-		log.debug("Sent data %s" % data)
 
 	def read_message(self):
+		while self.reader.peek_tag() == Extension.tag:
+			self.read_extension_message()
+		# Spooled values are dropped from the buffer while they are received,
+		# only the reader's resumable decoder keeps track of them.
+		spooling = self.spool_threshold is not None
+		if self.lazy_messages and not spooling:
+			scanned = self.reader.scan_message()
+			if scanned is not None:
+				return self._build_lazy_message(*scanned)
+		if self.typed_messages and not spooling:
+			message = self.reader.read_typed_message()
+			self.reader.flush()
+			return message
 		id, values, extensions = self.reader.read_message()
 		raw = self.reader.processed_bytes
 		self.reader.flush()
@@ -86,6 +236,45 @@ class Connection(object):
 		message = self.protocol.build_message(id, values, extensions, raw)
 		return message
 
+	def _build_lazy_message(self, id, offsets, extension_offsets):
+		raw = self.reader.processed_view()
+		self.reader.flush()
+		decode = self.reader.value_decoder(raw)
+		return self.protocol.build_lazy_message(id, raw, offsets, 
+			extension_offsets, decode)
+
+	def read_extension_message(self):
+		"""Read and handle an extension message sent in place of a message."""
+		extension = self.reader.read_extension()
+		if extension.registered_id == compression.Compressed.registered_id:
+			# Continue reading the wrapped message in its place
+			self.reader.replace_processed(compression.decompress(extension,
+				self.max_message_size))
+			return
+		self.reader.flush()
+		if extension.registered_id == compression.Compression.registered_id:
+			self.on_compression(extension.values[0])
+		else:
+			raise TWPError("Extension message not understood: %d" 
+				% extension.registered_id)
+
+	def offer_compression(self):
+		"""Offer to compress messages. Compression is used once the peer has 
+		answered with the same algorithm."""
+		self._compression_offered = True
+		self.send_twp(compression.Compression(compression.ZLIB))
+
+	def on_compression(self, algorithm):
+		"""Handle the peer's compression offer, or its answer to ours."""
+		supported = (algorithm == compression.ZLIB and 
+			self.compression_threshold is not None)
+		if not self._compression_offered:
+			answer = compression.ZLIB if supported else ""
+			self.send_twp(compression.Compression(answer))
+		self._compression_offered = False
+		self.compress = supported
+		log.debug("Compression %s" % ("enabled" if supported else "declined"))
+
 
 class TWPClient(Connection):
 	def __init__(self, host='localhost', port=5000):
@@ -98,6 +287,9 @@ class TWPClient(Connection):
 		# Reader wants Connection to quack like a socket
 		return self.socket.recv(*args, **kwargs)
 
+	def recv_into(self, *args, **kwargs):
+		return self.socket.recv_into(*args, **kwargs)
+
 	def create_socket(self, family, type):
 		sock = socket.socket(family, type)
 		sock.setblocking(1)
@@ -109,11 +301,46 @@ class TWPClient(Connection):
 	def _init_session(self):
 		protocol_id = marshalling.marshal_int(self.protocol.protocol_id)
 		self.send(TWP_MAGIC + protocol_id)
+		if self.compression_threshold is not None:
+			# Answered in read_message. A peer that does not support 
+			# compression may never answer, so do not wait for it.
+			self.offer_compression()
 
 	def send(self, data):
 		data = bytes(data)
 		self.socket.sendall(data)
 
+	def send_buffers(self, buffers):
+		"""Send a list of buffers with as few sendmsg() calls as possible, so 
+		they do not have to be joined first. File regions are sent with 
+		sendfile()."""
+		start = 0
+		for i, buffer in enumerate(buffers):
+			if isinstance(buffer, fields.FileRegion):
+				self._send_buffers(buffers[start:i])
+				# The fallback for files without sendfile() reads from the 
+				# current position if offset is 0
+				buffer.file.seek(buffer.offset)
+				sent = self.socket.sendfile(buffer.file, buffer.offset, 
+					buffer.length)
+				if sent != buffer.length:
+					raise TWPError("File is shorter than the region %s" % buffer)
+				start = i + 1
+		self._send_buffers(buffers[start:])
+
+	def _send_buffers(self, buffers):
+		if not hasattr(self.socket, "sendmsg"):
+			return self.send(b"".join(buffers))
+		i = 0
+		while i < len(buffers):
+			sent = self.socket.sendmsg(buffers[i:i + IOV_MAX])
+			# Skip what has been sent, the kernel may have taken less.
+			while i < len(buffers) and sent >= len(buffers[i]):
+				sent -= len(buffers[i])
+				i += 1
+			if sent:
+				buffers[i] = memoryview(buffers[i])[sent:]
+
 	def read_message(self):
 		# Blocking socket, just keep trying
 		while True:
@@ -139,30 +366,44 @@ class TWPClientAsync(asyncore.dispatcher_with_send, Connection):
 		protocol_id = marshalling.marshal_int(self.protocol.protocol_id)
 		self.out_buffer += TWP_MAGIC
 		self.out_buffer += protocol_id
+		if self.compression_threshold is not None:
+			# Answered in read_message
+			self.offer_compression()
+
+	def recv_into(self, buffer, nbytes=0):
+		return _dispatcher_recv_into(self, buffer, nbytes)
 
 	# TODO TCP needs to know about closes as well...
 	def handle_read(self):
 		try:
-			initial_pos = self.reader.pos
-			msg = self.read_message()
-			if self.message_handler_func:
-				self.message_handler_func(msg, self)
-		except ValueError:
-			# Rewind
-			self.reader.pos = initial_pos
+			while True:
+				msg = self.read_message()
+				if self.message_handler_func:
+					self.message_handler_func(msg, self)
+				if not self.connected or not self.reader.remaining_byte_length:
+					break
+				# We did not process all the bytes, read again
+		except reader.NotEnoughBytes:
+			# The reader continues where it stopped on the next read event
+			pass
 
 	def send_twp(self, twp_value):
 		"""Send pretty much anything that can be marshalled."""
 		log.debug("Sending TWP value %s" % twp_value)
-		data = marshalling.marshal(twp_value)
+		data = marshalling.join_buffers(self._marshal_buffers(twp_value))
 		# bug in asyncore? When we .send() while handling another receive, this 
 		# client sometimes does not end up in the write queue.
 		# Work around: don't send right away, just buffer
 		self.out_buffer += data
 		log.debug("Sent data %s" % data)
 
+	def send_many(self, message_class, rows):
+		self.out_buffer += marshalling.marshal_many(message_class, rows)
+
 
 class TWPConsumer(asyncore.dispatcher_with_send, Connection):
+	# Number of bytes of a file region to send per sendfile() call
+	sendfile_chunk_size = 65536
 	def __init__(self, sock, addr):
 		asyncore.dispatcher_with_send.__init__(self, sock)
 		Connection.__init__(self)
@@ -170,23 +411,85 @@ class TWPConsumer(asyncore.dispatcher_with_send, Connection):
 		log.debug("Connect from %s %s" % self._addr)
 		self.has_read_magic = False
 		self.has_read_protocol_id = False
+		# What to send after out_buffer: file regions as [region, sent], and 
+		# the data queued behind them
+		self._send_queue = collections.deque()
+
+	def recv_into(self, buffer, nbytes=0):
+		return _dispatcher_recv_into(self, buffer, nbytes)
+
+	def send(self, data):
+		if self._send_queue:
+			self._send_queue.append(data)
+		else:
+			asyncore.dispatcher_with_send.send(self, data)
+
+	def send_buffers(self, buffers):
+		"""Queue buffers for sending. File regions are sent with sendfile() once
+		everything before them has been sent."""
+		start = 0
+		for i, buffer in enumerate(buffers):
+			if isinstance(buffer, fields.FileRegion):
+				if i > start:
+					self.send(b"".join(buffers[start:i]))
+				self._send_queue.append([buffer, 0])
+				start = i + 1
+		if start < len(buffers):
+			self.send(b"".join(buffers[start:]))
+		self.initiate_send()
+
+	def initiate_send(self):
+		if self.out_buffer or not self._send_queue:
+			asyncore.dispatcher_with_send.initiate_send(self)
+		elif isinstance(self._send_queue[0], list):
+			self._send_region()
+		else:
+			self.out_buffer = self._send_queue.popleft()
+			asyncore.dispatcher_with_send.initiate_send(self)
+
+	def _send_region(self):
+		entry = self._send_queue[0]
+		region, sent = entry
+		size = min(region.length - sent, self.sendfile_chunk_size)
+		try:
+			sent += os.sendfile(self.socket.fileno(), region.file.fileno(), 
+				region.offset + sent, size)
+		except BlockingIOError:
+			return
+		except (AttributeError, OSError) as e:
+			if isinstance(e, ConnectionError):
+				self.handle_close()
+				return
+			# No sendfile() for this file or platform, read the region instead
+			self._send_queue[0] = region.read(sent)
+			return
+		if sent == region.length:
+			self._send_queue.popleft()
+		elif sent == entry[1]:
+			raise TWPError("File is shorter than the region %s" % region)
+		else:
+			entry[1] = sent
+
+	def writable(self):
+		return (asyncore.dispatcher_with_send.writable(self) or 
+			bool(self._send_queue))
 
 	def handle_read(self):
 		try:
-			initial_pos = self.reader.pos
-			if not self.has_read_magic:
-				self.read_twp_magic()
-			if not self.has_read_protocol_id:
-				self.read_protocol_id()
-			else:
-				message = self.read_message()
-				self.on_message(message)
-			if self.reader.remaining_byte_length:
+			while True:
+				if not self.has_read_magic:
+					self.read_twp_magic()
+				if not self.has_read_protocol_id:
+					self.read_protocol_id()
+				else:
+					message = self.read_message()
+					self.on_message(message)
+				if not self.connected or not self.reader.remaining_byte_length:
+					break
 				# We did not process all the bytes, read again
-				self.handle_read()
 		except reader.NotEnoughBytes:
-			# Rewind
-			self.reader.pos = initial_pos
+			# The reader continues where it stopped on the next read event
+			pass
 		except reader.ReaderError as e:
 			log.warn(e)
 			self.close()
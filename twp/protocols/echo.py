@@ -39,8 +39,11 @@ class EchoConsumer(protocol.TWPConsumer):
 			text = message.text
 			letters = re.sub('[^A-Za-z]','', text)
 			number_of_letters = len(letters)
-			response = Response(text, number_of_letters)
+			response = self.protocol.new_message(Response, text, 
+				number_of_letters)
 			self.send_twp(response)
+			self.protocol.release_message(response)
+			self.protocol.release_message(message)
 		else:
 			raise error.TWPError("Unexpected Message %s" % message)
 
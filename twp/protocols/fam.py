@@ -1,33 +1,34 @@
-import twp.values
+import twp.fields
+import twp.message
 import twp.protocol
 
-class Path(twp.values.Sequence):
-    type = twp.values.String()
+class Path(twp.fields.Sequence):
+    type = twp.fields.String()
 
-class Changed(twp.values.Message):
+class Changed(twp.message.Message):
     id = 0
     directory = Path()
-    filename = twp.values.String()
+    filename = twp.fields.String()
 
-class Deleted(twp.values.Message):
+class Deleted(twp.message.Message):
     id = 1
     directory = Path()
-    filename = twp.values.String()
+    filename = twp.fields.String()
 
-class Created(twp.values.Message):
+class Created(twp.message.Message):
     id = 2
     directory = Path()
-    filename = twp.values.String()
+    filename = twp.fields.String()
 
-class StartExecuting(twp.values.Message):
+class StartExecuting(twp.message.Message):
     id = 3
     directory = Path()
-    filename = twp.values.String()
+    filename = twp.fields.String()
 
-class StopExecuting(twp.values.Message):
+class StopExecuting(twp.message.Message):
     id = 4
     directory = Path()
-    filename = twp.values.String()
+    filename = twp.fields.String()
 
 class FAM(twp.protocol.Protocol):
     protocol_id = 4
@@ -5,26 +5,12 @@ from twp import log
 import twp.fields
 import twp.message
 import twp.protocol
-import twp.protocols.logging
 import twp.error
 import twp.utils
 
-class Double(twp.fields.Primitive):
+class Double(twp.fields.FixedSizeApplicationType):
     tag = 160
-    _length = 8
-
-    @staticmethod
-    def unmarshal(bytes):
-        try:
-            return struct.unpack("!d", bytes)[0]
-        except struct.error:
-            raise twp.error.TWPError("Failed to decode Double from %s" % value)
-
-    def marshal(self):
-        try:
-            return struct.pack("!BBd", self.tag, self._length, self.value)
-        except struct.error:
-            raise twp.error.TWPError("Failed to encode Double from %s" % self.value)
+    format = "d"
 
 
 class _ForwardTerm(twp.fields.Base):
@@ -51,6 +37,9 @@ class _ForwardTerm(twp.fields.Base):
     def value(self, val):
         self.ref.value = val
 
+    def _convert(self, value):
+        return self.ref._convert(value)
+
 
 class Parameters(twp.fields.Sequence):
     type = _ForwardTerm()
@@ -72,9 +61,7 @@ class Request(twp.message.Message):
     arguments = Parameters()
 
     def get_thread_id(self):
-        for ext in self.extensions:
-            if isinstance(ext, ThreadID):
-                return ext
+        return self.get_extension(ThreadID)
 
 class Reply(twp.message.Message):
     id = 1
@@ -159,13 +146,12 @@ class RequestHandler():
         client.send_twp(req)
 
     def _add_request_extensions(self, req):
-        has_tid = False
+        tid = self.request.get_thread_id()
         for ext in self.request.extensions:
-            if isinstance(ext, ThreadID):
+            if ext is tid:
                 ext = ThreadID(ext.tid, ext.depth + 1)
-                has_tid = True
             req.extensions.append(ext)
-        if not has_tid:
+        if tid is None:
             tid = ThreadID(self.request.request_id, 1)
             req.extensions.append(tid)
 
@@ -230,6 +216,9 @@ class OperatorImplementation(twp.protocol.TWPConsumer):
         handler.handle(req)
 
     def get_log_client(self):
+        # The logging protocol is only needed once we log, not to marshal or
+        # unmarshal calculator messages.
+        import twp.protocols.logging
         if not self._log_client:
             self._log_client = twp.protocol.TWPClientAsync(
                 'www.dcl.hpi.uni-potsdam.de', 80, 
@@ -237,6 +226,11 @@ class OperatorImplementation(twp.protocol.TWPConsumer):
         return self._log_client
 
     def log_request(self, msg):
+        try:
+            import twp.protocols.logging
+        except ImportError:
+            # Without the logging protocol there is no service to log to
+            return
         try:
             le = twp.protocols.logging.LogEntry()
             le.seconds = int(time.time())
@@ -244,7 +238,7 @@ class OperatorImplementation(twp.protocol.TWPConsumer):
             le.source = self.name
             thread_id = msg.get_thread_id()
             if thread_id:
-                le.thread_id = "%s" % dict(thread_id._fields)
+                le.thread_id = "%s" % dict(thread_id._items())
             le.text = "Request %s: %s" % (msg.id, msg.arguments)
             # FIXME self.get_log_client().send_twp(le)
             log.error("Would log to service: %s" % le)
@@ -1,17 +1,151 @@
+import array
+import re
+import select
 import struct
-import socket
-from twp import log
+import sys
+import tempfile
+from twp import fields, log
+from twp.cache import LRUCache
 from twp.message import Extension, UnknownExtension
 from twp.error import TWPError, EndOfContent
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Runs of complete short and long integers, how to unpack one of them, and 
+# its size
+_INT_RUNS = {
+    13: (re.compile(b"(?:\r.)+", re.DOTALL), "xb", 2),
+    14: (re.compile(b"(?:\x0e....)+", re.DOTALL), "xl", 5),
+}
+
+# Int values and length prefixes
+_INT_FORMATS = {
+    13: struct.Struct("!b"),
+    14: struct.Struct("!l"),
+}
+_SHORT_LENGTH = struct.Struct("!B")
+_LONG_LENGTH = struct.Struct("!I")
+
+# Kinds of complex values. While a complex value is decoded, a frame 
+# [kind, values, ...] for it is on the decoder's stack.
+_STRUCT, _SEQUENCE, _UNION, _MESSAGE = range(4)
+_EOC = -1
+_NO_VALUE = -2
+
+# What to do for each tag: the name of the method that reads a primitive 
+# value, the kind of complex value that starts, _EOC, _NO_VALUE, or None if 
+# the tag is invalid.
+_TAG_ACTIONS = [None] * 256
+_TAG_ACTIONS[0] = _EOC
+_TAG_ACTIONS[1] = _NO_VALUE
+_TAG_ACTIONS[2] = _STRUCT
+_TAG_ACTIONS[3] = _SEQUENCE
+_TAG_ACTIONS[4:12] = [_UNION] * 8
+_TAG_ACTIONS[12] = "read_unknown_extension"
+_TAG_ACTIONS[13:15] = ["read_int"] * 2
+_TAG_ACTIONS[15:17] = ["read_binary"] * 2
+_TAG_ACTIONS[17:128] = ["read_string"] * 111
+_TAG_ACTIONS[160:256] = ["read_application_type"] * 96
+
+# Compiled decoders for typed reading, keyed by Message, Struct, Sequence and
+# Union subclass. See TWPReader.read_typed_message().
+_typed_decoders = {}
+# The functions that continue interrupted typed decoding, by the same classes
+_typed_resumes = {}
 
 class TWPReader(object):
-    """Reads bytes from a connection and unmarshals them into values."""
+    """Reads bytes from a connection and unmarshals them into values.
+
+    Received bytes are kept in a bytearray that is filled with recv_into(). 
+    buffer is a memoryview of the bytes from the last flush() on, and pos 
+    the offset of the next unprocessed byte in it. The bytearray is only 
+    compacted or grown when there is no room for the next read, and the 
+    read size grows while reads keep filling it.
 
-    def __init__(self, connection, _recvsize=1024):
+    If homogeneous_sequences is "array" or "numpy", sequences that only 
+    contain integers or only floats are returned as array.array or numpy 
+    arrays instead of lists. "numpy" raises ImportError without numpy.
+
+    If zero_copy is set, Binary and String values of at least 
+    zero_copy_threshold bytes are not copied out of the buffer: Binary 
+    values are returned as read-only memoryviews into it, and String values
+    as twp.fields.LazyString, which is only decoded when used. The buffer 
+    memory they refer to is pinned: it is not reused until release() is 
+    called. Until then, the reader moves on to new memory instead.
+
+    max_message_size limits the bytes read since the last flush(), i.e. the 
+    size of a message. It is checked before bytes are received, so a length 
+    prefix beyond it raises MessageTooLarge right away. Binary and String 
+    values of at least spool_threshold bytes are not buffered: they are 
+    written to a file from spool_file() while they are received, and 
+    returned as a twp.fields.FileRegion of it, or a LazyString of one.
+
+    If intern_strings is set, up to that many String values of at most 
+    intern_max_length bytes are kept in an LRU table keyed by their UTF-8 
+    bytes, and repeated ones are returned as the same object instead of being
+    decoded again. Sequences of strings of at most intern_max_sequence_length
+    bytes are returned as tuples, and repeated ones as the same tuple. intern_stats() reports the hit rate and 
+    the memory saved."""
+    homogeneous_sequences = None
+    zero_copy = False
+    zero_copy_threshold = 256
+    max_message_size = None
+    spool_threshold = None
+    # Spool files are kept in memory up to this size
+    spool_memory = 2**20
+    # Upper bound for the adaptive read size
+    max_recvsize = 2**20
+    intern_strings = None
+    intern_max_length = 64
+    intern_max_sequence_length = 1024
+
+    def __init__(self, connection, _recvsize=16384, homogeneous_sequences=None,
+            zero_copy=None, max_message_size=None, spool_threshold=None, 
+            spool_file=None, intern_strings=None):
         self.connection = connection
-        self.buffer = b""
         self.pos = 0
-        self._recvsize = _recvsize
+        self._recvsize = self._min_recvsize = _recvsize
+        self._data = bytearray(_recvsize)
+        self._start = 0
+        self._end = 0
+        self._update_buffer()
+        if homogeneous_sequences:
+            self.homogeneous_sequences = homogeneous_sequences
+        if self.homogeneous_sequences == "numpy" and numpy is None:
+            raise ImportError('homogeneous_sequences="numpy" needs numpy, '
+                'which is not installed')
+        if zero_copy is not None:
+            self.zero_copy = zero_copy
+        if max_message_size is not None:
+            self.max_message_size = max_message_size
+        if spool_threshold is not None:
+            self.spool_threshold = spool_threshold
+        if spool_file is not None:
+            self.spool_file = spool_file
+        if intern_strings is not None:
+            self.intern_strings = intern_strings
+        # Interned strings and sequences, and the bytes their reuse has saved
+        self._interned = None
+        if self.intern_strings:
+            self._interned = LRUCache(self.intern_strings, sizeof=sys.getsizeof)
+        self._intern_saved = 0
+        # A value being spooled, and the bytes spooled since the last flush()
+        self._spool = None
+        self._spooled = 0
+        # Zero-copy values referring to the current buffer
+        self._pins = []
+        # The stack of a decoding interrupted by NotEnoughBytes
+        self._partial = None
+        # The state of a scan_message() interrupted by NotEnoughBytes
+        self._scan = None
+        # _TAG_ACTIONS with the methods bound, so subclasses can override them
+        self._tag_actions = [getattr(self, action) if isinstance(action, str)
+            else action for action in _TAG_ACTIONS]
+
+    def _update_buffer(self):
+        self.buffer = memoryview(self._data)[self._start:self._end]
 
     def _advance(self, n):
         assert(n <= self.remaining_byte_length)
@@ -21,8 +155,16 @@ class TWPReader(object):
         """Remove processed bytes from the input buffer to start processing a 
         new message."""
         # FIXME better name
-        self.buffer = self.buffer[self.pos:]
+        self._start += self.pos
         self.pos = 0
+        self._spooled = 0
+        if self._start == self._end and not self._pins:
+            # Nothing left, start over at the beginning of the buffer
+            self._start = self._end = 0
+            if len(self._data) > self.max_recvsize:
+                # Do not hold on to the memory of a huge message
+                self._data = bytearray(self._min_recvsize)
+        self._update_buffer()
 
     @property
     def remaining_byte_length(self):
@@ -30,38 +172,160 @@ class TWPReader(object):
 
     @property
     def processed_bytes(self):
-        return self.buffer[:self.pos]
+        return bytes(self.buffer[:self.pos])
+
+    def processed_view(self):
+        """The bytes processed since the last flush(), for values that keep 
+        referring to them, like lazy messages. With zero_copy, this is a 
+        read-only view of the buffer, pinned until release(), instead of a
+        copy."""
+        if self.zero_copy:
+            return self._pin(self.buffer[:self.pos].toreadonly())
+        return self.processed_bytes
+
+    def _pin(self, value):
+        self._pins.append(value)
+        return value
+
+    def release(self):
+        """Allow the memory of the zero-copy values returned so far to be 
+        reused. Their memoryviews are released and can no longer be used, and
+        the bytes of strings that have not been decoded yet are copied."""
+        pins = self._pins
+        self._pins = []
+        for value in pins:
+            if isinstance(value, fields.LazyString):
+                value.detach()
+                continue
+            try:
+                value.release()
+            except BufferError:
+                # Still exported, e.g. to a numpy array
+                self._pins.append(value)
 
     def _ensure_buffer_length(self, length):
         """Make sure we have at least length unprocessed bytes on the buffer. 
-        Read more bytes into the buffer if neccessary."""
-        if self.remaining_byte_length < length:
-            if not self._read_from_connection():
+        Read more bytes into the buffer if neccessary. Waits for them on 
+        blocking connections."""
+        if (self.max_message_size is not None and 
+                self.pos + self._spooled + length > self.max_message_size):
+            raise MessageTooLarge("Message exceeds %d bytes" 
+                % self.max_message_size)
+        while len(self.buffer) - self.pos < length:
+            if not self._read_from_connection(length - self.remaining_byte_length):
                 raise ReaderError("Connection closed")
-        if self.remaining_byte_length < length:
-            log.debug("Not enough bytes to unmarshal")
-            raise NotEnoughBytes()
+            if self.remaining_byte_length < length and not self._is_blocking():
+                log.debug("Not enough bytes to unmarshal")
+                raise NotEnoughBytes()
 
-    def _read_from_connection(self, size=1024):
+    def _is_blocking(self):
+        sock = getattr(self.connection, "socket", None)
+        return sock is not None and sock.gettimeout() is None
+
+    def _reserve(self, size):
+        """Make room for at least size more bytes after the received ones."""
+        data = self._data
+        if len(data) - self._end >= size:
+            return
+        used = self._end - self._start
+        if (used + size <= len(data) and used <= len(data) // 2 and 
+                not self._pins):
+            # Move the unflushed bytes to the front
+            view = memoryview(data)
+            view[:used] = view[self._start:self._end]
+        else:
+            if self._pins and used + size <= len(data):
+                # Only pinned values are in the way, not a lack of room
+                self._data = bytearray(len(data))
+            else:
+                self._data = bytearray(max(used + size, 2 * len(data)))
+            self._data[:used] = self.buffer
+            # Pinned values keep referring to the old buffer
+            self._pins = []
+        self._start = 0
+        self._end = used
+        self._update_buffer()
+
+    def _read_from_connection(self, size=0):
+        """Receive at least the current read size, or size bytes if that is 
+        more. Returns False if the connection has been closed."""
+        size = max(size, self._recvsize)
+        if self.max_message_size is not None:
+            # Bytes up to the size limit are not checked when they are used,
+            # so do not receive beyond it
+            size = min(size, self.max_message_size - self._spooled -
+                len(self.buffer))
+        self._reserve(size)
+        view = memoryview(self._data)[self._end:self._end + size]
         try:
-            data = self.connection.recv(self._recvsize)
-        except socket.error:
-            raise
-        if not len(data):
+            received = self._recv_into(view, size)
+        except BlockingIOError:
+            # Non-blocking connection, wait for the next read event
+            raise NotEnoughBytes()
+        finally:
+            view.release()
+        if not received:
             return False
-        log.debug("Recvd %d bytes:\n%s" % (len(data), data))
-        self.buffer += data
+        log.debug("Recvd %d bytes" % received)
+        if received == size and self._recvsize < self.max_recvsize:
+            # The connection had more to give, read more at once next time
+            self._recvsize = min(2 * self._recvsize, self.max_recvsize)
+        self._end += received
+        self._update_buffer()
         return True
 
+    def _recv_into(self, view, size):
+        recv_into = getattr(self.connection, "recv_into", None)
+        if recv_into is not None:
+            return recv_into(view, size)
+        data = self.connection.recv(size)
+        view[:len(data)] = data
+        return len(data)
+
     def read_bytes(self, n):
         self._ensure_buffer_length(n)
         end = self.pos + n
-        bytes = self.buffer[self.pos:end]
+        value = bytes(self.buffer[self.pos:end])
         self._advance(n)
-        return bytes
+        return value
 
     def read_tag(self):
-        return self.read_bytes(1)[0]
+        pos = self.pos
+        if pos >= len(self.buffer):
+            self._ensure_buffer_length(1)
+        tag = self.buffer[pos]
+        self.pos = pos + 1
+        return tag
+
+    def peek_tag(self):
+        """Return the next tag without consuming it. If reading a value has 
+        been interrupted by NotEnoughBytes, this is the tag of that value."""
+        if self._scan is not None:
+            return 4 + self._scan[0]
+        if self._partial is not None:
+            frame = self._partial[0]
+            if frame[0] == _STRUCT:
+                return 2
+            elif frame[0] == _SEQUENCE:
+                return 3
+            return 4 + frame[2]
+        self._ensure_buffer_length(1)
+        return self.buffer[self.pos]
+
+    def replace_processed(self, data):
+        """Replace the bytes processed since the last flush() with data, and 
+        continue reading at the start of data."""
+        rest = self.buffer[self.pos:]
+        size = len(data) + len(rest)
+        new = bytearray(max(size + self._recvsize, self._min_recvsize))
+        new[:len(data)] = data
+        new[len(data):size] = rest
+        self._data = new
+        self._pins = []
+        self._start = 0
+        self._end = size
+        self.pos = 0
+        self._update_buffer()
 
     def read_with_format(self, format):
         length = struct.calcsize(format)
@@ -70,131 +334,1023 @@ class TWPReader(object):
         self._advance(length)
         return values[0]
 
+    def _unpack(self, format):
+        """Read a value with a precompiled struct.Struct."""
+        self._ensure_buffer_length(format.size)
+        value = format.unpack_from(self.buffer, self.pos)[0]
+        self.pos += format.size
+        return value
+
     def read_value(self):
         """Read a TWP value from the stream. Automatically get more bytes from 
         the stream if the buffer does not contain a complete TWP value."""
-        tag = self.read_tag()
-        log.debug("Read tag %d" % tag)
-        if tag == 0:
-            raise EndOfContent("Unexpected End-Of-Content")
-        elif tag == 1:
-            return None
-        elif tag == 2:
-            # struct
-            return self.read_complex()
-        elif tag == 3:
-            # sequence
-            return self.read_complex()
-        elif tag in range(4,12): 
-            return self.read_union(tag)
-        elif tag == 12:
-            return self.read_extension(tag)
-        elif tag in range(13, 15):
-            return self.read_int(tag)
-        elif tag in range(15, 17):
-            return self.read_binary(tag)
-        elif tag in range(17, 128):
-            return self.read_string(tag)
-        elif tag in range(160, 256):
-            return self.read_application_type(tag)
-        else:
-            # User-defined?
-            raise TWPError("Invalid tag: %d" % tag)
+        return self._resume([])
 
-    def read_complex(self):
-        """Read a complex value from the stream until running into EOC."""
-        values = []
+    def _resume(self, stack):
+        """Decode the value on the stack, or continue the decoding that has 
+        been interrupted by NotEnoughBytes instead. If the bytes run out again,
+        the stack is kept for the next call, so that every value is only 
+        decoded once however it is split into reads."""
+        if self._partial is not None:
+            stack = self._partial
+            self._partial = None
+        try:
+            return self._decode(stack)
+        except NotEnoughBytes:
+            if stack:
+                self._partial = stack
+            raise
+
+    def _decode(self, stack):
+        """Decode values until the complex values on the stack are complete,
+        and return the outermost one. With an empty stack, decode a single 
+        value.
+
+        Tags are looked up in a table. Complex values are decoded with the 
+        explicit stack instead of recursion, so their depth is not limited,
+        and End-Of-Content completes the innermost one. On NotEnoughBytes, 
+        pos is left at the start of the incomplete primitive value or tag, 
+        and the stack holds the complex values around it."""
+        actions = self._tag_actions
+        homogeneous = self.homogeneous_sequences
         while True:
+            if homogeneous and stack and stack[-1][0] == _SEQUENCE:
+                self._read_int_runs(stack[-1])
+            start = self.pos
             try:
-                val = self.read_value()
-                values.append(val)
-            except EndOfContent:
-                break
-        return values
+                if self.pos >= len(self.buffer):
+                    self._ensure_buffer_length(1)
+                tag = self.buffer[self.pos]
+                self.pos += 1
+                action = actions[tag]
+                if action.__class__ is int:
+                    if action >= 0:
+                        stack.append(self._open(action, tag))
+                        continue
+                    elif action == _NO_VALUE:
+                        value = None
+                    elif stack:
+                        value = self._close(stack.pop())
+                    else:
+                        raise EndOfContent("Unexpected End-Of-Content")
+                elif action is None:
+                    raise TWPError("Invalid tag: %d" % tag)
+                else:
+                    value = action(tag)
+            except NotEnoughBytes:
+                self.pos = start
+                raise
+            # Add the value to the enclosing complex value
+            while stack:
+                frame = stack[-1]
+                if frame[0] != _UNION:
+                    frame[1].append(value)
+                    if homogeneous and frame[0] == _SEQUENCE:
+                        frame[2].add(value.__class__)
+                    break
+                # A union is complete with its value
+                stack.pop()
+                value = (frame[2], value)
+            else:
+                return value
 
-    def _read_message(self):
+    def _open(self, kind, tag):
+        """Return the frame for a complex value starting with tag."""
+        if kind == _STRUCT:
+            return [kind, []]
+        elif kind == _SEQUENCE:
+            return [kind, [], set(), self.pos - 1]
+        return [kind, None, tag - 4]
+
+    def _close(self, frame):
+        """Return the value of a frame ended by End-Of-Content."""
+        kind = frame[0]
+        if kind == _STRUCT:
+            return frame[1]
+        elif kind == _SEQUENCE:
+            if self._interned is not None:
+                sequence = self._intern_sequence(frame[3], frame[1])
+                if sequence is not None:
+                    return sequence
+            if self.homogeneous_sequences:
+                return self._to_array(frame[1], frame[2])
+            return frame[1]
+        elif kind == _UNION:
+            raise EndOfContent("Unexpected End-Of-Content")
         values = []
         extensions = []
-        while True:
-            try:
-                val = self.read_value()
-                if isinstance(val, Extension):
-                    extensions.append(val)
-                else:
-                    values.append(val)
-            except EndOfContent:
-                break
-        return values, extensions
+        for value in frame[1]:
+            if isinstance(value, Extension):
+                extensions.append(value)
+            else:
+                values.append(value)
+        return frame[2], values, extensions
+
+    def read_complex(self):
+        """Read a complex value from the stream until running into EOC."""
+        return self._resume([[_STRUCT, []]])
+
+    def read_sequence(self):
+        """Read the elements of a sequence until running into EOC."""
+        return self._resume([[_SEQUENCE, [], set(), self.pos - 1]])
+
+    def _read_int_runs(self, frame):
+        """Unpack all complete integers at the start of the unprocessed 
+        bytes with one call per run, and add them to the sequence frame."""
+        buffer = self.buffer
+        while self.pos < len(buffer):
+            run = _INT_RUNS.get(buffer[self.pos])
+            if run is None:
+                return
+            pattern, format, size = run
+            match = pattern.match(buffer, self.pos)
+            if not match:
+                return
+            count = (match.end() - self.pos) // size
+            frame[1].extend(struct.unpack_from("!" + format * count, buffer,
+                self.pos))
+            frame[2].add(int)
+            self.pos = match.end()
+
+    def _to_array(self, values, kinds):
+        if kinds == {int}:
+            typecode = "q"
+        elif kinds == {float}:
+            typecode = "d"
+        else:
+            return values
+        if self.homogeneous_sequences == "numpy":
+            return numpy.array(values, dtype=typecode)
+        return array.array(typecode, values)
 
     def read_message(self, tag=None):
         """Read a message (or union) from the stream. Returns the id, values and
-        extensions."""
+        extensions. If this raises NotEnoughBytes, call it again once more 
+        bytes have arrived to continue reading the message."""
+        if self._partial is not None:
+            return self._resume(None)
         tag = tag or self.read_tag()
         if not 4 <= tag <= 11:
             raise TWPError("Expected message tag but saw %d" % tag)
         id = tag - 4 # or union case
-        values, extensions = self._read_message()
+        return self._resume([[_MESSAGE, [], id]])
+
+    def scan_message(self, tag=None):
+        """Find the top-level values of a message without decoding them. 
+        Returns the message id and the offsets of its fields and of its 
+        extensions from the start of the message. Afterwards, the message's 
+        bytes are processed_bytes, and value_decoder() decodes the values at 
+        the offsets.
+
+        Application types that the protocol reads itself can only be decoded
+        from the connection. If the message contains any, this returns None 
+        with pos back at the start of the message, to read it with 
+        read_message() instead. If this raises NotEnoughBytes, call it again 
+        once more bytes have arrived; it continues at the first incomplete 
+        tag, even within a value."""
+        if self._scan is None:
+            start = self.pos
+            tag = tag or self.read_tag()
+            if not 4 <= tag <= 11:
+                raise TWPError("Expected message tag but saw %d" % tag)
+            self._scan = [tag - 4, start, [], [], False, None, None]
+        # offset and state are those of a value that is partly skipped
+        id, start, values, extensions, protocol_types, offset, state = \
+            self._scan
+        while True:
+            try:
+                if offset is None:
+                    self._ensure_buffer_length(1)
+                    if self.buffer[self.pos] == 0:
+                        self.pos += 1
+                        break
+                    offset = self.pos
+                    state = [0, False]
+                protocol_types = self._skip_value(state) or protocol_types
+            except NotEnoughBytes:
+                self._scan[4:] = protocol_types, offset, state
+                raise
+            except Exception:
+                self._scan = None
+                raise
+            if self.buffer[offset] == Extension.tag:
+                extensions.append(offset - start)
+            else:
+                values.append(offset - start)
+            offset = None
+        self._scan = None
+        if protocol_types:
+            self.pos = start
+            return None
         return id, values, extensions
 
+    def _skip_value(self, state=None):
+        """Advance pos past a value without decoding it. Returns True if it 
+        contains application types the protocol reads itself.
+
+        state is the [depth, protocol_types] reached in the value by an 
+        earlier call. If this raises NotEnoughBytes, pos is back at the first
+        incomplete tag and state is updated, so that calling it again with 
+        state continues there."""
+        depth, protocol_types = state or (0, False)
+        try:
+            while True:
+                item = self.pos
+                tag = self.read_tag()
+                action = _TAG_ACTIONS[tag]
+                if tag == 0:
+                    if not depth:
+                        raise EndOfContent("Unexpected End-Of-Content")
+                    depth -= 1
+                elif action == _STRUCT or action == _SEQUENCE:
+                    depth += 1
+                    continue
+                elif tag == Extension.tag:
+                    self._skip(_LONG_LENGTH.size)
+                    depth += 1
+                    continue
+                elif action == _UNION:
+                    # The value of the union follows
+                    continue
+                elif action is None:
+                    raise TWPError("Invalid tag: %d" % tag)
+                elif tag == 13 or tag == 14:
+                    self._skip(_INT_FORMATS[tag].size)
+                elif tag == 15:
+                    self._skip(self._unpack(_SHORT_LENGTH))
+                elif 17 <= tag < 127:
+                    self._skip(tag - 17)
+                elif tag >= 160 and tag not in fields.application_types:
+                    self.read_application_type(tag)
+                    protocol_types = True
+                elif tag != 1:
+                    # Long binaries, strings and application types
+                    self._skip(self._unpack(_LONG_LENGTH))
+                if not depth:
+                    return protocol_types
+        except NotEnoughBytes:
+            self.pos = item
+            if state is not None:
+                state[:] = depth, protocol_types
+            raise
+
+    def _skip(self, n):
+        self._ensure_buffer_length(n)
+        self.pos += n
+
+    def value_decoder(self, raw):
+        """Return a function that decodes the value at an offset of raw, a 
+        message as scanned by scan_message(). The values are decoded like 
+        this reader would, but without touching its buffer."""
+        decoder = _RawReader(self.connection, raw, self.homogeneous_sequences,
+            self.zero_copy)
+        return decoder.read_value_at
+
+    def read_typed_message(self):
+        """Read a message and decode it straight into an instance of its 
+        Message class in the connection's protocol, guided by the field 
+        definitions. Values that do not match them raise a TWPError. If this 
+        raises NotEnoughBytes, call it again once more bytes have arrived; it
+        continues with the first incomplete value."""
+        if self._partial is None:
+            return self._decode_typed_message()
+        stack = self._partial
+        self._partial = None
+        try:
+            return _resume_typed(self, iter(stack))
+        except RecursionError:
+            self._partial = None
+            cls = self.connection.protocol.message_ids[stack[0][2]]
+            raise TWPError("%s is nested too deeply" % cls.__name__)
+
+    def _interrupt_typed(self, start, frame):
+        """Keep the frame of a complex value whose typed decoding has been 
+        interrupted by NotEnoughBytes in _partial, which holds the frames 
+        from the outermost value inwards. Called from the innermost value 
+        outwards: the innermost value continues at start, the others with 
+        the value of the next frame."""
+        if self._partial is None:
+            self.pos = start
+            frame[5] = False
+            self._partial = [frame]
+        else:
+            frame[5] = True
+            self._partial.insert(0, frame)
+
+    def _decode_typed_message(self):
+        tag = self.read_tag()
+        if not 4 <= tag <= 11:
+            raise TWPError("Expected message tag but saw %d" % tag)
+        cls = self.connection.protocol.message_ids.get(tag - 4)
+        if cls is None:
+            raise TWPError("Message not understood: %d" % (tag - 4))
+        try:
+            return _get_typed_decoder(cls)(self, tag)
+        except RecursionError:
+            raise TWPError("%s is nested too deeply" % cls.__name__)
+
+    def _read_typed_extension(self):
+        """Read an extension after its tag. Its values are only decoded when 
+        it is materialized, see Message.get_extension()."""
+        return self._read_extension_values(self._unpack(_LONG_LENGTH))
+
+    def _read_untyped(self, tag):
+        """Decode the value starting with tag without a definition."""
+        self.pos -= 1
+        return self._decode([])
+
+    def read_message_start(self, tag=None):
+        """Read a message tag and return the message id. Together with 
+        read_value(), iter_sequence() and read_message_end() this reads a 
+        message field by field instead of all at once."""
+        tag = tag or self.read_tag()
+        if not 4 <= tag <= 11:
+            raise TWPError("Expected message tag but saw %d" % tag)
+        return tag - 4
+
+    def read_message_end(self):
+        """Read the remaining extensions of a message up to its EOC and 
+        return them."""
+        extensions = []
+        for value in self.iter_values():
+            if not isinstance(value, Extension):
+                raise TWPError("Expected extension or EOC but saw %s" % value)
+            extensions.append(value)
+        return extensions
+
+    def iter_sequence(self):
+        """Read a sequence and yield its elements as they are decoded. The 
+        bytes of consumed elements are dropped from the buffer, so memory use
+        does not depend on the length of the sequence. Meant for blocking 
+        connections, where waiting for the next element is fine."""
+        tag = self.read_tag()
+        if tag != 3:
+            raise TWPError("Expected sequence tag but saw %d" % tag)
+        return self.iter_values()
+
+    def iter_values(self):
+        """Yield values until running into EOC. On non-blocking sockets, 
+        this waits for the rest of a value with select(). Connections 
+        without a socket raise NotEnoughBytes instead; calling iter_values()
+        again once more bytes have arrived continues with the same value."""
+        while True:
+            try:
+                if self.peek_tag() == 0:
+                    self._advance(1)
+                    self.flush()
+                    return
+                value = self.read_value()
+            except NotEnoughBytes:
+                sock = getattr(self.connection, "socket", None)
+                if sock is None:
+                    raise
+                select.select([sock], [], [])
+                continue
+            self.flush()
+            yield value
+
     def read_union(self, tag=None):
         tag = tag or self.read_tag()
         if not 4 <= tag <= 11:
             raise TWPError("Expected union tag but saw %d" % tag)
-        case = tag - 4
-        return case, self.read_value()
+        return self._resume([[_UNION, None, tag - 4]])
 
     def read_int(self, tag=None):
-        tag = tag or self.read_tag()
-        formats = {
-            13: "!b",
-            14: "!l",
-        }
-        if not tag in formats:
+        if tag is None:
+            # Do not consume the tag without the value
+            start = self.pos
+            try:
+                return self.read_int(self.read_tag())
+            except NotEnoughBytes:
+                self.pos = start
+                raise
+        format = _INT_FORMATS.get(tag)
+        if format is None:
             raise TWPError("Expected int tag, but saw %d" % tag)
-        format = formats[tag]
-        return self.read_with_format(format)
+        return self._unpack(format)
 
     def read_binary(self, tag):
-        log.debug("Reading binary")
-        formats = {
-            15: "!b",
-            16: "!I"
-        }
-        format = formats[tag]
-        length = self.read_with_format(format)
+        length = self._unpack(_SHORT_LENGTH if tag == 15 else _LONG_LENGTH)
+        if self.spool_threshold is not None and length >= self.spool_threshold:
+            return self._spool_value(tag, length)
+        if self.zero_copy and length >= self.zero_copy_threshold:
+            return self._pin(self._read_view(length).toreadonly())
         return self.read_bytes(length)
 
+    def spool_file(self, tag, length):
+        """Return the file to write a value of at least spool_threshold bytes
+        to, given its tag and length. Anything with a write() method will do,
+        e.g. an object that hands the chunks to a callback, as long as the 
+        value is not read back."""
+        return tempfile.SpooledTemporaryFile(self.spool_memory)
+
+    def _spool_value(self, tag, length):
+        """Write the next length bytes to a spool file as they are received,
+        dropping them from the buffer. If this raises NotEnoughBytes, reading 
+        the same value again continues where it stopped."""
+        spool = self._spool
+        if spool is None or spool[0] != self.pos:
+            if (self.max_message_size is not None and self.pos + 
+                    self._spooled + length > self.max_message_size):
+                raise MessageTooLarge("Message exceeds %d bytes" 
+                    % self.max_message_size)
+            file = self.spool_file(tag, length)
+            tell = getattr(file, "tell", None)
+            spool = self._spool = [self.pos, file, tell() if tell else 0, 
+                length]
+        pos, file, offset, remaining = spool
+        while True:
+            available = min(remaining, len(self.buffer) - pos)
+            if available:
+                file.write(self.buffer[pos:pos + available])
+                remaining -= available
+            self._spooled += available
+            if not remaining:
+                break
+            # The buffered bytes all belong to the value, drop them
+            spool[3] = remaining
+            self._end = self._start + pos
+            self._update_buffer()
+            if not self._read_from_connection():
+                raise ReaderError("Connection closed")
+        # Drop the last chunk too, the bytes after it move into its place
+        rest = len(self.buffer) - pos - available
+        self.buffer[pos:pos + rest] = self.buffer[pos + available:]
+        self._end = self._start + pos + rest
+        self._update_buffer()
+        self._spool = None
+        self.pos = pos
+        return fields.FileRegion(file, offset, length)
+
+    def _read_view(self, n):
+        self._ensure_buffer_length(n)
+        end = self.pos + n
+        value = self.buffer[self.pos:end]
+        self.pos = end
+        return value
+
     def read_string(self, tag):
-        log.debug("Reading string")
         short_tag = 17
         long_tag = 127
         if tag < long_tag:
             length = tag - short_tag
         else:
-            length = self.read_with_format("@I")
-        value = self.read_bytes(length)
+            length = self._unpack(_LONG_LENGTH)
+        if self.spool_threshold is not None and length >= self.spool_threshold:
+            return fields.LazyString(self._spool_value(tag, length))
+        if self.zero_copy and length >= self.zero_copy_threshold:
+            return self._pin(fields.LazyString(self._read_view(length)))
+        self._ensure_buffer_length(length)
+        end = self.pos + length
+        interned = self._interned
+        if interned is not None and length <= self.intern_max_length:
+            key = bytes(self.buffer[self.pos:end])
+            value = interned.get(key)
+            if value is not None:
+                self._intern_saved += sys.getsizeof(value)
+                self.pos = end
+                return value
         try:
-            value = value.decode("utf-8")
+            value = str(self.buffer[self.pos:end], "utf-8")
         except UnicodeError:
             raise TWPError("Failed to utf-8 decode string value")
+        if interned is not None and length <= self.intern_max_length:
+            interned.put(key, value)
+        self.pos = end
         return value
 
+    def _intern_sequence(self, start, values):
+        """Return the strings of the sequence from start to pos as a tuple, 
+        the same one for the same bytes, or None if it is not interned."""
+        if self.pos - start > self.intern_max_sequence_length:
+            return None
+        for value in values:
+            if value.__class__ is not str:
+                return None
+        key = (tuple, bytes(self.buffer[start:self.pos]))
+        interned = self._interned
+        sequence = interned.get(key)
+        if sequence is None:
+            sequence = tuple(values)
+            interned.put(key, sequence)
+        else:
+            self._intern_saved += sys.getsizeof(sequence)
+        return sequence
+
+    def intern_stats(self):
+        """Return the statistics of the intern table, and the bytes of 
+        strings and tuples that were reused instead of allocated as 
+        "saved"."""
+        if self._interned is None:
+            return None
+        stats = self._interned.stats()
+        stats["saved"] = self._intern_saved
+        return stats
+
     def read_application_type(self, tag):
-        return self.connection.protocol.read_application_type(tag)
+        cls = fields.application_types.get(tag)
+        if cls is None:
+            return self.connection.protocol.read_application_type(tag)
+        length = self._unpack(_LONG_LENGTH)
+        data = self.read_bytes(length)
+        as_numpy = self.homogeneous_sequences == "numpy"
+        return cls.unmarshal(data, as_numpy=as_numpy)
 
     def read_extension(self, tag=None):
-        tag = tag or self.read_tag()
-        if tag != 12:
-            raise TWPError("Expected extension tag but saw %d" % tag)
-        id = self.read_bytes(4)
-        id = struct.unpack("!I", id)[0]
-        start_pos = self.pos
-        values = self.read_complex()
-        end_pos = self.pos - 1 # -1 for EOC
-        # Pass the raw bytes so we don't have to marshal this when forwarding
-        raw = self.buffer[start_pos:end_pos]
-        ext = UnknownExtension(id, values, raw=raw)
-        return ext
+        start = self.pos
+        try:
+            tag = tag or self.read_tag()
+            if tag != 12:
+                raise TWPError("Expected extension tag but saw %d" % tag)
+            return self.read_unknown_extension(tag)
+        except NotEnoughBytes:
+            self.pos = start
+            raise
+
+    def read_unknown_extension(self, tag):
+        """Read an extension as an UnknownExtension. Its values are not 
+        decoded until they are used: it keeps their raw bytes, which are sent
+        as they are when the extension is forwarded. With zero_copy, these are
+        a pinned view of the buffer instead of a copy."""
+        return self._read_extension_values(self._unpack(_LONG_LENGTH))
+
+    def _read_extension_values(self, id):
+        start = self.pos
+        protocol_types = False
+        while True:
+            if self.pos >= len(self.buffer):
+                self._ensure_buffer_length(1)
+            if self.buffer[self.pos] == 0:
+                break
+            protocol_types = self._skip_value() or protocol_types
+        raw = self.buffer[start:self.pos]
+        self.pos += 1
+        if protocol_types:
+            # Only this reader can decode them, so do it now
+            self.pos = start
+            values = self._decode([[_STRUCT, []]])
+            return UnknownExtension(id, values, raw=bytes(raw))
+        if self.zero_copy:
+            raw = self._pin(raw.toreadonly())
+        else:
+            raw = bytes(raw)
+        return UnknownExtension(id, raw=raw, decode=self.decode_values)
+
+    def decode_values(self, raw):
+        """Decode the values marshalled in raw, such as those of an 
+        extension, without touching the buffer."""
+        decoder = _RawReader(self.connection, raw, self.homogeneous_sequences,
+            self.zero_copy)
+        return decoder.read_values()
+
+
+# Typed decoders are called as decode(reader, tag) once the tag of a value has 
+# been read. They decode the value and return it: messages and extensions as 
+# instances of their class, structs as lists, like untyped decoding does. The
+# fields of a message convert their values, see twp.fields._Complex.
+
+def _get_typed_decoder(cls):
+    """Returns the typed decoder for a Message, Struct, Sequence or Union 
+    subclass, compiling it on first use."""
+    try:
+        return _typed_decoders[cls]
+    except KeyError:
+        pass
+    return _compile_typed(cls)
+
+def _compile_typed(cls):
+    """Compile the typed decoder and resume function of cls. An installed 
+    decoder, see install_typed_decoders(), is kept in _typed_decoders."""
+    if issubclass(cls, fields._Complex):
+        return _compile_typed_complex(cls)
+    elif issubclass(cls, fields.Sequence):
+        return _compile_typed_sequence(cls)
+    elif issubclass(cls, fields.Union):
+        return _compile_typed_union(cls)
+    else:
+        raise ValueError("Cannot compile a typed decoder for %s" % cls)
+
+def _typed_decoder(field):
+    """Returns a typed decoder for values of the field definition `field`."""
+    # Forward declarations only resolve to their target on access.
+    field = getattr(field, "ref", field)
+    if isinstance(field, fields.FixedSizeApplicationType):
+        return _typed_fixed_size(field.__class__)
+    elif field.is_application_type:
+        return _typed_primitive([field.tag], field.__class__.__name__)
+    elif isinstance(field, fields.Int):
+        return _typed_primitive([13, 14], "Int")
+    elif isinstance(field, fields.String):
+        return _typed_primitive(range(17, 128), "String")
+    elif isinstance(field, fields.Binary):
+        return _typed_primitive([15, 16], "Binary")
+    elif isinstance(field, (fields.Sequence, fields.Struct, fields.Union)):
+        return _get_typed_decoder(field.__class__)
+    # Anything else, e.g. an AnyDefinedBy in a sequence, is not checked
+    return _typed_untyped
+
+def _typed_mismatch(expected, tag):
+    return TWPError("Expected %s but saw tag %d" % (expected, tag))
+
+def _typed_primitive(tags, expected):
+    tags = frozenset(tags)
+    def decode(reader, tag):
+        if tag in tags:
+            return reader._tag_actions[tag](tag)
+        elif tag == 1:
+            return None
+        raise _typed_mismatch(expected, tag)
+    return decode
+
+def _typed_fixed_size(cls):
+    """Decodes values of a FixedSizeApplicationType as its marshal() encodes 
+    them, without the protocol's read_application_type()."""
+    format = struct.Struct("!B" + cls.format)
+    def decode(reader, tag):
+        if tag == cls.tag:
+            reader._ensure_buffer_length(format.size)
+            length, value = format.unpack_from(reader.buffer, reader.pos)
+            if length != format.size - 1:
+                raise TWPError("Expected %d for %s length byte, got %d" % (
+                    format.size - 1, cls.__name__, length))
+            reader.pos += format.size
+        elif tag == 1:
+            value = None
+        else:
+            raise _typed_mismatch(cls.__name__, tag)
+        return value
+    return decode
+
+def _typed_untyped(reader, tag):
+    return None if tag == 1 else reader._read_untyped(tag)
+
+def _resume_typed(reader, frames):
+    """Continue the typed decoding of the next of the frames interrupted by 
+    NotEnoughBytes, see TWPReader._interrupt_typed(), and return its value.
+    """
+    frame = next(frames)
+    return frame[3](reader, frame, frames)
+
+def _compile_typed_fields(cls):
+    """Returns decode_fields(reader, frame, frames=None), which decodes the 
+    values of the fields of cls into frame[1], starting with field frame[4],
+    until End-Of-Content or an extension. Returns the tag that ended them. 
+    If the value of field frame[4] has been interrupted, frame[5] is set and
+    it is continued from frames first."""
+    def decode_fields(reader, frame, frames=None):
+        values = frame[1]
+        i = frame[4]
+        item = reader.pos
+        try:
+            if frame[5]:
+                name, decode, reference = plan[i]
+                try:
+                    value = _resume_typed(reader, frames)
+                    if reference is not None:
+                        value = _any_definition(reader, definitions[i], 
+                            values[reference])._convert(value)
+                except TWPError as e:
+                    raise TWPError("%s.%s: %s" % (cls.__name__, name, e))
+                values.append(value)
+                i += 1
+            while i < count:
+                name, decode, reference = plan[i]
+                item = reader.pos
+                tag = reader.read_tag()
+                if tag == 0 or tag == Extension.tag:
+                    return tag
+                try:
+                    if reference is not None:
+                        value = _decode_any_defined_by(reader, tag, 
+                            definitions[i], values[reference])
+                    else:
+                        value = decode(reader, tag)
+                except TWPError as e:
+                    raise TWPError("%s.%s: %s" % (cls.__name__, name, e))
+                values.append(value)
+                i += 1
+            item = reader.pos
+            tag = reader.read_tag()
+        except NotEnoughBytes:
+            frame[4] = i
+            reader._interrupt_typed(item, frame)
+            raise
+        if tag != 0 and tag != Extension.tag:
+            raise TWPError("%s has more values than fields" % cls.__name__)
+        return tag
+    definitions = list(cls._fields.values())
+    names = list(cls._fields)
+    plan = []
+    for name, field in cls._fields.items():
+        if isinstance(field, fields.AnyDefinedBy):
+            plan.append((name, None, names.index(field.reference_name)))
+        else:
+            plan.append((name, _typed_decoder(field), None))
+    count = len(plan)
+    return decode_fields
+
+def _any_definition(reader, field, reference_value):
+    definition = reader.connection.protocol.define_any_defined_by(field, 
+        reference_value)
+    return getattr(definition, "ref", definition)
+
+def _decode_any_defined_by(reader, tag, field, reference_value):
+    definition = _any_definition(reader, field, reference_value)
+    if definition is None:
+        return _typed_untyped(reader, tag)
+    return definition._convert(_typed_decoder(definition)(reader, tag))
+
+def _compile_typed_complex(cls):
+    """Compile the typed decoder of a Message or Struct subclass. Their 
+    frames are [kind, values, id, resume, field index, interrupted]; once 
+    the fields are complete, the field index is None and a message frame 
+    holds the message instead of its values."""
+    def decode_message(reader, tag):
+        frame = [_MESSAGE, [], tag - 4, resume, 0, False]
+        return end_message(reader, frame, decode_fields(reader, frame))
+    def end_message(reader, frame, tag):
+        pool = reader.connection.protocol.message_pool
+        frame[1] = cls._from_values(frame[1], 
+            None if pool is None else pool.acquire(cls))
+        frame[4] = None
+        return end(reader, frame, tag)
+    def decode_struct(reader, tag):
+        if tag == 1:
+            return None
+        elif tag != fields.Struct.tag:
+            raise _typed_mismatch(cls.__name__, tag)
+        frame = [_STRUCT, [], None, resume, 0, False]
+        tag = decode_fields(reader, frame)
+        frame[4] = None
+        return end(reader, frame, tag)
+    def end(reader, frame, tag):
+        """Read the extensions after the fields, starting with tag."""
+        item = reader.pos - 1
+        try:
+            while tag == Extension.tag:
+                extension = reader._read_typed_extension()
+                # Structs have no place to keep extensions
+                if frame[0] == _MESSAGE:
+                    frame[1].extensions.append(extension)
+                item = reader.pos
+                tag = reader.read_tag()
+        except NotEnoughBytes:
+            reader._interrupt_typed(item, frame)
+            raise
+        if tag != 0:
+            raise TWPError("Expected extension or EOC but saw %d" % tag)
+        return frame[1]
+    def resume(reader, frame, frames):
+        if frame[4] is not None:
+            tag = decode_fields(reader, frame, frames)
+            if frame[0] == _MESSAGE:
+                return end_message(reader, frame, tag)
+            frame[4] = None
+        else:
+            try:
+                tag = reader.read_tag()
+            except NotEnoughBytes:
+                reader._interrupt_typed(reader.pos, frame)
+                raise
+        return end(reader, frame, tag)
+    if issubclass(cls, fields.Struct):
+        decode = decode_struct
+    else:
+        decode = decode_message
+    # Register before compiling the fields, so recursive types terminate.
+    _typed_decoders.setdefault(cls, decode)
+    _typed_resumes[cls] = resume
+    decode_fields = _compile_typed_fields(cls)
+    return decode
+
+def _compile_typed_sequence(cls):
+    """Compile the typed decoder of a Sequence subclass. Its frames are 
+    [kind, values, value classes, resume, start, interrupted]."""
+    def decode(reader, tag):
+        if tag == 1:
+            return None
+        elif tag != fields.Sequence.tag:
+            raise _typed_mismatch(cls.__name__, tag)
+        return decode_elements(reader, 
+            [_SEQUENCE, [], set(), decode_elements, reader.pos - 1, False])
+    def decode_elements(reader, frame, frames=None):
+        values = frame[1]
+        item = reader.pos
+        try:
+            if frame[5]:
+                try:
+                    values.append(_resume_typed(reader, frames))
+                except TWPError as e:
+                    raise TWPError("%s[%d]: %s" % (cls.__name__, len(values),
+                        e))
+            while True:
+                if ints:
+                    reader._read_int_runs(frame)
+                item = reader.pos
+                tag = reader.read_tag()
+                if tag == 0:
+                    break
+                try:
+                    values.append(decode_element(reader, tag))
+                except TWPError as e:
+                    raise TWPError("%s[%d]: %s" % (cls.__name__, len(values),
+                        e))
+        except NotEnoughBytes:
+            reader._interrupt_typed(item, frame)
+            raise
+        sequence = None
+        if reader._interned is not None:
+            sequence = reader._intern_sequence(frame[4], values)
+        if sequence is not None:
+            values = sequence
+        elif reader.homogeneous_sequences:
+            values = reader._to_array(values, set([value.__class__ 
+                for value in values]))
+        return values
+    _typed_decoders.setdefault(cls, decode)
+    _typed_resumes[cls] = decode_elements
+    element = getattr(cls.type, "ref", cls.type)
+    ints = isinstance(element, fields.Int)
+    decode_element = _typed_decoder(element)
+    return decode
+
+def _compile_typed_union(cls):
+    """Compile the typed decoder of a Union subclass. Its frames are 
+    [kind, None, case, resume, None, interrupted]."""
+    def decode(reader, tag):
+        if tag == 1:
+            return None
+        try:
+            decode_case = cases[tag - 4]
+        except KeyError:
+            raise _typed_mismatch("a case of %s" % cls.__name__, tag)
+        case = tag - 4
+        item = reader.pos
+        try:
+            return case, decode_case(reader, reader.read_tag())
+        except NotEnoughBytes:
+            reader._interrupt_typed(item, 
+                [_UNION, None, case, resume, None, False])
+            raise
+    def resume(reader, frame, frames):
+        case = frame[2]
+        item = reader.pos
+        try:
+            if frame[5]:
+                return case, _resume_typed(reader, frames)
+            return case, cases[case](reader, reader.read_tag())
+        except NotEnoughBytes:
+            reader._interrupt_typed(item, frame)
+            raise
+    cases = {}
+    _typed_decoders.setdefault(cls, decode)
+    _typed_resumes[cls] = resume
+    for case, field in cls.cases.items():
+        cases[case] = _typed_decoder(field)
+    return decode
+
+# Hooks for the decoders that twp.codegen generates. They decode like the 
+# compiled ones above, and hand values interrupted by NotEnoughBytes over to 
+# the compiled resume functions.
+
+def typed_decoder(field):
+    """Returns the typed decoder, decode(reader, tag), for values of the 
+    field definition `field`."""
+    return _typed_decoder(field)
+
+def decode_any_defined_by(reader, tag, field, reference_value):
+    """Decode the value of the AnyDefinedBy field `field` as the protocol 
+    defines it for reference_value."""
+    return _decode_any_defined_by(reader, tag, field, reference_value)
+
+def install_typed_decoders(decoders):
+    """Have read_typed_message() use the typed decoders in decoders, a dict 
+    keyed by class, instead of compiling its own."""
+    _typed_decoders.update(decoders)
+
+def interrupt_typed(reader, start, cls, values, position):
+    """Keep the state of a value of cls whose decoding has been interrupted
+    by NotEnoughBytes, for read_typed_message() to resume. Call this while 
+    the NotEnoughBytes propagates, from the innermost value outwards; start 
+    is where the incomplete tag or primitive value of the innermost one 
+    begins.
+
+    For messages and structs, values are the field values so far and 
+    position is the index of the next field, or None once the extensions 
+    after the fields are read, with the message as values. For sequences, 
+    values are the elements so far and position is that of the sequence 
+    tag. For unions, values is the case and position is None."""
+    resume = _typed_resumes.get(cls)
+    if resume is None:
+        _compile_typed(cls)
+        resume = _typed_resumes[cls]
+    if issubclass(cls, fields.Sequence):
+        frame = [_SEQUENCE, values, set(), resume, position, False]
+    elif issubclass(cls, fields.Union):
+        frame = [_UNION, None, values, resume, None, False]
+    elif issubclass(cls, fields.Struct):
+        frame = [_STRUCT, values, None, resume, position, False]
+    else:
+        frame = [_MESSAGE, values, cls.id, resume, position, False]
+    reader._interrupt_typed(start, frame)
+
+def decode_columns(protocol_class, data, intern_strings=4096,
+        homogeneous_sequences="array"):
+    """Decode the consecutive messages of protocol_class in data into 
+    columns instead of Message instances. Returns a dict with an array of 
+    the message ids as "id", a list of the extensions of each message, or 
+    None, as "extensions", and a column of values for each field name of the
+    protocol's message types. Messages without a field have None in its 
+    column. Columns of only integers or only floats are arrays, like 
+    homogeneous sequences. Strings, and sequences of them as tuples, are 
+    interned in a table of intern_strings entries, so that repeated ones 
+    share one object. The values are checked like by read_typed_message()."""
+    connection = _ColumnsConnection(protocol_class())
+    reader = _RawReader(connection, data, homogeneous_sequences, False,
+        intern_strings)
+    connection.reader = reader
+    protocol = connection.protocol
+    columns = {}
+    for cls in protocol.message_types:
+        for name in cls._fields:
+            columns.setdefault(name, [])
+    ids = array.array("B")
+    extensions = []
+    # For each message tag: how to decode the fields, the appends of their 
+    # columns, and the appends of the columns the message does not have
+    plans = {}
+    while reader.pos < len(reader.buffer):
+        message_tag = reader.read_tag()
+        plan = plans.get(message_tag)
+        if plan is None:
+            if not 4 <= message_tag <= 11:
+                raise TWPError("Expected message tag but saw %d" % message_tag)
+            cls = protocol.message_ids.get(message_tag - 4)
+            if cls is None:
+                raise TWPError("Message not understood: %d" 
+                    % (message_tag - 4))
+            plan = plans[message_tag] = (_compile_typed_fields(cls),
+                [columns[name].append for name in cls._fields],
+                [column.append for name, column in columns.items() 
+                    if name not in cls._fields])
+        decode_fields, appends, missing = plan
+        frame = [_MESSAGE, [], message_tag - 4, None, 0, False]
+        tag = decode_fields(reader, frame)
+        values = frame[1]
+        for append, value in zip(appends, values):
+            append(value)
+        for append in appends[len(values):]:
+            append(None)
+        for append in missing:
+            append(None)
+        message_extensions = None
+        while tag == Extension.tag:
+            if message_extensions is None:
+                message_extensions = []
+            message_extensions.append(reader._read_typed_extension())
+            tag = reader.read_tag()
+        if tag != 0:
+            raise TWPError("Expected extension or EOC but saw %d" % tag)
+        ids.append(message_tag - 4)
+        extensions.append(message_extensions)
+    for name, column in columns.items():
+        columns[name] = reader._to_array(column, 
+            set([value.__class__ for value in column]))
+    columns["id"] = ids
+    columns["extensions"] = extensions
+    return columns
+
+
+class _ColumnsConnection(object):
+    """Stands in for the connection of the messages decode_columns() 
+    decodes, for protocols that read application types themselves."""
+    def __init__(self, protocol):
+        self.protocol = protocol
+        protocol.init_connection(self)
+
+
+class _RawReader(TWPReader):
+    """Decodes values from complete bytes instead of a connection."""
+    def __init__(self, connection, raw, homogeneous_sequences, zero_copy,
+            intern_strings=None):
+        TWPReader.__init__(self, connection, 0, homogeneous_sequences, 
+            zero_copy, intern_strings=intern_strings)
+        self._data = raw
+        self._end = len(raw)
+        self._update_buffer()
+
+    def read_value_at(self, offset):
+        self.pos = offset
+        return self.read_value()
+
+    def read_values(self):
+        values = []
+        while self.pos < len(self.buffer):
+            values.append(self.read_value())
+        return values
+
+    def _read_from_connection(self, size=0):
+        raise ReaderError("Truncated message")
 
 
 class ReaderError(Exception):
@@ -202,3 +1358,6 @@ class ReaderError(Exception):
 
 class NotEnoughBytes(ReaderError):
     pass
+
+class MessageTooLarge(ReaderError):
+    pass
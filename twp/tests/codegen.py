@@ -0,0 +1,244 @@
+import io
+import os
+import types
+import unittest
+from twp import codegen, marshalling, parser, reader
+from twp.error import TWPError
+from twp.protocols import tcp
+from twp.tests.marshalling import calculator_request, marshal_reflective
+from twp.tests.reader import IncrementalTest, reader_for, trickle_reader
+from twp.utils import pack_ip
+
+T = codegen.Type
+
+APPLICATION_TYPES = {"double": "twp.protocols.tcp.Double"}
+
+
+def calculator_specification():
+	"""The definitions of tcp.tdl."""
+	return [codegen.Protocol("Calculator", 5, [
+		codegen.ForwardDef("Term"),
+		codegen.SequenceDef("parameters", T("identifier", "Term")),
+		codegen.StructDef("Expression", None, [
+			codegen.Field(T("primitive", "binary"), "host", False),
+			codegen.Field(T("primitive", "int"), "port", False),
+			codegen.Field(T("identifier", "parameters"), "arguments", False),
+		]),
+		codegen.UnionDef("Term", [
+			codegen.CaseDef(0, T("identifier", "double"), "value"),
+			codegen.CaseDef(1, T("identifier", "Expression"), "expr"),
+		]),
+		codegen.MessageDef("Request", 0, None, [
+			codegen.Field(T("primitive", "int"), "request_id", False),
+			codegen.Field(T("identifier", "parameters"), "arguments", False),
+		]),
+		codegen.MessageDef("Reply", 1, None, [
+			codegen.Field(T("primitive", "int"), "request_id", False),
+			codegen.Field(T("identifier", "double"), "result", False),
+		]),
+		codegen.MessageDef("Error", 2, None, [
+			codegen.Field(T("primitive", "string"), "text", False),
+		]),
+	])]
+
+def generate(specification, application_types=APPLICATION_TYPES):
+	output = io.StringIO()
+	codegen.Generator(specification, output, application_types).generate()
+	return output.getvalue()
+
+def load(source, name="generated"):
+	module = types.ModuleType(name)
+	exec(compile(source, name, "exec"), module.__dict__)
+	return module
+
+def encode(module, value):
+	parts = []
+	module.encoders[value.__class__](value, parts.append)
+	return b"".join(parts)
+
+
+class GeneratedConnection(object):
+	def __init__(self, protocol):
+		self.protocol = protocol
+		self.protocol.init_connection(self)
+
+
+class CalculatorTest(unittest.TestCase):
+	def setUp(self):
+		self.module = load(generate(calculator_specification()))
+
+	def tearDown(self):
+		for cls in self.module.encoders:
+			marshalling._encoders.pop(cls, None)
+		for cls in self.module.decoders:
+			reader._typed_decoders.pop(cls, None)
+			reader._typed_resumes.pop(cls, None)
+
+	def messages(self):
+		m = self.module
+		ip = pack_ip("127.0.0.1")
+		request = m.Request(1, [
+			(0, 42.0),
+			(1, [ip, 9000, [(0, 23.0), (1, [ip, 9001, [(0, 5.0)]])]]),
+			(1, {"host": ip, "port": 2**16}),
+		])
+		request.extensions.append(tcp.ThreadID(9, 1))
+		return [request, m.Request(), m.Reply(1, 736.666), m.Reply(300, -1.5),
+			m.Error("x" * 200)]
+
+	def testEncode(self):
+		for message in self.messages():
+			data = encode(self.module, message)
+			self.assertEqual(data,
+				marshal_reflective(message))
+			self.assertEqual(data, marshalling.marshal(message))
+
+	def testHandWrittenProtocol(self):
+		request = calculator_request()
+		generated = self.module.Request(request.request_id, request.arguments,
+			extensions=request.extensions)
+		self.assertEqual(encode(self.module, generated),
+			marshalling.marshal(request))
+
+	def testDecode(self):
+		for message in self.messages():
+			data = marshalling.marshal(message)
+			r = reader_for(data)
+			decoded = self.module.decoders[message.__class__](r, r.read_tag())
+			self.assertIsInstance(decoded, message.__class__)
+			self.assertEqual(r.remaining_byte_length, 0)
+			self.assertEqual(encode(self.module, decoded), data)
+		typed = reader_for(data).read_typed_message()
+		self.assertEqual(list(decoded._items()), list(typed._items()))
+
+	def testErrors(self):
+		r = reader_for(b"\5\x12xy\0")
+		with self.assertRaisesRegex(TWPError, "Reply.request_id: Expected Int"):
+			self.module.decode_reply(r, r.read_tag())
+		r = reader_for(b"\4\x0d\1\3\6\0\0")
+		with self.assertRaisesRegex(TWPError,
+				"Request.arguments: Parameters\\[0\\]: Expected a case"):
+			self.module.decode_request(r, r.read_tag())
+		r = reader_for(b"\5\x0d\1\1\x0d\2\0")
+		with self.assertRaisesRegex(TWPError, "more values than fields"):
+			self.module.decode_reply(r, r.read_tag())
+
+	def testInstall(self):
+		codegen.install(self.module)
+		self.assertIs(marshalling._get_encoder(self.module.Request),
+			self.module.encode_request)
+		connection = GeneratedConnection(self.module.Calculator())
+		for message in self.messages():
+			data = marshalling.marshal(message)
+			r = reader.TWPReader(connection)
+			connection.reader = r
+			r.replace_processed(data)
+			decoded = r.read_typed_message()
+			self.assertEqual(marshalling.marshal(decoded), data)
+
+	def testInstallFragmented(self):
+		codegen.install(self.module)
+		for message in self.messages():
+			data = marshalling.marshal(message)
+			r = trickle_reader()
+			r.connection.protocol = self.module.Calculator()
+			r.connection.protocol.init_connection(r.connection)
+			decoded = IncrementalTest.readByteByByte(self, r, data,
+				r.read_typed_message)
+			self.assertIsInstance(decoded, message.__class__)
+			self.assertEqual(marshalling.marshal(decoded), data)
+
+
+class GeneratorTest(unittest.TestCase):
+	def testExtensions(self):
+		specification = [
+			codegen.Protocol("Notes", 7, [
+				codegen.StructDef("note_error", 1001, [
+					codegen.Field(T("primitive", "string"), "text", False),
+				]),
+				codegen.MessageDef("Note", 0, None, [
+					codegen.Field(T("primitive", "string"), "kind", False),
+					codegen.Field(T("any defined by", "kind"), "body", True),
+					codegen.Field(T("primitive", "any"), "error", True),
+				]),
+			]),
+			codegen.MessageDef("MessageError", None, 1002, [
+				codegen.Field(T("primitive", "int"), "failed_msg_typs", False),
+				codegen.Field(T("primitive", "string"), "error_text", False),
+			]),
+		]
+		module = load(generate(specification))
+		self.assertEqual(module.Notes.message_types, [module.Note])
+		self.assertEqual(module.Notes.extension_types, [module.NoteError])
+		self.assertNotIn(module.NoteError, module.decoders)
+		values = [
+			module.Note("text", "hello", module.NoteError("failed")),
+			module.Note("number", 5, module.NoteError("")),
+			module.MessageError(3, "Not understood"),
+			module.NoteError("failed"),
+		]
+		for value in values:
+			self.assertEqual(encode(module, value), marshalling.marshal(value))
+		data = marshalling.marshal(values[0])
+		r = reader_for(data)
+		note = module.decode_note(r, r.read_tag())
+		self.assertEqual(note.body, "hello")
+		# Like read_typed_message(), an extension in place of the last field 
+		# is taken as an extension of the message
+		self.assertIsNone(note.error)
+		self.assertEqual(note.get_extension(module.NoteError).text, "failed")
+
+	def testUndefinedTypes(self):
+		specification = [codegen.StructDef("Point", None, [
+			codegen.Field(T("identifier", "double"), "x", False)])]
+		self.assertRaises(ValueError, generate, specification, {})
+		specification = [codegen.Protocol("P", 1, [
+			codegen.ForwardDef("Tree")])]
+		self.assertRaises(ValueError, generate, specification)
+
+	def testApplicationTypeImports(self):
+		application_types = dict(APPLICATION_TYPES, point="missing.Point")
+		source = generate(calculator_specification(), application_types)
+		self.assertIn("import twp.protocols.tcp\n", source)
+		self.assertNotIn("import missing", source)
+		load(source)
+
+	def testNames(self):
+		self.assertEqual(codegen.class_name("list_result"), "ListResult")
+		self.assertEqual(codegen.class_name("RPCException"), "RPCException")
+		self.assertEqual(codegen.function_name("StartExecuting"),
+			"start_executing")
+
+
+class ParsedSpecificationTest(unittest.TestCase):
+	directory = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+		"protocols")
+
+	def parse(self, filename):
+		return parser.parse_file(os.path.join(self.directory, filename))
+
+	def testCalculator(self):
+		self.assertEqual(self.parse("tcp.tdl"), calculator_specification())
+
+	def testProtocols(self):
+		for filename in sorted(os.listdir(self.directory)):
+			if not filename.endswith((".idl", ".tdl")):
+				continue
+			module = load(generate(self.parse(filename)), filename)
+			for cls in module.encoders:
+				if not issubclass(cls, marshalling.Message):
+					continue
+				value = cls()
+				try:
+					data = marshalling.marshal(value)
+				except (ValueError, TWPError):
+					# e.g. a double without a value
+					continue
+				self.assertEqual(encode(module, value), data)
+
+
+def runTests():
+	unittest.main()
+
+if __name__ == "__main__":
+	runTests()
@@ -0,0 +1,82 @@
+import unittest
+import array
+import struct
+from twp import fields
+from twp.error import TWPError
+from twp.tests.reader import reader_for
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class ApplicationTypeTest(unittest.TestCase):
+	def testRegistration(self):
+		with self.assertRaisesRegex(ValueError, "160-255, not 100"):
+			class Low(fields.ApplicationType):
+				tag = 100
+		self.assertNotIn(100, fields.application_types)
+		self.assertRaises(ValueError, type, "High", (fields.ApplicationType,),
+			{"tag": 256})
+		class Abstract(fields.ApplicationType):
+			pass
+		self.assertNotIn(None, fields.application_types)
+		try:
+			class Custom(fields.ApplicationType):
+				tag = 200
+			self.assertIs(fields.application_types[200], Custom)
+		finally:
+			del fields.application_types[200]
+		self.assertIs(fields.application_types[161], fields.PackedArray)
+
+
+class PackedArrayTest(unittest.TestCase):
+	def marshal(self, dtype, value):
+		packed = fields.PackedArray(dtype)
+		packed.value = value
+		return packed.marshal()
+
+	def testRoundTrip(self):
+		values = [
+			("int32", 1, "i", [1, -2, 2**31 - 1]),
+			("int64", 2, "q", [1, -2, 2**63 - 1]),
+			("float64", 3, "d", [1.5, -2.0, 1e300]),
+		]
+		for dtype, code, typecode, value in values:
+			data = self.marshal(dtype, value)
+			body = struct.pack("!B" + typecode * len(value), code, *value)
+			self.assertEqual(data, struct.pack("!BI", 161, len(body)) + body)
+			self.assertEqual(fields.PackedArray.unmarshal(body),
+				array.array(typecode, value))
+			self.assertEqual(self.marshal(dtype, array.array(typecode, value)),
+				data)
+			r = reader_for(data)
+			self.assertEqual(r.read_value(), array.array(typecode, value))
+			self.assertEqual(r.remaining_byte_length, 0)
+
+	@unittest.skipIf(numpy is None, "numpy is not installed")
+	def testNumpy(self):
+		value = numpy.arange(5, dtype="<i8")
+		data = self.marshal("int64", value)
+		self.assertEqual(data, self.marshal("int64", list(range(5))))
+		decoded = fields.PackedArray.unmarshal(data[5:], as_numpy=True)
+		self.assertEqual(decoded.tolist(), list(range(5)))
+
+	def testErrors(self):
+		self.assertRaisesRegex(ValueError, "Unknown dtype int8",
+			fields.PackedArray, "int8")
+		self.assertRaisesRegex(TWPError, "Unknown packed array dtype 9",
+			fields.PackedArray.unmarshal, b"\x09\0\0\0\0")
+		self.assertRaisesRegex(TWPError, "without dtype",
+			fields.PackedArray.unmarshal, b"")
+		self.assertRaisesRegex(TWPError, "length does not match",
+			fields.PackedArray.unmarshal, b"\x02" + b"\0" * 12)
+		self.assertRaises(TWPError, reader_for(b"\xa1\0\0\0\4\3\0\0\0").read_value)
+
+
+def runTests():
+	unittest.main()
+
+if __name__ == "__main__":
+	runTests()
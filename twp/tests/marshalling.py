@@ -0,0 +1,518 @@
+import unittest
+import array
+import copy
+import tempfile
+from twp import fields, marshalling, message
+from twp.cache import LRUCache
+from twp.error import TWPError
+from twp.marshalling import EOC, NO_VAL, _marshal_tag, marshal_extension, \
+	marshal_value
+from twp.message import Extension
+from twp.protocols import echo, fam, tcp
+from twp.utils import pack_ip
+
+# The encoder that marshal_message() used before encoders were compiled per
+# class, kept to check them against
+
+def marshal_reflective(message):
+	"""Marshal a message by inspecting each of its fields."""
+	tag = _marshal_tag(message.tag)
+	values = [_marshal_field(field, value) for field, value 
+		in zip(message.get_fields(), message._values)]
+	extensions = [marshal_extension(ext) for ext in message.extensions]
+	return tag + b"".join(values) + b"".join(extensions) + EOC
+
+def _marshal_field(field, value):
+	field = getattr(field, "ref", field)
+	if field.is_application_type:
+		field = copy.copy(field)
+		field.value = value
+		return field.marshal()
+	elif isinstance(field, fields.Primitive):
+		return marshal_value(value)
+	elif isinstance(field, fields.Struct):
+		return _marshal_struct(field, value)
+	elif isinstance(field, fields.Sequence):
+		return _marshal_sequence(field, value)
+	elif isinstance(field, fields.Union):
+		return _marshal_union(field, value)
+	elif isinstance(field, fields.AnyDefinedBy):
+		return _marshal_any_defined_by(value)
+	elif isinstance(field, Extension):
+		return marshal_extension(value)
+	else:
+		raise ValueError("Not a supported field %s" % field)
+
+def _marshal_struct(complex, value):
+	if value is None:
+		return NO_VAL
+	tag = _marshal_tag(complex.tag)
+	values = [_marshal_field(field, val) for field, val in zip(
+		complex.get_fields(), marshalling._struct_values(complex.__class__, 
+		value))]
+	return tag + b"".join(values) + EOC
+
+def _marshal_sequence(sequence, value):
+	type_field = sequence.type
+	values = []
+	for val in value or []:
+		values.append(_marshal_field(type_field, val))
+	values = b"".join(values)
+	tag = _marshal_tag(sequence.tag)
+	return tag + values + EOC
+
+def _marshal_union(union, value):
+	if value is None:
+		return NO_VAL
+	case, val = value
+	tag = _marshal_tag(4 + case)
+	return tag + _marshal_field(union.cases[case], val)
+
+def _marshal_any_defined_by(val):
+	if isinstance(val, list):
+		tag = _marshal_tag(fields.Struct.tag)
+		return tag + b"".join([marshal_value(v) for v in val]) + EOC
+	else:
+		return marshal_value(val)
+
+
+class Numbers(fields.Sequence):
+	type = fields.Int()
+
+
+class Doubles(fields.Sequence):
+	type = tcp.Double()
+
+
+class Sample(fields.Struct):
+	name = fields.String()
+	data = fields.Binary()
+
+
+class Everything(message.Message):
+	__slots__ = ()
+	id = 3
+	text = fields.String()
+	number = fields.Int()
+	data = fields.Binary()
+	numbers = Numbers()
+	doubles = Doubles()
+	sample = Sample()
+	term = tcp.Term()
+
+
+def calculator_request():
+	ip = pack_ip("127.0.0.1")
+	request = tcp.Request()
+	request.request_id = 1
+	request.arguments = [
+		(0, 42.0),
+		(1, [ip, 9000, [(0, 23.0), (1, [ip, 9001, [(0, 5.0)]])]]),
+	]
+	request.extensions.append(tcp.ThreadID(9, 1))
+	return request
+
+
+class CompiledEncoderTest(unittest.TestCase):
+	def testMatchesReflective(self):
+		messages = [
+			echo.Request("Hello, World!"),
+			echo.Response("x" * 300, 70000),
+			echo.Request(),
+			fam.Changed(["home", "user"], "fam.py"),
+			tcp.Reply(1, 2.5),
+			calculator_request(),
+			Everything("text", 300, b"x" * 300, [1, 300, 70000], [1.0, 2.0],
+				["name", b"data"], (1, ["", None, [(0, 1.0)]])),
+			Everything(sample={"name": "only the name"}, numbers=[]),
+		]
+		for m in messages:
+			self.assertEqual(marshalling.marshal(m), marshal_reflective(m))
+
+
+class MarshalManyTest(unittest.TestCase):
+	def assertMarshalsLike(self, rows, messages):
+		self.assertEqual(marshalling.marshal_many(echo.Response, rows),
+			b"".join([marshalling.marshal(m) for m in messages]))
+
+	def testRows(self):
+		self.assertMarshalsLike([("a", 1), ("b" * 300, 70000)],
+			[echo.Response("a", 1), echo.Response("b" * 300, 70000)])
+		self.assertMarshalsLike([{"number_of_letters": 5, "text": "x"}, {}],
+			[echo.Response("x", 5), echo.Response()])
+		# Missing values are sent as No Value
+		self.assertMarshalsLike([("a",), ()],
+			[echo.Response("a"), echo.Response()])
+		self.assertMarshalsLike([], [])
+		everything = Everything("text", 300, b"x" * 300, [1, 300], [1.0],
+			["name", b"data"], (1, ["", None, [(0, 1.0)]]))
+		self.assertEqual(marshalling.marshal_many(Everything,
+			[[value for name, value in everything._items()]]),
+			marshalling.marshal(everything))
+
+	def testErrors(self):
+		with self.assertRaisesRegex(ValueError, "Too many values"):
+			marshalling.marshal_many(echo.Response, [("a", 1, 2)])
+		with self.assertRaisesRegex(ValueError, "Unknown field name: txt"):
+			marshalling.marshal_many(echo.Response, [{"txt": "a"}])
+
+
+class MarshalStreamTest(unittest.TestCase):
+	def testGenerator(self):
+		consumed = []
+		def numbers():
+			for i in range(1000):
+				consumed.append(i)
+				yield i
+		chunks = []
+		progress = []
+		def send(chunk):
+			chunks.append(chunk)
+			progress.append(len(consumed))
+		message = Everything("x" * 300, numbers=numbers())
+		marshalling.marshal_stream(message, send, chunk_size=100)
+		self.assertEqual(b"".join(chunks),
+			marshalling.marshal(Everything("x" * 300, numbers=range(1000))))
+		# Chunks are sent while the generator is consumed
+		self.assertLess(progress[len(progress) // 2], 1000)
+		# Pieces larger than chunk_size are sent as they are
+		self.assertEqual(chunks[1], b"x" * 300)
+		self.assertTrue(all(len(chunk) < 200 for chunk in chunks[2:]))
+
+
+class PackTest(unittest.TestCase):
+	def pack(self, pack, values):
+		parts = []
+		self.assertTrue(pack(values, parts.append))
+		return b"".join(parts)
+
+	def encodeEach(self, field, values):
+		parts = []
+		encode = marshalling._field_encoder(field)
+		for value in values:
+			encode(value, parts.append)
+		return b"".join(parts)
+
+	def testInts(self):
+		runs = [
+			[],
+			[0, 1, 255],
+			[256, 70000, 2**32 - 1],
+			[1, 256, 2, 3, 70000, 255, 256],
+			[300] + [1] * 10 + [2**31] * 10,
+		]
+		for values in runs:
+			expected = self.encodeEach(fields.Int(), values)
+			for typecode in "BhiLqQ":
+				try:
+					values_array = array.array(typecode, values)
+				except OverflowError:
+					continue
+				self.assertEqual(self.pack(marshalling._pack_ints, values_array),
+					expected)
+
+	def testIntsOutOfBounds(self):
+		for values in [array.array("q", [1, -1]), array.array("Q", [2**32]),
+				array.array("q", [2**40, 5])]:
+			self.assertRaisesRegex(ValueError, "out of bounds",
+				marshalling._pack_ints, values, [].append)
+		everything = Everything(numbers=array.array("i", [5, -3]))
+		self.assertRaises(ValueError, marshalling.marshal, everything)
+
+	def testFixedSize(self):
+		pack = marshalling._fixed_size_packer(tcp.Double())
+		for typecode, values in [("d", [0.5, -1.25, 1e300]), ("f", [0.5, 2.0]),
+				("i", [1, -2, 3]), ("d", [])]:
+			self.assertEqual(self.pack(pack, array.array(typecode, values)),
+				self.encodeEach(tcp.Double(), values))
+
+	def testUnsupportedTypecodes(self):
+		parts = []
+		self.assertFalse(marshalling._pack_ints(array.array("d", [1.0]),
+			parts.append))
+		self.assertFalse(marshalling._pack_ints(array.array("u", "ab"),
+			parts.append))
+		pack = marshalling._fixed_size_packer(tcp.Double())
+		self.assertFalse(pack(array.array("u", "ab"), parts.append))
+		self.assertEqual(parts, [])
+		# Sequences of them are encoded element by element instead
+		with self.assertRaisesRegex(TWPError, "Failed to encode Double from a"):
+			marshalling.marshal(Everything(doubles=array.array("u", "ab")))
+
+	@unittest.skipIf(marshalling.numpy is None, "numpy is not installed")
+	def testNumpy(self):
+		numpy = marshalling.numpy
+		values = [1, 256, 2, 70000]
+		self.assertEqual(self.pack(marshalling._pack_ints,
+			numpy.array(values, dtype="u4")),
+			self.encodeEach(fields.Int(), values))
+		self.assertFalse(marshalling._pack_ints(numpy.array([1.0]), [].append))
+		self.assertRaises(ValueError, marshalling._pack_ints,
+			numpy.array([-1]), [].append)
+		pack = marshalling._fixed_size_packer(tcp.Double())
+		self.assertEqual(self.pack(pack, numpy.array([0.5, 2.0])),
+			self.encodeEach(tcp.Double(), [0.5, 2.0]))
+
+
+class Point(fields.Struct):
+	x = fields.Int()
+
+
+class Points(fields.Sequence):
+	type = Point()
+
+
+class Names(fields.Sequence):
+	type = fields.String()
+
+
+class Shape(message.Message):
+	id = 4
+	name = fields.String()
+	names = Names()
+	points = Points()
+
+
+class Origin(message.Extension):
+	registered_id = 2001
+	point = Point()
+
+
+class LRUCacheTest(unittest.TestCase):
+	def testCounters(self):
+		cache = LRUCache(maxsize=2)
+		self.assertIsNone(cache.get("a"))
+		cache.put("a", b"1")
+		self.assertEqual(cache.get("a"), b"1")
+		self.assertEqual(cache.get("b", b"default"), b"default")
+		stats = cache.stats()
+		self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+		self.assertEqual(cache.hit_rate, 1 / 3)
+		self.assertEqual(LRUCache().hit_rate, 0.0)
+
+	def testEviction(self):
+		cache = LRUCache(maxsize=2)
+		cache.put("a", b"1")
+		cache.put("b", b"2")
+		cache.get("a")
+		cache.put("c", b"3")
+		# b is the least recently used
+		self.assertEqual((sorted(cache._entries), cache.evictions),
+			(["a", "c"], 1))
+		cache.put("a", b"11")
+		self.assertEqual((len(cache), cache.size), (2, 3))
+		cache.clear()
+		self.assertEqual((len(cache), cache.size, cache.evictions), (0, 0, 1))
+
+	def testMaxBytes(self):
+		cache = LRUCache(maxsize=10, maxbytes=5)
+		cache.put("a", b"123")
+		cache.put("b", b"45")
+		self.assertEqual(cache.size, 5)
+		cache.put("c", b"6")
+		self.assertNotIn("a", cache)
+		self.assertEqual((cache.size, cache.evictions), (3, 1))
+		# Larger than all of the cache
+		cache.put("d", b"123456")
+		self.assertNotIn("d", cache)
+		self.assertEqual(len(cache), 2)
+
+
+class MarshalCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.cache = marshalling.enable_cache(LRUCache(), max_value_size=100)
+
+	def tearDown(self):
+		marshalling.disable_cache()
+
+	def testHits(self):
+		shape = Shape("square", ("a", "b"), [])
+		data = marshalling.marshal(shape)
+		# The name, the tuple, and its elements
+		self.assertEqual((self.cache.hits, self.cache.misses), (0, 4))
+		self.assertEqual(marshalling.marshal(shape), data)
+		self.assertEqual((self.cache.hits, self.cache.misses), (2, 4))
+		thread_id = tcp.ThreadID(9, 1)
+		for i in range(2):
+			self.assertEqual(marshalling.marshal(thread_id), b"\x0c\0\0\0\x2a"
+				b"\x0d\x09\x0d\x01\0")
+		self.assertEqual((self.cache.hits, self.cache.misses), (3, 5))
+		marshalling.disable_cache()
+		self.assertEqual(marshalling.marshal(shape), data)
+
+	def assertOnlyImmutableKeys(self):
+		for encoder, value in self.cache._entries:
+			self.assertTrue(marshalling._cacheable(value), value)
+
+	def testMutableValues(self):
+		point = Point(1)
+		shape = Shape("a", ["x"], (point,))
+		marshalling.marshal(shape)
+		point["x"] = 2
+		self.assertEqual(marshalling.marshal(shape),
+			b"\x08\x12a\x03\x12x\0\x03\x02\x0d\x02\0\0\0")
+		origin = Origin(point)
+		marshalling.marshal(origin)
+		point["x"] = 3
+		self.assertEqual(marshalling.marshal(origin),
+			b"\x0c\0\0\x07\xd1\x02\x0d\x03\0\0")
+		self.assertOnlyImmutableKeys()
+
+	def testNotCached(self):
+		for value in [("a", 1.5), ("a", True), ("a", ["b"]), ("a", None),
+				"x" * 101]:
+			self.assertFalse(marshalling._cacheable(value))
+		for value in ["a", 1, b"a", ("a", (1, b"a")), "x" * 100]:
+			self.assertTrue(marshalling._cacheable(value))
+		names = ("y" * 60, "z" * 60)
+		shape = Shape("x" * 101, names)
+		for i in range(2):
+			marshalling.marshal(shape)
+		# Only the elements are short enough
+		self.assertEqual(sorted([value for encoder, value in
+			self.cache._entries]), list(names))
+		self.assertEqual(self.cache.hits, 2)
+
+
+class MarshalledSizeTest(unittest.TestCase):
+	def assertSizeMatches(self, value):
+		self.assertEqual(marshalling.marshalled_size(value),
+			len(marshalling.marshal(value)))
+
+	def testPrimitives(self):
+		values = [
+			None, 0, 255, 256, 2**32-1, True,
+			"", "a" * fields.String.MAX_SHORT_LENGTH,
+			"a" * (fields.String.MAX_SHORT_LENGTH + 1), "ä" * 60,
+			b"", b"x" * 255, b"x" * 256,
+		]
+		for value in values:
+			self.assertSizeMatches(value)
+
+	def testMessages(self):
+		messages = [
+			echo.Request("Hello, World!"),
+			echo.Response("x" * 300, 70000),
+			echo.Request(),
+			fam.Changed(["home", "user"], "fam.py"),
+			fam.Deleted(("home",), "ä" * 100),
+			tcp.Reply(1, 2.5),
+			tcp.Error(None),
+			calculator_request(),
+		]
+		for m in messages:
+			self.assertSizeMatches(m)
+
+	def testStructuredFields(self):
+		everything = Everything("text", 300, b"x" * 300, [1, 300, 70000],
+			[1.0, 2.0], ["name", b"data"], (1, ["", None, [(0, 1.0)]]))
+		self.assertSizeMatches(everything)
+		everything.sample = {"name": "only the name"}
+		everything.term = None
+		everything.numbers = None
+		self.assertSizeMatches(everything)
+
+	def testApplicationTypes(self):
+		class Samples(message.Message):
+			id = 4
+			counts = fields.PackedArray("int32")
+			values = fields.PackedArray("float64")
+		samples = [
+			Samples([], []),
+			Samples([1, 2, 3], array.array("d", [0.5] * 10)),
+			Samples(array.array("i", range(1000)), [1.0]),
+		]
+		for m in samples:
+			self.assertSizeMatches(m)
+		# The dtype byte and the elements
+		self.assertEqual(fields.PackedArray("int64").value_size([1, 2, 3]), 25)
+
+	def testArrays(self):
+		everything = Everything(
+			numbers=array.array("q", [1, 255, 256, 2**32-1]),
+			doubles=array.array("d", [0.5] * 10))
+		self.assertSizeMatches(everything)
+		everything.numbers = array.array("B")
+		everything.doubles = array.array("i", [1, 2, 3])
+		self.assertSizeMatches(everything)
+
+	def testOutOfBounds(self):
+		self.assertRaises(ValueError, marshalling.marshalled_size, -1)
+		everything = Everything(numbers=array.array("q", [2**32]))
+		self.assertRaises(ValueError, marshalling.marshalled_size, everything)
+
+
+class MessageTest(unittest.TestCase):
+	def testValues(self):
+		everything = Everything("text", sample={"name": "n"}, 
+			term=(1, [b"ip", 1, []]))
+		self.assertFalse(hasattr(everything, "__dict__"))
+		self.assertEqual(everything.text, "text")
+		self.assertIsNone(everything.number)
+		self.assertIsInstance(everything.sample, Sample)
+		self.assertEqual(everything.sample["name"], "n")
+		self.assertIsInstance(everything.term[1], tcp.Expression)
+		self.assertEqual(everything.term[1]["host"], b"ip")
+		self.assertRaises(ValueError, setattr, everything, "term", (5, 1))
+		self.assertRaises(AttributeError, setattr, everything, "missing", 1)
+		self.assertRaises(KeyError, everything.sample.__getitem__, "missing")
+		# Without __slots__, messages take other attributes
+		request = echo.Request("text")
+		request.received = 1
+		self.assertEqual((request.received, request.text), (1, "text"))
+		self.assertEqual(marshalling.marshal(request), 
+			marshalling.marshal(echo.Request("text")))
+
+	def testSharedDefinitions(self):
+		first, second = Everything("a"), Everything("b")
+		self.assertEqual((first.text, second.text), ("a", "b"))
+		self.assertIs(first._fields, second._fields)
+		self.assertIsNone(Everything._fields["text"].value)
+
+
+class FileRegionTest(unittest.TestCase):
+	def setUp(self):
+		self.file = tempfile.TemporaryFile()
+		self.file.write(bytes(range(256)) * 10)
+
+	def tearDown(self):
+		self.file.close()
+
+	def testMarshalsLikeBytes(self):
+		for offset, length in [(0, None), (10, 20), (100, 256), (0, 0)]:
+			region = fields.FileRegion(self.file, offset, length)
+			data = bytes(region)
+			self.assertEqual(marshalling.marshal(Everything(data=region)),
+				marshalling.marshal(Everything(data=data)))
+			self.assertEqual(marshalling.marshal(region), 
+				marshalling.marshal(data))
+			self.assertEqual(marshalling.marshalled_size(Everything(data=region)),
+				len(marshalling.marshal(Everything(data=data))))
+
+	def testBuffersKeepRegion(self):
+		region = fields.FileRegion(self.file, 256)
+		self.assertEqual(len(region), 2304)
+		buffers = marshalling.marshal_buffers(Everything(data=region))
+		self.assertIn(region, buffers)
+		self.assertEqual(marshalling.join_buffers(buffers),
+			marshalling.marshal(Everything(data=bytes(region))))
+
+	def testStream(self):
+		region = fields.FileRegion(self.file, 3)
+		message = Everything(data=region)
+		chunks = []
+		marshalling.marshal_stream(message, chunks.append, chunk_size=100)
+		self.assertEqual(b"".join(chunks), marshalling.marshal(message))
+		self.assertEqual(marshalling.marshal_into(message, bytearray()),
+			marshalling.marshal(message))
+
+	def testShortFile(self):
+		region = fields.FileRegion(self.file, 2500, 200)
+		self.assertRaises(ValueError, marshalling.marshal, region)
+
+
+def runTests():
+	unittest.main()
+
+if __name__ == "__main__":
+	runTests()
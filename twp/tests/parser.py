@@ -0,0 +1,189 @@
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+from twp import codegen, parser
+from twp.parser import ParseError
+
+T = codegen.Type
+
+
+class TokenizeTest(unittest.TestCase):
+	def kinds(self, text):
+		return [token[0] for token in parser.tokenize(text)]
+
+	def testTokens(self):
+		self.assertEqual(parser.tokenize("message Foo=ID 17{"), [
+			("message", "message", 1, 1),
+			("identifier", "Foo", 1, 9),
+			("=", "=", 1, 12),
+			("ID", "ID", 1, 13),
+			("number", "17", 1, 16),
+			("{", "{", 1, 18),
+			("end", "", 1, 19),
+		])
+
+	def testComments(self):
+		text = ("struct /* a\nmulti-line */ A = ID 1 { // the fields\n"
+			"  int x; /* one */ int y; /* two */\n}")
+		self.assertEqual(self.kinds(text), ["struct", "identifier", "=", "ID",
+			"number", "{", "int", "identifier", ";", "int", "identifier", ";",
+			"}", "end"])
+		self.assertEqual(parser.tokenize(text)[6][2:], (3, 3))
+		self.assertEqual(self.kinds("// only a comment"), ["end"])
+
+	def testErrors(self):
+		self.assertRaisesRegex(ParseError, "1:5: unterminated comment",
+			parser.tokenize, "int /* x")
+		self.assertRaisesRegex(ParseError, "2:3: unexpected character '-'",
+			parser.tokenize, "a\nb -1")
+
+
+class ParseTest(unittest.TestCase):
+	def testDefinitions(self):
+		text = """
+		protocol P = ID 9 {
+			typedef Tree;
+			sequence<Tree> forest;
+			struct Tree {
+				string label;
+				optional forest children;
+			}
+			union Node { case 0: int leaf; case 7: Tree tree; }
+			message Grow = 0 {
+				any defined by kind value;
+				any extra;
+				int any_count;
+			}
+			message Empty = 1 {}
+		}
+		message Ping = ID 100 { binary data; }
+		struct Note = ID 101 { string text; }
+		"""
+		self.assertEqual(parser.parse(text), [
+			codegen.Protocol("P", 9, [
+				codegen.ForwardDef("Tree"),
+				codegen.SequenceDef("forest", T("identifier", "Tree")),
+				codegen.StructDef("Tree", None, [
+					codegen.Field(T("primitive", "string"), "label", False),
+					codegen.Field(T("identifier", "forest"), "children", True),
+				]),
+				codegen.UnionDef("Node", [
+					codegen.CaseDef(0, T("primitive", "int"), "leaf"),
+					codegen.CaseDef(7, T("identifier", "Tree"), "tree"),
+				]),
+				codegen.MessageDef("Grow", 0, None, [
+					codegen.Field(T("any defined by", "kind"), "value", False),
+					codegen.Field(T("primitive", "any"), "extra", False),
+					codegen.Field(T("primitive", "int"), "any_count", False),
+				]),
+				codegen.MessageDef("Empty", 1, None, []),
+			]),
+			codegen.MessageDef("Ping", None, 100, [
+				codegen.Field(T("primitive", "binary"), "data", False),
+			]),
+			codegen.StructDef("Note", 101, [
+				codegen.Field(T("primitive", "string"), "text", False),
+			]),
+		])
+
+	def testErrors(self):
+		errors = [
+			("protocol P = 1 {}", "1:14: expected 'ID' but found '1'"),
+			("message M = 8 {}", "expected a message number 0-7 or ID"),
+			("message M = 07 {}", "expected a message number 0-7 or ID"),
+			("struct S { int x; }", "top-level struct S needs an ID"),
+			("struct S = ID 1 {}", "expected a type but found '}'"),
+			("message M = 0 { int message; }",
+				"expected an identifier but found 'message'"),
+			("protocol P = ID 1 { union U { } }", "expected 'case' or '}'"),
+			("protocol P = ID 1 {", "expected a type definition, message or "
+				"'}' but found end of input"),
+			("sequence<int> s;", "expected protocol, message or struct"),
+		]
+		for text, message in errors:
+			with self.assertRaisesRegex(ParseError, message):
+				parser.parse(text, "test.tdl")
+
+
+class CompileTest(unittest.TestCase):
+	directory = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+		"protocols")
+
+	def setUp(self):
+		self.temporary = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.temporary)
+
+	def path(self, filename):
+		return os.path.join(self.directory, filename)
+
+	def testCache(self):
+		cache_dir = os.path.join(self.temporary, "cache")
+		specification = parser.parse_file(self.path("fam.idl"), cache_dir)
+		self.assertEqual(specification, parser.parse_file(self.path("fam.idl")))
+		cached, = os.listdir(cache_dir)
+		# Loaded from the cache, not parsed again
+		with open(os.path.join(cache_dir, cached), "wb") as f:
+			pickle.dump(["cached"], f)
+		self.assertEqual(parser.parse_file(self.path("fam.idl"), cache_dir),
+			["cached"])
+		parser.parse_file(self.path("echo.idl"), cache_dir)
+		self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+	def testBrokenCache(self):
+		cache_dir = os.path.join(self.temporary, "cache")
+		specification = parser.parse_file(self.path("fam.idl"), cache_dir)
+		cached = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+		# Truncated or garbled files are parsed again and replaced
+		for data in [b"", b"garbage", pickle.dumps(specification)[:-10]]:
+			with open(cached, "wb") as f:
+				f.write(data)
+			self.assertEqual(parser.parse_file(self.path("fam.idl"), 
+				cache_dir), specification)
+			with open(cached, "rb") as f:
+				self.assertEqual(pickle.load(f), specification)
+		# No temporary file is left behind when writing the cache fails
+		dump = pickle.dump
+		def fail(*args):
+			raise pickle.PicklingError("Cannot pickle")
+		pickle.dump = fail
+		try:
+			self.assertRaises(pickle.PicklingError, parser.parse_file,
+				self.path("echo.idl"), cache_dir)
+		finally:
+			pickle.dump = dump
+		self.assertEqual(os.listdir(cache_dir), [os.path.basename(cached)])
+
+	def testCompileFiles(self):
+		paths = [self.path(filename) for filename in ["echo.idl", "fam.idl",
+			"rpc.idl", "tcp.tdl", "tfs.idl"]]
+		outputs = parser.compile_files(paths, self.temporary,
+			{"double": "twp.protocols.tcp.Double"}, jobs=2)
+		self.assertEqual([os.path.basename(output) for output in outputs],
+			["echo.py", "fam.py", "rpc.py", "tcp.py", "tfs.py"])
+		for path, output in zip(paths, outputs):
+			with open(output) as f:
+				self.assertEqual(f.read(), parser.compile_file(path, None,
+					{"double": "twp.protocols.tcp.Double"}))
+
+	def testMain(self):
+		output = os.path.join(self.temporary, "echo.py")
+		self.assertEqual(parser.main([self.path("echo.idl"), output]), 0)
+		self.assertTrue(os.path.exists(output))
+		stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+		try:
+			self.assertEqual(parser.main([self.path("tcp.tdl"), output]), 1)
+		finally:
+			sys.stderr.close()
+			sys.stderr = stderr
+
+
+def runTests():
+	unittest.main()
+
+if __name__ == "__main__":
+	runTests()
@@ -0,0 +1,279 @@
+import unittest
+import array
+import asyncore
+import socket
+import tempfile
+from twp import compression, fields, marshalling, protocol, reader
+from twp.error import TWPError
+from twp.protocols import echo, tcp
+from twp.tests.marshalling import Everything, calculator_request
+from twp.tests.reader import EverythingProtocol
+
+
+class ShortWriteSocket(object):
+	"""A socket whose sendmsg() takes at most max_write bytes per call."""
+	def __init__(self, max_write):
+		self.max_write = max_write
+		self.data = bytearray()
+		self.calls = []
+
+	def sendmsg(self, buffers):
+		self.calls.append(len(buffers))
+		if len(buffers) > protocol.IOV_MAX:
+			raise OSError("Too many buffers")
+		sent = 0
+		for buffer in buffers:
+			chunk = bytes(buffer)[:self.max_write - sent]
+			self.data += chunk
+			sent += len(chunk)
+		return sent
+
+	def sendall(self, data):
+		self.data += data
+
+	def sendfile(self, file, offset, count):
+		file.seek(offset)
+		data = file.read(count)
+		self.data += data
+		return len(data)
+
+
+def client(sock):
+	"""A TWPClient on sock, without connecting it."""
+	c = protocol.TWPClient.__new__(protocol.TWPClient)
+	c.socket = sock
+	return c
+
+
+class SendBuffersTest(unittest.TestCase):
+	def setUp(self):
+		self.iov_max = protocol.IOV_MAX
+
+	def tearDown(self):
+		protocol.IOV_MAX = self.iov_max
+
+	def testShortWrites(self):
+		buffers = [bytes([i]) * i for i in range(1, 30)]
+		for max_write in [1, 7, 100, 1000]:
+			sock = ShortWriteSocket(max_write)
+			client(sock).send_buffers(list(buffers))
+			self.assertEqual(sock.data, b"".join(buffers))
+
+	def testIOVMax(self):
+		protocol.IOV_MAX = 4
+		buffers = [bytes([i]) * 3 for i in range(10)]
+		sock = ShortWriteSocket(5)
+		client(sock).send_buffers(list(buffers))
+		self.assertEqual(sock.data, b"".join(buffers))
+		self.assertLessEqual(max(sock.calls), 4)
+		sock = ShortWriteSocket(1000)
+		client(sock).send_buffers(list(buffers))
+		self.assertEqual(sock.calls, [4, 4, 2])
+
+	def testFileRegions(self):
+		with tempfile.TemporaryFile() as f:
+			f.write(bytes(range(256)) * 4)
+			message = Everything("x" * 300, data=fields.FileRegion(f, 10, 500))
+			buffers = marshalling.marshal_buffers(message)
+			buffers += marshalling.marshal_buffers(echo.Request("y" * 100))
+			self.assertIn(message.data, buffers)
+			expected = marshalling.join_buffers(buffers)
+			sock = ShortWriteSocket(7)
+			client(sock).send_buffers(buffers)
+			self.assertEqual(sock.data, expected)
+			sock = ShortWriteSocket(7)
+			buffers = [b"\x10\0\0\0\x64", fields.FileRegion(f, 1000, 100)]
+			self.assertRaises(TWPError, client(sock).send_buffers, buffers)
+
+
+class RecordingConnection(protocol.Connection):
+	"""A connection that keeps what it sends, and receives what has been fed 
+	to it."""
+	protocol_class = echo.EchoProtocol
+
+	def __init__(self):
+		protocol.Connection.__init__(self)
+		self.sent = bytearray()
+		self.pending = bytearray()
+
+	def send(self, data):
+		self.sent += data
+
+	def feed(self, *values):
+		for value in values:
+			self.pending += marshalling.marshal(value)
+
+	def recv(self, size):
+		if not self.pending:
+			raise BlockingIOError()
+		data = bytes(self.pending[:size])
+		del self.pending[:size]
+		return data
+
+
+class SendManyTest(unittest.TestCase):
+	def testSendMany(self):
+		connection = RecordingConnection()
+		connection.send_many(echo.Response, [("a", 1), {"text": "b"}, ()])
+		self.assertEqual(connection.sent, b"".join([marshalling.marshal(m)
+			for m in [echo.Response("a", 1), echo.Response("b"),
+			echo.Response()]]))
+		self.assertRaises(ValueError, connection.send_many, echo.Response,
+			[{"txt": "a"}])
+
+	def testSendStream(self):
+		connection = RecordingConnection()
+		message = Everything(numbers=(i * 1000 for i in range(100)))
+		connection.send_twp_stream(message, chunk_size=64)
+		self.assertEqual(connection.sent, marshalling.marshal(
+			Everything(numbers=[i * 1000 for i in range(100)])))
+
+
+class AsyncClientTest(unittest.TestCase):
+	def testHandleRead(self):
+		sock, peer = socket.socketpair()
+		self.addCleanup(peer.close)
+		received = []
+		c = protocol.TWPClientAsync.__new__(protocol.TWPClientAsync)
+		asyncore.dispatcher_with_send.__init__(c, sock)
+		self.addCleanup(c.close)
+		c.protocol_class = echo.EchoProtocol
+		protocol.Connection.__init__(c)
+		c.message_handler_func = lambda message, client: received.append(
+			message.text)
+		# All messages of a read event are handled, not only the first
+		peer.sendall(marshalling.marshal(echo.Request("a")) + 
+			marshalling.marshal(echo.Request("b")) + b"\4")
+		c.handle_read()
+		self.assertEqual(received, ["a", "b"])
+		peer.sendall(b"\x11\0")
+		c.handle_read()
+		self.assertEqual(received, ["a", "b", ""])
+
+
+class OperatorTest(unittest.TestCase):
+	def testLogRequest(self):
+		# There is no logging protocol to log requests with
+		operator = tcp.OperatorImplementation.__new__(tcp.OperatorImplementation)
+		operator.name = "mk 127.0.0.1 5000"
+		operator.log_request(calculator_request())
+
+
+class ReadMessageTest(unittest.TestCase):
+	def testZeroCopyPins(self):
+		connection = RecordingConnection()
+		connection.reader.zero_copy = True
+		connection.feed(echo.Request("Hello"))
+		self.assertEqual(connection.read_message().text, "Hello")
+		# Built messages do not refer to the raw bytes
+		self.assertEqual(connection.reader._pins, [])
+		connection.lazy_messages = True
+		connection.feed(echo.Request("Hello"))
+		message = connection.read_message()
+		self.assertEqual(connection.reader._pins, [message.raw])
+		self.assertEqual(message.text, "Hello")
+
+	def testHomogeneousSequences(self):
+		class ArrayConnection(RecordingConnection):
+			protocol_class = EverythingProtocol
+			homogeneous_sequences = "array"
+		connection = ArrayConnection()
+		connection.feed(Everything(numbers=[1, 2, 3]))
+		self.assertEqual(connection.read_message().numbers, 
+			array.array("q", [1, 2, 3]))
+
+
+class CompressingConnection(RecordingConnection):
+	compression_threshold = 100
+
+
+class CompressionTest(unittest.TestCase):
+	def sendRequests(self, connection):
+		"""Send a small and a large request and return whether each was 
+		compressed."""
+		compressed = []
+		for request in [echo.Request("x"), echo.Request("x" * 200)]:
+			del connection.sent[:]
+			connection.send_twp(request)
+			compressed.append(connection.sent[0] == 12)
+			if compressed[-1]:
+				other = CompressingConnection()
+				other.pending = connection.sent
+				self.assertEqual(other.read_message().text, request.text)
+		return compressed
+
+	def testOfferAccepted(self):
+		connection = CompressingConnection()
+		connection.offer_compression()
+		self.assertEqual(connection.sent, marshalling.marshal(
+			compression.Compression(compression.ZLIB)))
+		self.assertEqual(self.sendRequests(connection), [False, False])
+		connection.feed(compression.Compression(compression.ZLIB),
+			echo.Response("y"))
+		self.assertEqual(connection.read_message().text, "y")
+		self.assertTrue(connection.compress)
+		self.assertEqual(self.sendRequests(connection), [False, True])
+
+	def testOfferDeclined(self):
+		connection = CompressingConnection()
+		connection.offer_compression()
+		connection.feed(compression.Compression(""), echo.Response("y"))
+		self.assertEqual(connection.read_message().text, "y")
+		self.assertFalse(connection.compress)
+		self.assertEqual(self.sendRequests(connection), [False, False])
+
+	def testAccept(self):
+		connection = CompressingConnection()
+		connection.feed(compression.Compression(compression.ZLIB))
+		self.assertRaises(reader.NotEnoughBytes, connection.read_message)
+		self.assertEqual(connection.sent, marshalling.marshal(
+			compression.Compression(compression.ZLIB)))
+		self.assertTrue(connection.compress)
+
+	def testDecline(self):
+		for connection, algorithm in [(RecordingConnection(), compression.ZLIB),
+				(CompressingConnection(), "lz4")]:
+			connection.feed(compression.Compression(algorithm))
+			self.assertRaises(reader.NotEnoughBytes, connection.read_message)
+			self.assertEqual(connection.sent, marshalling.marshal(
+				compression.Compression("")))
+			self.assertFalse(connection.compress)
+
+	def testPeerWithoutCompression(self):
+		# The peer never answers our offer
+		connection = CompressingConnection()
+		connection.offer_compression()
+		connection.feed(echo.Response("y"))
+		self.assertEqual(connection.read_message().text, "y")
+		self.assertFalse(connection.compress)
+		self.assertEqual(self.sendRequests(connection), [False, False])
+
+	def testClientDoesNotWait(self):
+		sock = ShortWriteSocket(1000)
+		c = client(sock)
+		c.protocol_class = echo.EchoProtocol
+		c.compression_threshold = 100
+		protocol.Connection.__init__(c)
+		c._init_session()
+		self.assertTrue(sock.data.endswith(marshalling.marshal(
+			compression.Compression(compression.ZLIB))))
+
+	def testDecompressLimit(self):
+		def received(data):
+			connection = RecordingConnection()
+			connection.feed(compression.compress(data))
+			return connection.reader.read_extension()
+		bomb = received(b"\0" * (compression.DEFAULT_MAX_SIZE + 1))
+		self.assertLess(len(bomb.values[0]), 2**20)
+		self.assertRaisesRegex(TWPError, "exceeds", compression.decompress,
+			bomb)
+		self.assertRaisesRegex(TWPError, "exceeds 100 bytes",
+			compression.decompress, received(b"x" * 101), 100)
+		self.assertEqual(compression.decompress(received(b"x" * 100), 100),
+			b"x" * 100)
+
+def runTests():
+	unittest.main()
+
+if __name__ == "__main__":
+	runTests()
@@ -0,0 +1,1075 @@
+import unittest
+import array
+import socket
+import threading
+from twp import compression, fields, marshalling, protocol, reader
+from twp.error import TWPError, EndOfContent
+from twp.message import Extension, LazyMessage, Message, MessagePool, \
+	UnknownExtension, registered_extensions
+from twp.protocols import echo, fam, tcp
+from twp.tests.marshalling import Everything, Sample, calculator_request
+
+
+class Connection(object):
+	"""A connection that has nothing more to receive."""
+	def __init__(self):
+		self.protocol = tcp.CalculatorProtocol()
+		self.protocol.init_connection(self)
+
+	def recv(self, size):
+		raise BlockingIOError()
+
+
+def reader_for(data, **kwargs):
+	connection = Connection()
+	r = reader.TWPReader(connection, **kwargs)
+	connection.reader = r
+	r.replace_processed(data)
+	return r
+
+
+class DecodeTest(unittest.TestCase):
+	def assertDecodes(self, data, expected, **kwargs):
+		r = reader_for(data, **kwargs)
+		self.assertEqual(r.read_value(), expected)
+		self.assertEqual(r.remaining_byte_length, 0)
+
+	def testPrimitives(self):
+		self.assertDecodes(b"\1", None)
+		self.assertDecodes(marshalling.marshal(5), 5)
+		self.assertDecodes(marshalling.marshal(70000), 70000)
+		self.assertDecodes(marshalling.marshal(b"x" * 10), b"x" * 10)
+		self.assertDecodes(marshalling.marshal(b"x" * 300), b"x" * 300)
+		self.assertDecodes(marshalling.marshal(""), "")
+		self.assertDecodes(marshalling.marshal("ä" * 200), "ä" * 200)
+
+	def testApplicationTypes(self):
+		double = tcp.Double()
+		double.value = 1.5
+		self.assertDecodes(double.marshal(), 1.5)
+		packed = fields.PackedArray("int32")
+		packed.value = [1, -2, 3]
+		self.assertDecodes(packed.marshal(), array.array("i", [1, -2, 3]))
+
+	def testComplex(self):
+		self.assertDecodes(b"\2\x0d\1\3\x0d\2\1\0\0", [1, [2, None]])
+		self.assertDecodes(b"\3\5\4\x0d\7\0", [(1, (0, 7))])
+		r = reader_for(b"\x0c\0\0\0\x2a\x0d\1\x11\0")
+		extension = r.read_value()
+		self.assertIsInstance(extension, UnknownExtension)
+		self.assertEqual(extension.registered_id, 42)
+		self.assertEqual(extension.values, [1, ""])
+		self.assertEqual(extension.raw, b"\x0d\1\x11")
+
+	def testMessage(self):
+		data = marshalling.marshal(tcp.Request(1, [(0, 2.5)],
+			extensions=[tcp.ThreadID(9, 1)]))
+		id, values, extensions = reader_for(data).read_message()
+		self.assertEqual(id, 0)
+		self.assertEqual(values, [1, [(0, 2.5)]])
+		self.assertEqual(extensions[0].values, [9, 1])
+
+	def testHomogeneousSequences(self):
+		data = b"\3" + b"\x0d\1\x0e\0\1\0\0" * 3 + b"\x0d\2\0"
+		self.assertDecodes(data, array.array("q", [1, 65536] * 3 + [2]),
+			homogeneous_sequences="array")
+		self.assertDecodes(b"\3\x0d\1\x11\0", [1, ""],
+			homogeneous_sequences="array")
+		numpy = reader.numpy
+		reader.numpy = None
+		try:
+			self.assertRaisesRegex(ImportError, "needs numpy", reader_for, 
+				data, homogeneous_sequences="numpy")
+		finally:
+			reader.numpy = numpy
+
+	def testDeepNesting(self):
+		depth = 100000
+		value = reader_for(b"\3" * depth + b"\0" * depth).read_value()
+		for i in range(depth - 1):
+			value = value[0]
+		self.assertEqual(value, [])
+
+	def testLengths(self):
+		# Short binary lengths are unsigned
+		self.assertDecodes(b"\x0f\xc8" + b"x" * 200, b"x" * 200)
+		# Long lengths are in network byte order
+		self.assertDecodes(b"\x10\0\0\1\0" + b"x" * 256, b"x" * 256)
+		self.assertDecodes(b"\x7f\0\0\1\0" + b"y" * 256, "y" * 256)
+		r = reader_for(b"\2\x0f\xc8" + b"x" * 200 + b"\x7f\0\0\1\0" +
+			b"y" * 256 + b"\0")
+		r._skip_value()
+		self.assertEqual(r.remaining_byte_length, 0)
+
+	def testWouldBlock(self):
+		# A connection without more bytes for now is not an error
+		r = reader_for(b"\x12")
+		self.assertRaises(reader.NotEnoughBytes, r.read_value)
+		r.connection.recv = lambda size: b"y"
+		self.assertEqual(r.read_value(), "y")
+		r.replace_processed(b"\x12")
+		r.connection.recv = lambda size: b""
+		self.assertRaisesRegex(reader.ReaderError, "Connection closed",
+			r.read_value)
+
+	def testErrors(self):
+		self.assertRaises(EndOfContent, reader_for(b"\0").read_value)
+		self.assertRaises(EndOfContent, reader_for(b"\2\4\0").read_value)
+		self.assertRaises(TWPError, reader_for(b"\x80").read_value)
+		self.assertRaises(reader.NotEnoughBytes,
+			reader_for(b"\2\x0d\1").read_value)
+
+
+class Trickle(Connection):
+	"""A connection that receives one byte at a time from what has been fed to
+	it."""
+	def __init__(self):
+		Connection.__init__(self)
+		self.pending = bytearray()
+
+	def feed(self, data):
+		self.pending += data
+
+	def recv(self, size):
+		if not self.pending:
+			raise BlockingIOError()
+		data = bytes(self.pending[:1])
+		del self.pending[:1]
+		return data
+
+
+def trickle_reader(**kwargs):
+	connection = Trickle()
+	connection.reader = reader.TWPReader(connection, **kwargs)
+	return connection.reader
+
+
+class TrickleConnection(Trickle, protocol.Connection):
+	protocol_class = echo.EchoProtocol
+	compression_threshold = 0
+
+	def __init__(self):
+		Trickle.__init__(self)
+		protocol.Connection.__init__(self)
+
+
+class IncrementalTest(unittest.TestCase):
+	def readByteByByte(self, r, data, read):
+		"""Feed data to r's connection one byte at a time and call read after 
+		each byte until it succeeds."""
+		last_pos = 0
+		for i in range(len(data)):
+			r.connection.feed(data[i:i + 1])
+			try:
+				result = read()
+			except reader.NotEnoughBytes:
+				# Decoded bytes are never decoded again
+				self.assertGreaterEqual(r.pos, last_pos)
+				last_pos = r.pos
+				continue
+			self.assertEqual(i, len(data) - 1, "Read before the last byte")
+			return result
+		self.fail("Incomplete after the last byte")
+
+	def testMessages(self):
+		messages = [
+			echo.Request("Hello, World!"),
+			echo.Response("x" * 300, 100),
+			fam.Changed(["home", "user"], "fam.py"),
+			calculator_request(),
+			Everything("text", 100, b"x" * 300, [1, 2, 3], [1.0], ["n", b"d"],
+				(1, [b"ip", None, [(0, 1.0)]])),
+		]
+		for message in messages:
+			data = marshalling.marshal(message)
+			id, values, extensions = reader_for(data).read_message()
+			r = trickle_reader()
+			result = self.readByteByByte(r, data, r.read_message)
+			self.assertEqual(result[:2], (id, values))
+			self.assertEqual([extension.values for extension in result[2]],
+				[extension.values for extension in extensions])
+			self.assertEqual(r.remaining_byte_length, 0)
+
+	def testValues(self):
+		values = [
+			b"\3" + b"\x0d\1\x0e\0\1\0\0" * 3 + b"\0",
+			b"\2" * 50 + b"\0" * 50,
+			b"\x0c\0\0\0\x2a\x0d\1\x11\0",
+		]
+		for data in values:
+			for homogeneous in (None, "array"):
+				expected = reader_for(data,
+					homogeneous_sequences=homogeneous).read_value()
+				r = trickle_reader(homogeneous_sequences=homogeneous)
+				result = self.readByteByByte(r, data, r.read_value)
+				if isinstance(expected, UnknownExtension):
+					self.assertEqual((result.values, result.raw),
+						(expected.values, expected.raw))
+				else:
+					self.assertEqual(result, expected)
+
+	def testConnection(self):
+		connection = TrickleConnection()
+		connection.compress = True
+		compressed, plain, declined = [marshalling.join_buffers(
+			connection._marshal_buffers(message)) for message in [
+				echo.Request("x" * 200),
+				echo.Response("Hello", 5, extensions=[tcp.ThreadID(1, 2)]),
+				compression.Compression(""),
+			]]
+		self.assertEqual(compressed[0], 12, "Not compressed")
+		message = self.readByteByByte(connection.reader, compressed,
+			connection.read_message)
+		self.assertEqual(message.text, "x" * 200)
+		message = self.readByteByByte(connection.reader, plain,
+			connection.read_message)
+		self.assertEqual((message.text, message.number_of_letters),
+			("Hello", 5))
+		self.assertEqual(message.extensions[0].values, [1, 2])
+		# The peer declines our offer
+		connection._compression_offered = True
+		for i in range(len(declined)):
+			connection.feed(declined[i:i + 1])
+			self.assertRaises(reader.NotEnoughBytes, connection.read_message)
+		self.assertFalse(connection.compress)
+
+
+def sequence(*values):
+	return (b"\3" + b"".join([marshalling.marshal(value) for value in values]) +
+		b"\0")
+
+
+class ZeroCopyTest(unittest.TestCase):
+	def testValues(self):
+		r = reader_for(sequence("x" * 10, "ä" * 200, b"y" * 10, b"z" * 300),
+			zero_copy=True)
+		short_string, string, short_binary, binary = r.read_value()
+		self.assertEqual((short_string, short_binary), ("x" * 10, b"y" * 10))
+		self.assertIsInstance(string, fields.LazyString)
+		self.assertEqual(string, "ä" * 200)
+		self.assertIsInstance(binary, memoryview)
+		self.assertTrue(binary.readonly)
+		self.assertEqual(binary, b"z" * 300)
+
+	def testLazyStringField(self):
+		data = marshalling.marshal(echo.Request("ä" * 200))
+		r = reader_for(data, zero_copy=True)
+		id, values, extensions = r.read_message()
+		self.assertIsInstance(values[0], fields.LazyString)
+		self.assertIsNone(values[0]._data)
+		message = echo.Request(*values)
+		self.assertEqual(message.text, "ä" * 200)
+		self.assertEqual(type(message.text), str)
+		r = reader_for(marshalling.marshal(b"\xff" * 300)[1:], zero_copy=True)
+		self.assertRaises(TWPError, str, r.read_string(127))
+
+	def testPinned(self):
+		r = reader_for(marshalling.marshal(b"a" * 300), zero_copy=True)
+		value = r.read_value()
+		r.flush()
+		# Received data must not overwrite the pinned value
+		for data in [marshalling.marshal(b"b" * 300), b"\xff" * 1000]:
+			r.replace_processed(data)
+			r.buffer[:] = b"\0" * len(r.buffer)
+			r.flush()
+		self.assertEqual(value, b"a" * 300)
+		r = reader_for(sequence(b"a" * 300, "s" * 300), zero_copy=True)
+		value, string = r.read_value()
+		r.release()
+		self.assertRaises(ValueError, bytes, value)
+		self.assertEqual(string, "s" * 300)
+		self.assertIsInstance(string.encoded, bytes)
+
+	def testRelay(self):
+		values = ["ä" * 200, b"z" * 300]
+		for value in values:
+			data = marshalling.marshal(value)
+			relayed = reader_for(data, zero_copy=True).read_value()
+			self.assertEqual(marshalling.marshal(relayed), data)
+			self.assertEqual(marshalling.join_buffers(
+				marshalling.marshal_buffers(relayed)), data)
+		data = marshalling.marshal(values[0])
+		relayed = reader_for(data, zero_copy=True).read_value()
+		message = echo.Request(relayed)
+		self.assertEqual(marshalling.marshal(message),
+			marshalling.marshal(echo.Request(values[0])))
+
+
+class LazyConnection(TrickleConnection):
+	lazy_messages = True
+
+
+class CountingReader(reader.TWPReader):
+	"""A reader that counts the tags it reads and the bytes it skips."""
+	examined = 0
+
+	def read_tag(self):
+		tag = reader.TWPReader.read_tag(self)
+		self.examined += 1
+		return tag
+
+	def _skip(self, n):
+		reader.TWPReader._skip(self, n)
+		self.examined += n
+
+
+def feedInChunks(test, r, data, size, read):
+	"""Feed data to r's connection in chunks of size bytes and call read 
+	after each until it succeeds."""
+	for i in range(0, len(data), size):
+		r.connection.feed(data[i:i + size])
+		try:
+			result = read()
+		except reader.NotEnoughBytes:
+			continue
+		test.assertGreaterEqual(i + size, len(data), "Read before the end")
+		return result
+	test.fail("Incomplete after the last chunk")
+
+
+class LazyMessageTest(unittest.TestCase):
+	def testScan(self):
+		messages = [
+			echo.Response("Hello", 5, extensions=[tcp.ThreadID(1, 2)]),
+			fam.Changed(["home", "user"], "fam.py"),
+			# Without Doubles, which the CalculatorProtocol reads itself
+			Everything("text", 100, b"x" * 300, [1, 2, 3], [], ["n", b"d"],
+				(1, [b"ip", None, []])),
+		]
+		for message in messages:
+			data = marshalling.marshal(message)
+			id, values, extensions = reader_for(data).read_message()
+			r = reader_for(data)
+			id, offsets, extension_offsets = r.scan_message()
+			self.assertEqual(r.remaining_byte_length, 0)
+			decode = r.value_decoder(r.processed_bytes)
+			self.assertEqual([decode(offset) for offset in offsets], values)
+			self.assertEqual([decode(offset).values for offset in 
+				extension_offsets], [extension.values for extension in extensions])
+
+	def testProtocolApplicationTypes(self):
+		# Doubles are read by the CalculatorProtocol
+		r = reader_for(marshalling.marshal(calculator_request()))
+		self.assertIsNone(r.scan_message())
+		self.assertEqual(r.pos, 0)
+		self.assertEqual(r.read_message()[1][0], 1)
+
+	def testLazyMessage(self):
+		connection = LazyConnection()
+		message = echo.Response("x" * 200, 100, extensions=[tcp.ThreadID(1, 2)])
+		data = marshalling.marshal(message)
+		lazy = IncrementalTest.readByteByByte(self, connection.reader, data,
+			connection.read_message)
+		self.assertIsInstance(lazy, LazyMessage)
+		self.assertEqual(lazy.id, 1)
+		self.assertEqual(lazy.number_of_letters, 100)
+		self.assertEqual(lazy._decoded, {"number_of_letters"})
+		self.assertEqual(marshalling.marshal(lazy), data)
+		self.assertEqual(marshalling.join_buffers(
+			marshalling.marshal_buffers(lazy)), data)
+		self.assertEqual(marshalling.marshalled_size(lazy), len(data))
+		self.assertEqual(lazy.extensions[0].values, [1, 2])
+		self.assertEqual(lazy.text, "x" * 200)
+		decoded = lazy.decode()
+		self.assertIsInstance(decoded, echo.Response)
+		self.assertEqual(decoded._items(), message._items())
+		lazy.number_of_letters = 3
+		message.number_of_letters = 3
+		self.assertIsNone(lazy.raw)
+		self.assertEqual(marshalling.marshal(lazy), marshalling.marshal(message))
+		self.assertRaises(AttributeError, getattr, lazy, "missing")
+
+	def testChunks(self):
+		data = marshalling.marshal(fam.Changed(["d" * 50] * 2500, "fam.py"))
+		connection = Stream()
+		r = connection.reader = CountingReader(connection)
+		result = feedInChunks(self, r, data, 100, r.scan_message)
+		self.assertEqual((result[0], len(result[1])), (0, 2))
+		# Incomplete values are continued at their last tag, not skipped again
+		self.assertLessEqual(r.examined, len(data) + len(data) // 100 + 1)
+
+	def testMissingFields(self):
+		connection = LazyConnection()
+		lazy = IncrementalTest.readByteByByte(self, connection.reader,
+			b"\5\x16hello\0", connection.read_message)
+		self.assertEqual((lazy.text, lazy.number_of_letters), ("hello", None))
+
+
+class Operands(fields.Struct):
+	a = fields.Int()
+	b = fields.Int()
+
+
+class Call(Message):
+	id = 0
+	operation = fields.String()
+	parameters = fields.AnyDefinedBy("operation")
+
+
+class CallProtocol(protocol.Protocol):
+	message_types = [Call]
+
+	def define_any_defined_by(self, field, reference_value):
+		if reference_value == "add":
+			return Operands()
+
+
+class EverythingProtocol(tcp.CalculatorProtocol):
+	message_types = [Everything]
+
+
+class TypedTest(unittest.TestCase):
+	def reader(self, data, protocol_class=tcp.CalculatorProtocol):
+		r = reader_for(data)
+		r.connection.protocol = protocol_class()
+		r.connection.protocol.init_connection(r.connection)
+		return r
+
+	def testMessages(self):
+		messages = [
+			(echo.EchoProtocol, echo.Response("Hello", 5)),
+			(fam.FAM, fam.Changed(["home", "user"], "fam.py")),
+			(tcp.CalculatorProtocol, calculator_request()),
+			(EverythingProtocol, Everything("text", 100, b"x" * 300, 
+				[1, 2, 3], [1.0], ["n", b"d"], (1, [b"ip", None, [(0, 1.0)]]))),
+		]
+		for protocol_class, message in messages:
+			data = marshalling.marshal(message)
+			r = self.reader(data, protocol_class)
+			result = r.read_typed_message()
+			self.assertIsInstance(result, message.__class__)
+			self.assertEqual(r.remaining_byte_length, 0)
+			self.assertEqual(marshalling.marshal(result), data)
+		self.assertIsInstance(result.sample, Sample)
+		self.assertEqual(result.sample["data"], b"d")
+		self.assertEqual(result.term[1]["host"], b"ip")
+		request = self.reader(marshalling.marshal(calculator_request())
+			).read_typed_message()
+		self.assertIsInstance(request.get_thread_id(), tcp.ThreadID)
+
+	def trickleReader(self, protocol_class):
+		r = trickle_reader()
+		r.connection.protocol = protocol_class()
+		r.connection.protocol.init_connection(r.connection)
+		return r
+
+	def testIncremental(self):
+		messages = [
+			(tcp.CalculatorProtocol, calculator_request()),
+			(EverythingProtocol, Everything("text", 100, b"x" * 300, 
+				[1, 2, 3], [1.0], ["n", b"d"], (1, [b"ip", None, [(0, 1.0)]]),
+				extensions=[tcp.ThreadID(1, 2)])),
+			(fam.FAM, fam.Changed(["home", "user"], "fam.py")),
+		]
+		for protocol_class, message in messages:
+			data = marshalling.marshal(message)
+			r = self.trickleReader(protocol_class)
+			result = IncrementalTest.readByteByByte(self, r, data, 
+				r.read_typed_message)
+			self.assertEqual(marshalling.marshal(result), data)
+		self.assertEqual(result.directory, ["home", "user"])
+		data = marshalling.marshal(Call("add", None))[:-2] + (b"\2\x0d\1"
+			b"\x0d\2\0\0")
+		r = self.trickleReader(CallProtocol)
+		call = IncrementalTest.readByteByByte(self, r, data, 
+			r.read_typed_message)
+		self.assertIsInstance(call.parameters, Operands)
+		self.assertEqual((call.parameters["a"], call.parameters["b"]), (1, 2))
+
+	def testChunks(self):
+		data = marshalling.marshal(fam.Changed(["d" * 50] * 2500, "fam.py"))
+		connection = Stream()
+		connection.protocol = fam.FAM()
+		connection.protocol.init_connection(connection)
+		r = connection.reader = CountingReader(connection)
+		r.connection.feed(data)
+		r.read_typed_message()
+		examined = r.examined
+		r = connection.reader = CountingReader(connection)
+		result = feedInChunks(self, r, data, 100, r.read_typed_message)
+		self.assertEqual(len(result.directory), 2500)
+		# Incomplete values are continued at their tag, not decoded again
+		self.assertLessEqual(r.examined, examined + len(data) // 100 + 1)
+
+	def testAnyDefinedBy(self):
+		data = marshalling.marshal(Call("add", None))[:-2] + (b"\2\x0d\1"
+			b"\x0d\2\0\0")
+		call = self.reader(data, CallProtocol).read_typed_message()
+		self.assertIsInstance(call.parameters, Operands)
+		self.assertEqual((call.parameters["a"], call.parameters["b"]), (1, 2))
+		data = marshalling.marshal(Call("sub", None))[:-2] + b"\2\x0d\1\0\0"
+		call = self.reader(data, CallProtocol).read_typed_message()
+		self.assertEqual(call.parameters, [1])
+
+	def testMismatch(self):
+		errors = [
+			(b"\4\x0d\1\0", "Request.text: Expected String but saw tag 13"),
+			(b"\5\x11\x0d\1\x0d\2\0", "Response has more values than fields"),
+			(b"\7\0", "Message not understood: 3"),
+		]
+		for data, error in errors:
+			r = self.reader(data, echo.EchoProtocol)
+			with self.assertRaises(TWPError) as context:
+				r.read_typed_message()
+			self.assertEqual(str(context.exception), error)
+		request = calculator_request()
+		request.arguments[1][1][0] = 1
+		r = self.reader(marshalling.marshal(request))
+		with self.assertRaises(TWPError) as context:
+			r.read_typed_message()
+		self.assertEqual(str(context.exception), "Request.arguments: "
+			"Parameters[1]: Expression.host: Expected Binary but saw tag 13")
+		# The same once the decoding has been interrupted within the value
+		r = self.trickleReader(tcp.CalculatorProtocol)
+		with self.assertRaises(TWPError) as resumed:
+			IncrementalTest.readByteByByte(self, r, 
+				marshalling.marshal(request), r.read_typed_message)
+		self.assertEqual(str(resumed.exception), str(context.exception))
+
+
+class UnknownExtensionTest(unittest.TestCase):
+	data = b"\x0c\0\0\0\x2b\x0d\1\x16hello\2\x0d\2\0\0"
+
+	def testLazyValues(self):
+		r = reader_for(self.data)
+		extension = r.read_value()
+		self.assertIsNotNone(extension._decode)
+		self.assertEqual(extension.raw, self.data[5:-1])
+		self.assertEqual(marshalling.marshal(extension), self.data)
+		self.assertEqual(extension.values, [1, "hello", [2]])
+
+	def testZeroCopy(self):
+		r = reader_for(self.data, zero_copy=True)
+		extension = r.read_extension()
+		self.assertIsInstance(extension.raw, memoryview)
+		self.assertTrue(extension.raw.readonly)
+		request = tcp.Request(1, [], extensions=[extension])
+		self.assertEqual(marshalling.marshal(request), 
+			b"\4\x0d\1\3\0" + self.data + b"\0")
+		self.assertEqual(extension.values, [1, "hello", [2]])
+
+	def testProtocolApplicationTypes(self):
+		double = tcp.Double()
+		double.value = 1.5
+		data = b"\x0c\0\0\0\x2b" + double.marshal() + b"\0"
+		extension = reader_for(data).read_value()
+		self.assertIsNone(extension._decode)
+		self.assertEqual(extension.values, [1.5])
+		self.assertEqual(marshalling.marshal(extension), data)
+
+	def testPinnedBufferSize(self):
+		connection = Stream()
+		r = reader.TWPReader(connection, _recvsize=1024, zero_copy=True)
+		connection.reader = r
+		data = b"\x0c\0\0\0\x2b" + marshalling.marshal(b"x" * 500) + b"\0"
+		extensions = []
+		for i in range(100):
+			connection.feed(data)
+			extensions.append(r.read_value())
+			r.flush()
+		self.assertLessEqual(len(r._data), 4096)
+		self.assertEqual([extension.values for extension in extensions],
+			[[b"x" * 500]] * 100)
+
+
+class RegisteredExtensionTest(unittest.TestCase):
+	def testRegistry(self):
+		self.assertIs(registered_extensions[42], tcp.ThreadID)
+		class Priority(Extension):
+			registered_id = 1000
+			level = fields.Int()
+		self.assertIs(registered_extensions[1000], Priority)
+		self.assertNotIn(None, registered_extensions)
+
+	def testConflict(self):
+		with self.assertRaisesRegex(ValueError, "42 of Tid is taken by "
+				"twp.protocols.tcp.ThreadID"):
+			class Tid(Extension):
+				registered_id = 42
+		self.assertIs(registered_extensions[42], tcp.ThreadID)
+		# Defining the same class again, e.g. in a reloaded module, replaces it
+		for i in range(2):
+			class Redefined(Extension):
+				registered_id = 2000
+		self.assertIs(registered_extensions[2000], Redefined)
+
+	def testGetExtension(self):
+		data = marshalling.marshal(calculator_request())
+		request = reader_for(data).read_typed_message()
+		extension = request.extensions[0]
+		self.assertIsInstance(extension, UnknownExtension)
+		self.assertIsNotNone(extension._decode)
+		thread_id = request.get_extension(tcp.ThreadID)
+		self.assertIsInstance(thread_id, tcp.ThreadID)
+		self.assertEqual((thread_id.tid, thread_id.depth), (9, 1))
+		self.assertIs(request.get_extension(tcp.ThreadID), thread_id)
+		self.assertIs(request.extensions[0], thread_id)
+		self.assertEqual(marshalling.marshal(request), data)
+		self.assertIsNone(tcp.Reply(1, 2.0).get_extension(tcp.ThreadID))
+
+	def testMaterialize(self):
+		extension = reader_for(b"\x0c\0\0\0\x2a\x0d\3\x0d\4\0").read_value()
+		thread_id = extension.materialize()
+		self.assertIsInstance(thread_id, tcp.ThreadID)
+		self.assertEqual((thread_id.tid, thread_id.depth), (3, 4))
+		unknown = reader_for(UnknownExtensionTest.data).read_value()
+		self.assertIs(unknown.materialize(), unknown)
+
+
+class Stream(Trickle):
+	"""A connection that receives as much of what has been fed to it as 
+	asked for."""
+	def recv(self, size):
+		if not self.pending:
+			raise BlockingIOError()
+		data = bytes(self.pending[:size])
+		del self.pending[:size]
+		return data
+
+
+class Chunks(object):
+	"""A spool file that collects the chunks written to it."""
+	def __init__(self):
+		self.chunks = []
+
+	def write(self, chunk):
+		self.chunks.append(bytes(chunk))
+
+
+class SocketConnection(Connection):
+	"""A connection that receives from a non-blocking socket."""
+	def __init__(self, sock):
+		Connection.__init__(self)
+		self.socket = sock
+		sock.setblocking(False)
+
+	def recv_into(self, buffer, size):
+		return self.socket.recv_into(buffer, size)
+
+
+class StreamingTest(unittest.TestCase):
+	def streamReader(self, data=b""):
+		connection = Stream()
+		connection.reader = reader.TWPReader(connection)
+		connection.feed(data)
+		return connection.reader
+
+	def testFieldByField(self):
+		message = fam.Changed(["home", "user"], "fam.py",
+			extensions=[tcp.ThreadID(1, 2)])
+		r = self.streamReader(marshalling.marshal(message))
+		self.assertEqual(r.read_message_start(), 0)
+		directory = []
+		for value in r.iter_sequence():
+			# Consumed values are dropped from the buffer
+			self.assertEqual(r.pos, 0)
+			directory.append(value)
+		self.assertEqual(directory, ["home", "user"])
+		self.assertEqual(r.read_value(), "fam.py")
+		extensions = r.read_message_end()
+		self.assertEqual([extension.values for extension in extensions],
+			[[1, 2]])
+		self.assertEqual(r.remaining_byte_length, 0)
+
+	def testErrors(self):
+		r = self.streamReader(b"\2\0")
+		self.assertRaisesRegex(TWPError, "Expected message tag but saw 2",
+			r.read_message_start)
+		r = self.streamReader(b"\x0d\1")
+		self.assertRaisesRegex(TWPError, "Expected sequence tag but saw 13",
+			r.iter_sequence)
+		r = self.streamReader(b"\x0d\1\0")
+		self.assertRaisesRegex(TWPError, "Expected extension or EOC but saw 1",
+			r.read_message_end)
+
+	def testNotEnoughBytes(self):
+		data = sequence("a", "b" * 100, "c")
+		r = self.streamReader(data[:10])
+		values = r.iter_sequence()
+		self.assertEqual(next(values), "a")
+		self.assertRaises(reader.NotEnoughBytes, next, values)
+		r.connection.feed(data[10:])
+		self.assertEqual(list(r.iter_values()), ["b" * 100, "c"])
+
+	def testNonBlockingSocket(self):
+		data = sequence(*["x" * 100] * 50)
+		sender, receiver = socket.socketpair()
+		try:
+			connection = SocketConnection(receiver)
+			r = reader.TWPReader(connection)
+			sender.sendall(data[:1000])
+			later = threading.Timer(0.05, sender.sendall, [data[1000:]])
+			later.start()
+			self.assertEqual(list(r.iter_sequence()), ["x" * 100] * 50)
+			later.join()
+		finally:
+			sender.close()
+			receiver.close()
+
+
+class SpoolingConnection(Stream, protocol.Connection):
+	protocol_class = echo.EchoProtocol
+	max_message_size = 100000
+	spool_threshold = 1000
+
+	def __init__(self):
+		Stream.__init__(self)
+		protocol.Connection.__init__(self)
+
+
+class BufferTest(unittest.TestCase):
+	def streamReader(self, **kwargs):
+		connection = Stream()
+		connection.reader = reader.TWPReader(connection, _recvsize=100, 
+			**kwargs)
+		return connection.reader
+
+	def readAll(self, r):
+		values = []
+		while True:
+			try:
+				values.append(r.read_value())
+			except reader.NotEnoughBytes:
+				return values
+			r.flush()
+
+	def receivedReader(self, processed, unprocessed, **kwargs):
+		"""A reader with a 100 byte buffer that has received and flushed 
+		processed bytes, followed by unprocessed ones."""
+		r = self.streamReader(**kwargs)
+		r.connection.feed(b"\1" * (processed + unprocessed))
+		r.peek_tag()
+		r._advance(processed)
+		r.flush()
+		return r
+
+	def testCompaction(self):
+		r = self.receivedReader(70, 10)
+		buffer = r._data
+		r._reserve(50)
+		# The unflushed bytes are moved to the front
+		self.assertIs(r._data, buffer)
+		self.assertEqual((r._start, r._end), (0, 10))
+		self.assertEqual(r.buffer, b"\1" * 10)
+		r._reserve(90)
+		self.assertIs(r._data, buffer)
+
+	def testGrowth(self):
+		# More than half of the buffer is unflushed
+		r = self.receivedReader(20, 60)
+		buffer = r._data
+		r._reserve(30)
+		self.assertIsNot(r._data, buffer)
+		self.assertEqual(len(r._data), 200)
+		self.assertEqual((r._start, r._end), (0, 60))
+		self.assertEqual(r.buffer, b"\1" * 60)
+		# The unflushed bytes and size do not fit
+		r = self.receivedReader(70, 10)
+		r._reserve(500)
+		self.assertEqual(len(r._data), 510)
+		self.assertEqual(r.buffer, b"\1" * 10)
+
+	def testPinned(self):
+		r = self.streamReader(zero_copy=True)
+		r.max_recvsize = 100
+		r.connection.feed(marshalling.marshal(b"p" * 300))
+		value = r.read_value()
+		r.flush()
+		buffer = r._data
+		r.connection.feed(b"\1")
+		self.assertIsNone(r.read_value())
+		# A new buffer of the same size, compacting would overwrite the 
+		# zero-copy value
+		self.assertIsNot(r._data, buffer)
+		self.assertEqual(len(r._data), len(buffer))
+		self.assertEqual(value, b"p" * 300)
+
+	def testRecvsize(self):
+		sizes = []
+		def recorded():
+			r = self.streamReader()
+			recv = r.connection.recv
+			def record(size):
+				sizes.append(size)
+				return recv(size)
+			r.connection.recv = record
+			return r
+		r = recorded()
+		r.max_recvsize = 1000
+		r.connection.feed(sequence(*["x" * 20] * 500))
+		self.assertEqual(len(r.read_value()), 500)
+		self.assertEqual(sizes[:6], [100, 200, 400, 800, 1000, 1000])
+		self.assertEqual(max(sizes), 1000)
+		# Reads that return less than asked for do not grow it
+		r = recorded()
+		del sizes[:]
+		data = sequence(*["x" * 20] * 20)
+		for i in range(0, len(data), 50):
+			r.connection.feed(data[i:i + 50])
+			self.readAll(r)
+		self.assertEqual(set(sizes), {100})
+		self.assertEqual(r._recvsize, 100)
+
+	def testShrink(self):
+		r = self.streamReader()
+		r.max_recvsize = 1000
+		r.connection.feed(marshalling.marshal(b"z" * 5000) + b"\1")
+		self.assertEqual(r.read_value(), b"z" * 5000)
+		self.assertEqual(r.peek_tag(), 1)
+		r.flush()
+		# Not while unflushed bytes remain
+		self.assertGreater(len(r._data), 5000)
+		self.assertEqual(r.read_value(), None)
+		r.flush()
+		self.assertEqual(len(r._data), 100)
+		# Buffers of up to max_recvsize are kept
+		r = self.streamReader()
+		r.max_recvsize = 1000
+		r.connection.feed(marshalling.marshal(b"z" * 995))
+		self.assertEqual(r.read_value(), b"z" * 995)
+		r.flush()
+		self.assertEqual(len(r._data), 1000)
+
+
+class MemoryBudgetTest(unittest.TestCase):
+	def streamReader(self, **kwargs):
+		connection = Stream()
+		connection.reader = reader.TWPReader(connection, _recvsize=1024, 
+			**kwargs)
+		return connection.reader
+
+	def readInPieces(self, r, data, size=3000, read=None):
+		"""Feed data in pieces of size bytes, reading a value after each."""
+		for i in range(0, len(data), size):
+			r.connection.feed(data[i:i + size])
+			try:
+				value = (read or r.read_value)()
+			except reader.NotEnoughBytes:
+				# Spooled values are not buffered
+				self.assertLessEqual(len(r._data), 2 * (r._min_recvsize + size))
+				continue
+			self.assertGreaterEqual(i + size, len(data))
+			return value
+		self.fail("Incomplete after the last piece")
+
+	def testMaxMessageSize(self):
+		r = reader_for(b"\x10\x7f\xff\xff\xff", max_message_size=2**20)
+		self.assertRaises(reader.MessageTooLarge, r.read_value)
+		self.assertLess(len(r._data), 2**20)
+		data = sequence(*[b"x" * 200] * 10)
+		self.assertRaises(reader.MessageTooLarge, reader_for(data, 
+			max_message_size=1000).read_value)
+		self.assertEqual(len(reader_for(data, max_message_size=len(data)
+			).read_value()), 10)
+		r = self.streamReader(max_message_size=10000, spool_threshold=1000)
+		r.connection.feed(marshalling.marshal(b"x" * 20000))
+		self.assertRaises(reader.MessageTooLarge, r.read_value)
+
+	def testMaxMessageSizeSpooled(self):
+		data = sequence(b"x" * 5000, b"y" * 3000)
+		for size in [1, 100, 3000, len(data)]:
+			r = self.streamReader(max_message_size=len(data),
+				spool_threshold=1000)
+			self.assertEqual(len(self.readInPieces(r, data, size)), 2)
+			self.assertEqual(r.pos + r._spooled, len(data))
+			self.assertEqual(r._spooled, 8000)
+			r = self.streamReader(max_message_size=len(data) - 1,
+				spool_threshold=1000)
+			self.assertRaises(reader.MessageTooLarge, self.readInPieces, r,
+				data, size)
+
+	def testSpool(self):
+		payload = bytes(range(256)) * 400
+		values = [
+			(payload, marshalling.marshal(payload)),
+			("ä" * 50000, marshalling.marshal("ä" * 50000)),
+		]
+		for value, data in values:
+			r = self.streamReader(spool_threshold=4096)
+			result = self.readInPieces(r, sequence(value, 1))
+			self.assertEqual(result[1], 1)
+			if isinstance(value, bytes):
+				self.assertIsInstance(result[0], fields.FileRegion)
+				self.assertEqual(bytes(result[0]), value)
+			else:
+				self.assertIsInstance(result[0].encoded, fields.FileRegion)
+				self.assertEqual(result[0], value)
+			self.assertEqual(marshalling.marshal(result[0]), data)
+			region = result[0] if isinstance(value, bytes) else result[0].encoded
+			region.file.close()
+		r = self.streamReader(spool_threshold=100)
+		r.connection.feed(marshalling.marshal(b"x" * 99))
+		self.assertEqual(r.read_value(), b"x" * 99)
+
+	def testSpoolFile(self):
+		spools = []
+		def spool_file(tag, length):
+			spools.append((tag, length, Chunks()))
+			return spools[-1][2]
+		r = self.streamReader(spool_threshold=4096, spool_file=spool_file)
+		payload = b"y" * 100000
+		region = self.readInPieces(r, marshalling.marshal(payload))
+		self.assertEqual(len(region), len(payload))
+		tag, length, chunks = spools[0]
+		self.assertEqual((tag, length), (16, len(payload)))
+		self.assertEqual(b"".join(chunks.chunks), payload)
+		self.assertGreater(len(chunks.chunks), 10)
+
+	def testConnection(self):
+		connection = SpoolingConnection()
+		data = marshalling.marshal(echo.Request("z" * 50000))
+		message = self.readInPieces(connection.reader, data, 
+			read=connection.read_message)
+		self.assertEqual(message.text, "z" * 50000)
+		connection.feed(marshalling.marshal(echo.Request("z" * 200000)))
+		self.assertRaises(reader.MessageTooLarge, connection.read_message)
+
+	def testDecompress(self):
+		data = b"x" * 100000
+		extension = UnknownExtension(compression.Compressed.registered_id,
+			[compression.compress(data).body])
+		self.assertEqual(compression.decompress(extension), data)
+		self.assertEqual(compression.decompress(extension, len(data)), data)
+		self.assertRaises(TWPError, compression.decompress, extension, 
+			len(data) - 1)
+		extension.values = [extension.values[0][:-10]]
+		self.assertRaises(TWPError, compression.decompress, extension, 
+			len(data))
+
+
+class InternTest(unittest.TestCase):
+	def testStrings(self):
+		names = ["home", "user", "home", "fam.py", "x" * 100, "x" * 100]
+		r = reader_for(sequence(*names) * 2, intern_strings=10)
+		first, second = r.read_value(), r.read_value()
+		self.assertEqual(list(first), names)
+		self.assertIsInstance(first, tuple)
+		self.assertIs(first, second)
+		self.assertIs(first[0], first[2])
+		# Longer than intern_max_length
+		self.assertIsNot(first[4], first[5])
+		stats = r.intern_stats()
+		self.assertEqual((stats["hits"], stats["misses"]), (6, 4))
+		self.assertGreater(stats["saved"], 0)
+		self.assertIsNone(reader_for(b"\1").intern_stats())
+
+	def testSequences(self):
+		r = reader_for(sequence("a", 1) + sequence() + sequence(b"a"),
+			intern_strings=10)
+		self.assertEqual(r.read_value(), ["a", 1])
+		self.assertEqual(r.read_value(), ())
+		self.assertEqual(r.read_value(), [b"a"])
+		r = reader_for(sequence(*["a"] * 2000), intern_strings=10)
+		self.assertIsInstance(r.read_value(), list)
+
+	def testEviction(self):
+		r = reader_for(sequence("a", "b", "c", "a"), intern_strings=2)
+		r.read_value()
+		stats = r.intern_stats()
+		# "a" is evicted by "c" before it repeats, the tuple evicts "c"
+		self.assertEqual((stats["hits"], stats["evictions"]), (0, 3))
+
+	def testTyped(self):
+		message = fam.Changed(["home", "user"], "home")
+		r = reader_for(marshalling.marshal(message) * 2, intern_strings=10)
+		r.connection.protocol = fam.FAM()
+		first = r.read_typed_message()
+		r.flush()
+		second = r.read_typed_message()
+		self.assertEqual(first.directory, ("home", "user"))
+		self.assertIs(first.directory, second.directory)
+		self.assertIs(first.filename, first.directory[0])
+		self.assertEqual(marshalling.marshal(second), 
+			marshalling.marshal(message))
+
+
+class ColumnsTest(unittest.TestCase):
+	def testFAM(self):
+		messages = [
+			fam.Changed(["home", "user"], "a.py"),
+			fam.Created(["home", "user"], "b.py", 
+				extensions=[tcp.ThreadID(1, 2)]),
+			fam.Deleted(["home", "user"], "a.py"),
+		]
+		data = b"".join([marshalling.marshal(message) for message in messages])
+		columns = reader.decode_columns(fam.FAM, data)
+		self.assertEqual(columns["id"], array.array("B", [0, 2, 1]))
+		self.assertEqual(columns["filename"], ["a.py", "b.py", "a.py"])
+		self.assertIs(columns["filename"][0], columns["filename"][2])
+		directories = columns["directory"]
+		self.assertEqual(directories[0], ("home", "user"))
+		self.assertTrue(directories[0] is directories[1] is directories[2])
+		self.assertEqual(columns["extensions"][0], None)
+		self.assertEqual(columns["extensions"][1][0].values, [1, 2])
+
+	def testColumns(self):
+		messages = [
+			echo.Response("Hello", 5),
+			echo.Request("Hi"),
+			echo.Response("Hello", 5),
+		]
+		data = b"".join([marshalling.marshal(message) for message in messages])
+		columns = reader.decode_columns(echo.EchoProtocol, data)
+		self.assertEqual(columns["text"], ["Hello", "Hi", "Hello"])
+		self.assertEqual(columns["number_of_letters"], [5, None, 5])
+		columns = reader.decode_columns(echo.EchoProtocol, 
+			marshalling.marshal(messages[0]) * 2)
+		self.assertEqual(columns["number_of_letters"], array.array("q", [5, 5]))
+		self.assertRaises(reader.ReaderError, reader.decode_columns, 
+			echo.EchoProtocol, data[:-1])
+		self.assertRaises(TWPError, reader.decode_columns, echo.EchoProtocol,
+			b"\7\0")
+
+
+class PooledConnection(Stream, protocol.Connection):
+	protocol_class = echo.EchoProtocol
+	message_pool_size = 2
+
+	def __init__(self):
+		Stream.__init__(self)
+		protocol.Connection.__init__(self)
+
+
+class MessagePoolTest(unittest.TestCase):
+	def testConnection(self):
+		for typed in (True, False):
+			connection = PooledConnection()
+			connection.typed_messages = typed
+			connection.feed(marshalling.marshal(echo.Response("a", 1, 
+				extensions=[tcp.ThreadID(1, 2)])))
+			connection.feed(marshalling.marshal(echo.Response("b")))
+			first = connection.read_message()
+			self.assertEqual(len(first.extensions), 1)
+			connection.protocol.release_message(first)
+			second = connection.read_message()
+			self.assertIs(second, first)
+			self.assertEqual((second.text, second.number_of_letters), 
+				("b", None))
+			self.assertEqual(second.extensions, [])
+			stats = connection.protocol.message_pool.stats()[echo.Response]
+			self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+			self.assertEqual(stats["reuse_rate"], 0.5)
+
+	def testBounds(self):
+		pool = MessagePool(maxsize=1, sizes={echo.Request: 0})
+		first, second = echo.Response("a", 1), echo.Response("b", 2)
+		first.received = 1
+		with pool.lease(first) as message:
+			self.assertIs(message, first)
+		self.assertFalse(hasattr(first, "received"))
+		self.assertRaises(ValueError, pool.release, first)
+		pool.release(second)
+		pool.release(echo.Request("c"))
+		self.assertIs(pool.new(echo.Response, "d"), first)
+		self.assertEqual((first.text, first.number_of_letters), ("d", None))
+		self.assertIsNot(pool.new(echo.Response), second)
+		stats = pool.stats()
+		self.assertEqual(stats[echo.Response]["dropped"], 1)
+		self.assertEqual(stats[echo.Request]["dropped"], 1)
+
+
+def runTests():
+	unittest.main()
+
+if __name__ == "__main__":
+	runTests()